@@ -1,27 +1,33 @@
 
 import json
+import sys
 from pathlib import Path
 
-def annotate_geojson(index_geojson_paths, raw_dir, output_geojson_path):
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from download_ledger import DownloadLedger, STATUS_DOWNLOADED
+
+def annotate_geojson(index_geojson_paths, ledger_file, output_geojson_path):
     """
-    Reads a GeoJSON file and a list of sheet numbers, then creates a new
+    Reads a GeoJSON file and the download ledger, then creates a new
     annotated GeoJSON file with a 'status' property for each feature.
 
     Args:
         index_geojson_path (str): The path to the input GeoJSON file.
-        sheet_nos_path (str): The path to the text file containing sheet numbers.
+        ledger_file (str): The path to the download ledger written by scrape_sheets.py.
         output_geojson_path (str): The path to write the annotated GeoJSON file.
     """
     try:
 
+        statuses = DownloadLedger(ledger_file).get_statuses()
         available_sheets = set()
-        for p in raw_dir.glob('*.pdf'):
-            available_sheets.add(p.stem)
         unavailable_sheets = set()
-        for p in raw_dir.glob('*.unavailable'):
-            unavailable_sheets.add(p.stem.replace('.pdf', ''))
-        for p in raw_dir.glob('*.html'):
-            unavailable_sheets.add(p.stem)
+        for sheet, status in statuses.items():
+            if status == STATUS_DOWNLOADED:
+                available_sheets.add(sheet)
+            else:
+                unavailable_sheets.add(sheet)
 
         all_features = []
         for index_geojson_path in index_geojson_paths:
@@ -64,4 +70,5 @@ if __name__ == '__main__':
     INDEX_25K_GEOJSON = 'data/index_25k.geojson'
     EXTRA_GEOJSON = 'data/extra.geojson'
     OUTPUT_GEOJSON = 'data/index_annotated.geojson'
-    annotate_geojson([INDEX_25K_GEOJSON], Path('data/raw'), OUTPUT_GEOJSON)
+    LEDGER_FILE = 'data/download_ledger.sqlite'
+    annotate_geojson([INDEX_25K_GEOJSON], LEDGER_FILE, OUTPUT_GEOJSON)
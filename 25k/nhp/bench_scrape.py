@@ -0,0 +1,126 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "soi-common",
+# ]
+#
+# [tool.uv.sources]
+# soi-common = { git = "https://github.com/ramseraph/soi_common" }
+# ///
+
+import os
+import sys
+import time
+from pathlib import Path
+
+# the mock portal is shared by the benchmarks of all the scrapers
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from mock_portal import (
+    PORTAL_URL_ENV,
+    TIME_SCALE_ENV,
+    add_bench_args,
+    run_bench,
+    get_catalogue,
+    get_accounts,
+    point_at_portal,
+    mock_login,
+    call_portal,
+    run_with_timeout,
+    diff_counts,
+    get_run_record,
+    bench_sheet_runs,
+    verify_downloads,
+)
+
+# the account workers are spawned and import this file again, they need pointing at the portal too
+if __name__ == '__mp_main__' and os.environ.get(PORTAL_URL_ENV):
+    import scrape_sheets
+    point_at_portal(scrape_sheets, os.environ[PORTAL_URL_ENV], float(os.environ.get(TIME_SCALE_ENV, '1')))
+
+
+def get_listing_keys(catalogue):
+    # scrape_available keys the listings by the state and district names
+    keys = {}
+    for state_id, (state_name, dists) in catalogue.states.items():
+        for dist_id, (dist_name, _) in dists.items():
+            keys[f'{state_id}/{dist_id}'] = f'{state_name}/{dist_name}'
+    return keys
+
+def check_listings(catalogue, ledger, list_dir):
+    counts = { 'ok': 0, 'missing': 0, 'wrong_listing': 0 }
+    problems = []
+    for key, name in get_listing_keys(catalogue).items():
+        state_id, dist_id = key.split('/')
+        expected = catalogue.get_listing(state_id, dist_id, available_only=True)
+        if not ledger.is_listing_done(name):
+            counts['missing'] += 1
+            continue
+        sheets_file = Path(list_dir) / name / 'sheets.txt'
+        found = sheets_file.read_text().split() if sheets_file.exists() else []
+        if found != expected:
+            counts['wrong_listing'] += 1
+            problems.append(f'{name}: listed {len(found)} sheets, the portal has {len(expected)}')
+            continue
+        counts['ok'] += 1
+    return counts, problems
+
+def bench_sheets(args, url):
+    import scrape_sheets
+    point_at_portal(scrape_sheets, url, args.time_scale)
+    accounts = get_accounts(args.accounts)
+    scrape_sheets.get_secrets = lambda: accounts
+
+    sheet_list = get_catalogue(args).sheets
+    ledger_file = scrape_sheets.ledger.ledger_file
+    runs = bench_sheet_runs(args, url, ledger_file, sheet_list,
+                            lambda: scrape_sheets.scrape_wrap(False, 'NHP', sheet_list))
+    check, problems = verify_downloads(get_catalogue(args), sheet_list, ledger_file, scrape_sheets.raw_data_dir, zipped=True)
+    return { 'runs': runs, 'check': check, 'problems': problems }
+
+def bench_available(args, url):
+    import scrape_available
+    point_at_portal(scrape_available, url, args.time_scale)
+    account = next(iter(get_accounts(1)))
+
+    def scrape():
+        mock_login(scrape_available, url, account)
+        scrape_available.scrape()
+
+    catalogue = get_catalogue(args)
+    listing_keys = get_listing_keys(catalogue)
+    ledger = scrape_available.ledger
+    runs = []
+    for run in range(1, args.runs + 1):
+        if run > 1:
+            call_portal(url, '__restore', post=True)
+        done_before = { k for k, name in listing_keys.items() if ledger.is_listing_done(name) }
+        stats_before = call_portal(url, '__stats')
+        start = time.time()
+        error = run_with_timeout(scrape, args.timeout)
+        elapsed = time.time() - start
+        stats = call_portal(url, '__stats')
+        done_after = { k for k, name in listing_keys.items() if ledger.is_listing_done(name) }
+        # listing pages of districts done in an earlier run shouldn't be fetched again
+        pages = diff_counts(stats['listing_pages'], stats_before['listing_pages'])
+        repeats = sum(v for k, v in pages.items() if k in done_before)
+        runs.append(get_run_record(run, elapsed, stats, stats_before, len(done_after - done_before), repeats, error))
+    check, problems = check_listings(catalogue, ledger, scrape_available.list_data_dir)
+    return { 'runs': runs, 'check': check, 'problems': problems }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='run an NHP scraper against the mock portal and check what it leaves in the ledger',
+        epilog='the scraper settings come from the usual environment variables, '
+               'like ORDER_BATCH_SIZE, NUM_ACCOUNTS and RATE_START/RATE_MIN/RATE_MAX')
+    parser.add_argument('--scraper', choices=['sheets', 'available'], default='sheets',
+                        help='run scrape_sheets.py or scrape_available.py, the listings are counted in place of sheets for the latter')
+    add_bench_args(parser)
+    args = parser.parse_args()
+
+    if args.scraper == 'sheets':
+        run_bench(args, 'nhp', lambda url: bench_sheets(args, url))
+    else:
+        run_bench(args, 'nhp_available', lambda url: bench_available(args, url))
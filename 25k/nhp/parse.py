@@ -10,6 +10,7 @@
 
 
 import os
+import sys
 import json
 import time
 import subprocess
@@ -25,6 +26,14 @@ from shapely.geometry import LineString
 
 from topo_map_processor.processor import TopoMapProcessor, LineRemovalParams
 
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from stage_stats import StageStats
+from line_removal import remove_lines
+from stage_handoff import StageHandoff
+from stage_manifest import StageManifest, get_code_version
+
 GRATICULE_LAYER_NAME_PREFIX1 = "Graticle_Line"
 GRATICULE_LAYER_NAME_PREFIX2 = "Graticule"
 GRATICULE_LAYER_NAME_PREFIX3 = "IndiaGridpro_25K"
@@ -38,6 +47,13 @@ BLACK_LINES_MIN_LINE_SCALE = 16
 BLACK_COLOR_TOL = 0.1
 BLUE_COLOR_TOL = 0.1
 
+# auto: render in process unless the page needs the font substitutions of mutool,
+# pymupdf/mutool: always render with that
+RENDER_ENGINE = os.environ.get('RENDER_ENGINE', 'auto')
+# rows rendered at a time, 0 renders the page in one go. banding caps the extra memory
+# at one band but the anti aliasing at the band edges comes out slightly different
+RENDER_BAND_HEIGHT = int(os.environ.get('RENDER_BAND_HEIGHT', '0'))
+
 # create a point namedtuple
 Point = namedtuple('Point', ['x', 'y'])
 
@@ -52,6 +68,79 @@ def run_external(cmd):
     if res.returncode != 0:
         raise Exception(f'command {cmd} failed with exit code: {res.returncode}')
 
+def run_mutool_draw(pdf_file_path, img_path):
+    run_external(f'bin/mutool draw -n data/SOI_FONTS -r {DPI} -c rgb -o {str(img_path)} {str(pdf_file_path)}')
+
+def get_unembedded_fonts(page):
+    fonts = []
+    for xref, ext, ftype, basefont, *_ in page.get_fonts():
+        if ext == 'n/a' and ftype != 'Type3':
+            fonts.append(basefont)
+    return fonts
+
+def can_render_in_process(page):
+    if RENDER_ENGINE == 'mutool':
+        return False
+    if RENDER_ENGINE == 'pymupdf':
+        return True
+    # mutool substitutes the missing fonts from data/SOI_FONTS, pymupdf can't
+    fonts = get_unembedded_fonts(page)
+    if len(fonts) > 0:
+        print(f'Page uses fonts which are not embedded: {fonts}, rendering with mutool')
+        return False
+    return True
+
+def render_page(page, dpi=DPI, band_height=RENDER_BAND_HEIGHT):
+    """
+    Renders page with the current layer state of its document into a BGR array,
+    laid out like cv2.imread() of a mutool rendering of the page.
+    """
+    start = time.time()
+    matrix = pymupdf.Matrix(dpi / 72.0, dpi / 72.0)
+    dl = page.get_displaylist()
+    irect = (dl.rect * matrix).round()
+    if band_height <= 0:
+        band_height = irect.height
+    out = np.empty((irect.height, irect.width, 3), dtype=np.uint8)
+    for y0 in range(irect.y0, irect.y1, band_height):
+        y1 = min(y0 + band_height, irect.y1)
+        if y0 == irect.y0 and y1 == irect.y1:
+            clip = None
+        else:
+            clip = pymupdf.Rect(irect.x0, y0, irect.x1, y1) * ~matrix
+        pix = dl.get_pixmap(matrix=matrix, colorspace=pymupdf.csRGB, alpha=False, clip=clip)
+        band = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(pix.h, pix.w, 3)
+        # the rounding of the clip can give an extra row or column
+        by = y0 - pix.y
+        bx = irect.x0 - pix.x
+        cv2.cvtColor(band[by:by + (y1 - y0), bx:bx + irect.width], cv2.COLOR_RGB2BGR, dst=out[y0 - irect.y0:y1 - irect.y0])
+        del band
+        del pix
+    print(f'rendering page of size {irect.width}x{irect.height} took {time.time() - start} secs')
+    return out
+
+def set_layers_off(doc, off_xrefs):
+    """
+    Switches off the layers off_xrefs and switches on all the others, in the state
+    used when rendering doc. doc.set_layer() only changes what gets saved, so this
+    goes through the layer ui configs. Returns False if the layers can't all be
+    reached that way.
+    """
+    ocgs = doc.get_ocgs()
+    names = [ props.get('name', '') for props in ocgs.values() ]
+    configs = [ c for c in doc.layer_ui_configs() if c.get('type') != 'label' ]
+    if len(set(names)) != len(names) or sorted(names) != sorted(c['text'] for c in configs):
+        return False
+
+    off_names = set(ocgs[xref].get('name', '') for xref in off_xrefs)
+    for c in configs:
+        doc.set_layer_ui_config(c['number'], action=2 if c['text'] in off_names else 0)
+
+    for xref, props in doc.get_ocgs().items():
+        if props.get('on') != (xref not in off_xrefs):
+            return False
+    return True
+
 # assumes some ordering of the points in the lines, and the lines themselves
 def get_line_intersection_parallel(line1, line2, direction, tolerance=0.0):
     lines = [line1, line2]
@@ -166,6 +255,69 @@ def get_line_intersection_perpendicular(line1, line2, tolerance=0.0, pick_only_4
         
     return None
 
+def get_line_intersections_perpendicular(lines1, lines2, tolerance=0.0, pick_only_4way=False, pick_only_4way_tolerance=5.0):
+    """
+    Same as calling get_line_intersection_perpendicular for every pair from lines1 x lines2,
+    computed for all pairs at once. Returns the intersection points in the same order as the nested loops.
+    """
+    if len(lines1) == 0 or len(lines2) == 0:
+        return []
+
+    a = np.array([ (l[0].x, l[0].y, l[1].x, l[1].y) for l in lines1 ], dtype=np.float64)
+    b = np.array([ (l[0].x, l[0].y, l[1].x, l[1].y) for l in lines2 ], dtype=np.float64)
+
+    # rows are lines1, columns are lines2
+    x1, y1, x2, y2 = [ a[:, k][:, None] for k in range(4) ]
+    x3, y3, x4, y4 = [ b[:, k][None, :] for k in range(4) ]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t_dist = np.sqrt((x2 - x1)**2 + (y2 - y1)**2)
+        u_dist = np.sqrt((x4 - x3)**2 + (y4 - y3)**2)
+        t_tol = tolerance / t_dist
+        u_tol = tolerance / u_dist
+
+        den = (x1 - x2) * (y3 - y4) - (y1 - y2) * (x3 - x4)
+        t = ((x1 - x3) * (y3 - y4) - (y1 - y3) * (x3 - x4)) / den
+        u = -((x1 - x2) * (y1 - y3) - (y1 - y2) * (x1 - x3)) / den
+
+        valid = (t_dist != 0) & (u_dist != 0) & (den != 0)
+        valid &= (0 - t_tol <= t) & (t <= 1 + t_tol) & (0 - u_tol <= u) & (u <= 1 + u_tol)
+        if pick_only_4way:
+            t_4way_tol = pick_only_4way_tolerance / t_dist
+            u_4way_tol = pick_only_4way_tolerance / u_dist
+            valid &= (0 + t_4way_tol < t) & (t < 1 - t_4way_tol) & (0 + u_4way_tol < u) & (u < 1 - u_4way_tol)
+
+        ix = x1 + t * (x2 - x1)
+        iy = y1 + t * (y2 - y1)
+
+    rows, cols = np.nonzero(valid)
+    return list(zip(ix[rows, cols].tolist(), iy[rows, cols].tolist()))
+
+def count_unique_points(points, threshold):
+    """
+    Each point is counted against the first earlier unique point closer than threshold,
+    or becomes a unique point itself. Candidates are looked up in a grid of threshold sized cells.
+    """
+    unique_points = {}
+    grid = {}
+    for point in points:
+        cx, cy = int(np.floor(point[0] / threshold)), int(np.floor(point[1] / threshold))
+        match = None
+        for gx in (cx - 1, cx, cx + 1):
+            for gy in (cy - 1, cy, cy + 1):
+                for idx, unique_point in grid.get((gx, gy), []):
+                    if match is not None and match[0] < idx:
+                        continue
+                    dist = np.sqrt((point[0] - unique_point[0])**2 + (point[1] - unique_point[1])**2)
+                    if dist < threshold:
+                        match = (idx, unique_point)
+        if match is not None:
+            unique_points[match[1]] += 1
+            continue
+        grid.setdefault((cx, cy), []).append((len(unique_points), point))
+        unique_points[point] = 1
+    return unique_points
+
 def display_lines(horizontal_lines, vertical_lines, title="Lines"):
     import matplotlib.pyplot as plt
 
@@ -204,30 +356,15 @@ def get_corners_from_lines(page, vertical_lines, horizontal_lines, line_scale=2,
     print(f"After joining and filtering short lines, {len(vertical_lines)} vertical and {len(horizontal_lines)} horizontal lines")
     #display_lines(horizontal_lines, vertical_lines, title="Extracted Lines")
 
-    intersections = []
-    for h_line in horizontal_lines:
-        for v_line in vertical_lines:
-            intersection = get_line_intersection_perpendicular(h_line, v_line, pick_only_4way=pick_only_4way, pick_only_4way_tolerance=5.0)
-            if intersection:
-                intersections.append(intersection)
+    intersections = get_line_intersections_perpendicular(horizontal_lines, vertical_lines, pick_only_4way=pick_only_4way, pick_only_4way_tolerance=5.0)
                 
     if not intersections:
         print("No intersections found.")
         return
 
     # Filter for unique intersection points
-    unique_intersections = {}
     uniqueness_threshold = 1.0
-    for point in intersections:
-        is_unique = True
-        for unique_point in unique_intersections:
-            dist = np.sqrt((point[0] - unique_point[0])**2 + (point[1] - unique_point[1])**2)
-            if dist < uniqueness_threshold:
-                unique_intersections[unique_point] += 1
-                is_unique = False
-                break
-        if is_unique:
-            unique_intersections[point] = 1
+    unique_intersections = count_unique_points(intersections, uniqueness_threshold)
 
     pprint('Unique intersections found:')
     pprint(unique_intersections)
@@ -307,18 +444,42 @@ def join_lines(lines, direction='vertical', tolerance=1.0, angle_tol=1.0, page=N
         else: # horizontal
             lines.sort(key=lambda line: ((line[0].y + line[1].y)/2, line[0].x))
 
+        # per line values, computed once per pass
+        coords = np.array([ (line[0].x, line[0].y, line[1].x, line[1].y) for line in lines ], dtype=np.float64)
+        angles = np.degrees(np.arctan2(coords[:, 3] - coords[:, 1], coords[:, 2] - coords[:, 0]))
+        if direction == 'vertical':
+            across = coords[:, [0, 2]]
+            along = coords[:, [1, 3]]
+        else:
+            across = coords[:, [1, 3]]
+            along = coords[:, [0, 2]]
+        # lines are sorted by their offset, the middle of their extent across the direction
+        offsets = (across[:, 0] + across[:, 1]) / 2
+        half_spans = np.abs(across[:, 1] - across[:, 0]) / 2
+        along_min = along.min(axis=1)
+        along_max = along.max(axis=1)
+        # buffers of lines further apart than this can't touch, a bit of slack for rounding
+        gap_tol = 2 * tolerance + 1e-9
+        max_half_span = half_spans.max()
+
         new_lines = []
-        already_merged = set()
+        already_merged = np.zeros(len(lines), dtype=bool)
         for i in range(len(lines)):
-            if i in already_merged:
+            if already_merged[i]:
                 continue
             line1 = lines[i]
+
+            # sweep window, the lines whose offsets are close enough for the extents to touch
+            end = np.searchsorted(offsets, offsets[i] + half_spans[i] + max_half_span + gap_tol, side='right')
+            window = np.arange(i + 1, end)
+            ok = ~already_merged[i + 1:end]
+            ok &= np.abs(angles[i] - angles[i + 1:end]) <= angle_tol
+            ok &= np.abs(offsets[i + 1:end] - offsets[i]) <= half_spans[i] + half_spans[i + 1:end] + gap_tol
+            ok &= along_min[i + 1:end] <= along_max[i] + gap_tol
+            ok &= along_max[i + 1:end] >= along_min[i] - gap_tol
+
             merged = False
-            for j in range(i+1, len(lines)):
-                if j == len(lines):
-                    break
-                if j in already_merged:
-                    continue
+            for j in window[ok]:
                 line2 = lines[j]
 
                 if has_thickness:
@@ -328,12 +489,6 @@ def join_lines(lines, direction='vertical', tolerance=1.0, angle_tol=1.0, page=N
                     cp1, cp2 = line1
                     np1, np2 = line2
 
-                cp_angle = np.degrees(np.arctan2(cp2.y - cp1.y, cp2.x - cp1.x))
-                np_angle = np.degrees(np.arctan2(np2.y - np1.y, np2.x - np1.x))
-
-                if abs(cp_angle - np_angle) > angle_tol:
-                    continue
-
                 intersection, reason = get_line_intersection_parallel((cp1, cp2), (np1, np2), direction, tolerance)
                 if intersection is None:
                     continue
@@ -370,8 +525,8 @@ def join_lines(lines, direction='vertical', tolerance=1.0, angle_tol=1.0, page=N
                 else:
                     new_lines.append((new_p1, new_p2))
                 merged = True
-                already_merged.add(i)
-                already_merged.add(j)
+                already_merged[i] = True
+                already_merged[j] = True
                 break
 
             if not merged:
@@ -384,30 +539,21 @@ def join_lines(lines, direction='vertical', tolerance=1.0, angle_tol=1.0, page=N
     return lines
 
 
-def get_corners_from_drawings(page, drawings, join_tol=2.0, join_angle_tol=1.0):
+def get_corners_from_drawings(page, segments, join_tol=2.0, join_angle_tol=1.0):
     """
-    Processes drawings to find and plot the four corner points of the graticule.
+    Processes drawing line segments to find and plot the four corner points of the graticule.
     """
-    horizontal_lines = []
-    vertical_lines = []
-    
     # Tolerance for categorization
     angle_tol = 1.0
-    
-    for drawing in drawings:
-        for item in drawing['items']:
-            if item[0] == 'l':  # Line
-                p1, p2 = item[1], item[2]
-                angle = np.degrees(np.arctan2(p2.y - p1.y, p2.x - p1.x))
-                angle = abs(angle)
-                if angle > 90:
-                    angle = 180 - angle
-                is_horizontal = angle < angle_tol
-                is_vertical = abs(angle - 90) < angle_tol
-                if is_horizontal:
-                    horizontal_lines.append((p1, p2))
-                elif is_vertical:
-                    vertical_lines.append((p1, p2))
+
+    x1, y1, x2, y2 = segments.T
+    angles = np.abs(np.degrees(np.arctan2(y2 - y1, x2 - x1)))
+    angles = np.where(angles > 90, 180 - angles, angles)
+    is_horizontal = angles < angle_tol
+    is_vertical = ~is_horizontal & (np.abs(angles - 90) < angle_tol)
+
+    horizontal_lines = segments_to_lines(segments[is_horizontal])
+    vertical_lines = segments_to_lines(segments[is_vertical])
 
     return get_corners_from_lines(page, vertical_lines, horizontal_lines, line_scale=2, join_tol=join_tol, join_angle_tol=join_angle_tol)
 
@@ -463,32 +609,24 @@ def check_is_rectangle(corners, tolerance_degrees=1.0):
             
     return True
 
-def has_blue_lines(doc, layer_name, color_tol):
+def has_blue_lines(doc, drawings, layer_name, color_tol):
     page = doc[0]
     page_rect = page.rect
     h, w = page_rect.height, page_rect.width
     diag_len = np.sqrt(h*h + w*w)
-    drawings = page.get_drawings("rawdict")
-    blue_lines = []
-    
-    for drawing in drawings:
-        if drawing.get('layer') != layer_name:
-            continue
-        color = drawing.get('color')
-        if color is not None and is_color_match(color, (0.0, 0.0, 1.0), tol=color_tol):
-            for item in drawing['items']:
-                if item[0] == 'l':  # Line
-                    p1, p2 = item[1], item[2]
-                    dist = np.sqrt((p1.x - p2.x)**2 + (p1.y - p2.y)**2)
-                    blue_lines.append(dist/diag_len)
-    big_blue_lines = [ d for d in blue_lines if d > 0.3 ]
+
+    # only stroked paths have a color
+    mask = drawings.layer_mask(lambda name: name == layer_name) & drawings.color_mask((0.0, 0.0, 1.0), color_tol)
+    x1, y1, x2, y2 = drawings.get_segments(mask).T
+    blue_lines = np.sqrt((x1 - x2)**2 + (y1 - y2)**2) / diag_len
+    big_blue_lines = blue_lines[blue_lines > 0.3]
     if len(big_blue_lines) > 10:
         print(f"Found {len(big_blue_lines)} big blue lines")
         return True
 
     return False
 
-def locate_other_layer_name(doc, check_for_blue_lines=False, blue_color_tol=None):
+def locate_other_layer_name(doc, drawings, check_for_blue_lines=False, blue_color_tol=None):
     layer_configs = doc.layer_ui_configs()
     other_layer_numbers = []
     other_layer_names = []
@@ -502,13 +640,11 @@ def locate_other_layer_name(doc, check_for_blue_lines=False, blue_color_tol=None
 
     for i,num in enumerate(other_layer_numbers):
         print(f"Checking Other layer: number {num}, name {other_layer_names[i]}")
-        # switch on the layer
+        # switch on the layer, the layers stay on like before for the callers that use doc later
         doc.set_layer_ui_config(num, action=0)
-        text = doc[0].get_text("text")
-        print(f"Extracted text length: {len(text)}")
-        if text.find('COPYRIGHT') >= 0:
+        if drawings.has_visible_text('COPYRIGHT', doc):
             print(f"Located 'COPYRIGHT' text in layer {other_layer_names[i]}")
-            if check_for_blue_lines and not has_blue_lines(doc, other_layer_names[i], blue_color_tol):
+            if check_for_blue_lines and not has_blue_lines(doc, drawings, other_layer_names[i], blue_color_tol):
                 print(f"Layer {other_layer_names[i]} does not has blue lines, skipping it")
                 continue
             return other_layer_names[i]
@@ -570,45 +706,204 @@ def is_long_and_axis_aligned(p1, p2, page_rect, angle_tol, min_line_scale):
     return False, None
 
 
-def locate_lines(doc, angle_tol=1, color=(0.0, 0.0, 0.0), color_tol=0.01, min_line_scale=8):
+def locate_lines(doc, drawings, angle_tol=1, color=(0.0, 0.0, 0.0), color_tol=0.01, min_line_scale=8):
     page = doc[0]
-    drawings = page.get_drawings()
     page_rect = page.rect
+    w, h = page_rect.width, page_rect.height
+
+    # same as page.get_drawings(), the paths visible with the current layer state
+    mask = drawings.visible_mask(doc) & drawings.color_mask(color, color_tol)
+    segments = drawings.get_segments(mask)
+    thicknesses = drawings.get_segment_widths(mask)
+
+    # vectorized is_long_and_axis_aligned()
+    x0, y0, x1, y1 = segments.T
+    angles = np.abs(np.degrees(np.arctan2(y1 - y0, x1 - x0)))
+    angles = np.where(angles > 90, 180 - angles, angles)
+    lengths = np.sqrt((x1 - x0)**2 + (y1 - y0)**2)
+    is_horizontal = (angles < angle_tol) & (lengths >= w / min_line_scale)
+    is_vertical = ~(angles < angle_tol) & (np.abs(angles - 90) < angle_tol) & (lengths >= h / min_line_scale)
+
     h_lines = []
     v_lines = []
-    for drawing in drawings:
-        stroke_color = drawing.get('color')
-        if stroke_color is None:
-            continue
+    for i in np.nonzero(is_horizontal | is_vertical)[0]:
+        p1 = pymupdf.Point(segments[i, 0], segments[i, 1])
+        p2 = pymupdf.Point(segments[i, 2], segments[i, 3])
+        if is_horizontal[i]:
+            h_lines.append( (p1, p2, thicknesses[i]) )
+        else:
+            v_lines.append( (p1, p2, thicknesses[i]) )
+    return v_lines, h_lines
 
-        #layer = drawing.get('layer', '')
-        #print(f"Drawing stroke color: {stroke_color}, layer: {layer}")
-        #for item in drawing['items']:
-        #    if item[0] == 'l':
-        #        p1, p2 = item[1], item[2]
-        #        p1 = (p1.x, p1.y)
-        #        p2 = (p2.x, p2.y)
-        #        dist = np.sqrt((p1[0] - p2[0])**2 + (p1[1] - p2[1])**2)
-        #        print(dist)
-
-        if not is_color_match(stroke_color, color, color_tol):
-            continue
-        for item in drawing['items']:
-            if item[0] == 'l':
+
+def segments_to_lines(segments):
+    return [ (pymupdf.Point(x1, y1), pymupdf.Point(x2, y2)) for x1, y1, x2, y2 in segments.tolist() ]
+
+
+DRAWING_TYPE_PATH = 0
+DRAWING_TYPE_CLIP = 1
+DRAWING_TYPE_GROUP = 2
+DRAWING_STORE_VERSION = 2
+
+class DrawingStore:
+    """
+    The line segments of all the vector drawings on the first page of a pdf, extracted
+    in one get_drawings() pass with every layer switched on. Kept as numpy columns:
+    per drawing its type, layer, stroke color and width, per segment its endpoints
+    and drawing. The same pass collects the text of each layer from the page's text
+    spans. Saved next to the other intermediate files so that a rerun skips the
+    extraction.
+    """
+    ARRAYS = [ 'drawing_type', 'drawing_layer', 'drawing_color', 'drawing_color_len',
+               'drawing_width', 'segment_drawing', 'segment_coords', 'layer_names',
+               'text_layer_names', 'text_layer_texts', 'source' ]
+
+    def __init__(self, arrays):
+        for k in self.ARRAYS:
+            setattr(self, k, arrays[k])
+
+    @classmethod
+    def get_source_info(cls, pdf_path):
+        st = Path(pdf_path).stat()
+        return np.array([ DRAWING_STORE_VERSION, st.st_size, st.st_mtime_ns ], dtype=np.int64)
+
+    @classmethod
+    def extract(cls, pdf_path):
+        print(f'extracting drawings from {pdf_path}')
+        doc = pymupdf.open(pdf_path)
+        # everything visible, the layer state of the callers is applied when filtering
+        for config in doc.layer_ui_configs():
+            doc.set_layer_ui_config(config['number'], action=0)
+
+        layer_ids = {}
+        drawing_type = []
+        drawing_layer = []
+        drawing_color = []
+        drawing_color_len = []
+        drawing_width = []
+        segment_drawing = []
+        segment_coords = []
+        for idx, drawing in enumerate(doc[0].get_drawings(extended=True)):
+            dtype = drawing['type']
+            if dtype == 'group':
+                drawing_type.append(DRAWING_TYPE_GROUP)
+            elif dtype.startswith('clip'):
+                drawing_type.append(DRAWING_TYPE_CLIP)
+            else:
+                drawing_type.append(DRAWING_TYPE_PATH)
+
+            layer = drawing.get('layer')
+            if layer is None:
+                drawing_layer.append(-1)
+            else:
+                drawing_layer.append(layer_ids.setdefault(layer, len(layer_ids)))
+
+            color = drawing.get('color')
+            if color is None:
+                drawing_color_len.append(-1)
+                drawing_color.append((np.nan,) * 4)
+            else:
+                color = tuple(color)[:4]
+                drawing_color_len.append(len(color))
+                drawing_color.append(color + (np.nan,) * (4 - len(color)))
+
+            width = drawing.get('width', 1.0)
+            drawing_width.append(np.nan if width is None else width)
+
+            for item in drawing.get('items', []):
+                if item[0] != 'l':
+                    continue
                 p1, p2 = item[1], item[2]
-                is_long, is_horizontal = is_long_and_axis_aligned(p1, p2, page_rect, angle_tol, min_line_scale)
-                if is_long:
-                    thickness = drawing.get('width', 1.0)
-                    if is_horizontal:
-                        h_lines.append( (p1, p2, thickness) )
-                    if not is_horizontal:
-                        v_lines.append( (p1, p2, thickness) )
-    return v_lines, h_lines
+                segment_drawing.append(idx)
+                segment_coords.append((p1.x, p1.y, p2.x, p2.y))
+
+        # text of each layer, in content order, what get_text() sees when the layer is on
+        page_rect = doc[0].rect
+        layer_texts = {}
+        for span in doc[0].get_texttrace():
+            layer = span.get('layer') or ''
+            chars = [ chr(c[0]) for c in span['chars'] if pymupdf.Rect(c[3]).intersects(page_rect) ]
+            layer_texts.setdefault(layer, []).extend(chars)
+        text_layer_names = list(layer_texts.keys())
+
+        layer_names = sorted(layer_ids, key=lambda k: layer_ids[k])
+        return cls({
+            'drawing_type': np.array(drawing_type, dtype=np.int8),
+            'drawing_layer': np.array(drawing_layer, dtype=np.int32),
+            'drawing_color': np.array(drawing_color, dtype=np.float64).reshape((-1, 4)),
+            'drawing_color_len': np.array(drawing_color_len, dtype=np.int8),
+            'drawing_width': np.array(drawing_width, dtype=np.float64),
+            'segment_drawing': np.array(segment_drawing, dtype=np.int32),
+            'segment_coords': np.array(segment_coords, dtype=np.float64).reshape((-1, 4)),
+            'layer_names': np.array(layer_names, dtype=str),
+            'text_layer_names': np.array(text_layer_names, dtype=str),
+            'text_layer_texts': np.array([ ''.join(layer_texts[k]) for k in text_layer_names ], dtype=str),
+            'source': cls.get_source_info(pdf_path),
+        })
+
+    @classmethod
+    def load(cls, pdf_path, store_file):
+        store_file = Path(store_file)
+        if store_file.exists():
+            with np.load(store_file) as data:
+                arrays = { k: data[k] for k in data.files }
+            if set(arrays.keys()) == set(cls.ARRAYS) and np.array_equal(arrays['source'], cls.get_source_info(pdf_path)):
+                print(f'using drawings from {store_file}')
+                return cls(arrays)
+
+        store = cls.extract(pdf_path)
+        store_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = store_file.with_name(store_file.name + '.tmp.npz')
+        np.savez(temp_file, **{ k: getattr(store, k) for k in cls.ARRAYS })
+        temp_file.replace(store_file)
+        return store
+
+    def has_visible_text(self, text, doc):
+        # whether text shows up in the page text with the current layer state of doc
+        on_names = set(props.get('name') for props in doc.get_ocgs().values() if props.get('on'))
+        for name, layer_text in zip(self.text_layer_names.tolist(), self.text_layer_texts.tolist()):
+            if name != '' and name not in on_names:
+                continue
+            if layer_text.find(text) >= 0:
+                print(f"Found '{text}' in layer '{name}'")
+                return True
+        return False
+
+    def layer_mask(self, pred):
+        # drawings whose layer name satisfies pred, drawings without a layer never match
+        layer_ok = np.array([ bool(pred(str(name))) for name in self.layer_names ] + [ False ], dtype=bool)
+        return layer_ok[self.drawing_layer]
+
+    def visible_mask_all_types(self, doc):
+        # drawings visible with the current layer state of doc
+        on_names = set(props.get('name') for props in doc.get_ocgs().values() if props.get('on'))
+        return self.layer_mask(lambda name: name == '' or name in on_names) | (self.drawing_layer == -1)
+
+    def visible_mask(self, doc):
+        # only the paths, like page.get_drawings() without extended
+        return self.visible_mask_all_types(doc) & (self.drawing_type == DRAWING_TYPE_PATH)
+
+    def color_mask(self, color, tol):
+        # is_color_match() for every drawing, compares as many components as both colors have
+        mask = self.drawing_color_len >= 0
+        for k, c in enumerate(color):
+            comp_ok = np.abs(self.drawing_color[:, k] - c) <= tol
+            mask &= comp_ok | (self.drawing_color_len <= k)
+        return mask
+
+    def get_segments(self, drawing_mask):
+        return self.segment_coords[drawing_mask[self.segment_drawing]]
+
+    def get_segment_widths(self, drawing_mask):
+        widths = self.drawing_width[self.segment_drawing[drawing_mask[self.segment_drawing]]]
+        return [ None if np.isnan(wd) else wd for wd in widths.tolist() ]
+
 
 class SOIProcessor(TopoMapProcessor):
 
     def __init__(self, filepath, extra, index_box):
         super().__init__(filepath, extra, index_box)
+        self.extra = extra
         self.corner_overrides = extra.get('corner_overrides', None)
         self.warp_jpeg_export_quality = 100
         self.blue_color_tol = extra.get('blue_color_tol', 0.5)
@@ -620,12 +915,37 @@ class SOIProcessor(TopoMapProcessor):
         self.lines_to_remove_widths = extra.get('lines_to_remove_widths', None)
         self.remove_lines_using_image_processing = extra.get('remove_lines_using_image_processing', False)
         self.other_layer_name = extra.get('other_layer_name', None)
+        # the rendered sheet is passed on as a raw raster instead of a jpeg
+        self.handoff = StageHandoff(self.get_workdir())
+
+    def get_full_file_path(self):
+        if self.handoff.has('full'):
+            return self.handoff.get_gdal_file('full')
+        return super().get_full_file_path()
+
+    def get_full_img(self):
+        if self.full_img is None and self.handoff.has('full'):
+            self.full_img = self.handoff.get('full')
+        return super().get_full_img()
+
+    def get_drawing_store(self, pdf_path):
+        pdf_path = Path(pdf_path)
+        return DrawingStore.load(pdf_path, self.get_workdir() / f'{pdf_path.stem}.drawings.npz')
+
+    def get_page_img(self, pdf_file_path):
+        # rendered with the layers as they are in the file
+        doc = pymupdf.open(pdf_file_path)
+        if can_render_in_process(doc[0]):
+            return render_page(doc[0])
+        pre_img_path = self.get_workdir() / 'pre_full.jpg'
+        run_mutool_draw(pdf_file_path, pre_img_path)
+        return cv2.imread(str(pre_img_path))
 
     def rotate(self):
         workdir = self.get_workdir()
         full_img_path = workdir / 'full.jpg'
-        if full_img_path.exists():
-            print(f"Full image already exists at {full_img_path}, skipping rotate()")
+        if self.handoff.has('full') or full_img_path.exists():
+            print(f"Full image already exists in {workdir}, skipping rotate()")
             return
 
         pdf_file_path = Path(self.filepath)
@@ -636,36 +956,37 @@ class SOIProcessor(TopoMapProcessor):
         if not self.auto_remove_lines:
             workdir.mkdir(parents=True, exist_ok=True)
             if self.lines_to_remove is None:
-                run_external(f'bin/mutool draw -n data/SOI_FONTS -r {DPI} -c rgb -o {str(full_img_path)} {str(pdf_file_path)}')
+                if can_render_in_process(doc[0]):
+                    self.handoff.put('full', render_page(doc[0]))
+                else:
+                    run_mutool_draw(pdf_file_path, full_img_path)
                 return
 
-            pre_img_path = workdir / 'pre_full.jpg'
-            run_external(f'bin/mutool draw -n data/SOI_FONTS -r {DPI} -c rgb -o {str(pre_img_path)} {str(pdf_file_path)}')
             black_lines = self.lines_to_remove.get('black', [])
             blue_lines = self.lines_to_remove.get('blue', [])
             blue_line_width = self.lines_to_remove_widths['blue']
             black_line_width = self.lines_to_remove_widths['black']
 
-            img = cv2.imread(str(pre_img_path))
+            img = self.get_page_img(pdf_file_path)
             w = img.shape[1]
             factor = DPI / 72.0
-            for i in range(2):
-                for color, lines, thickness in [('blue', blue_lines, blue_line_width), ('black', black_lines, black_line_width)]:
-                    for line in lines:
-                        p1, p2 = line
-                        p1, p2 = (Point(p1[0], p1[1]), Point(p2[0], p2[1]))
-                        if thickness < 2.0:
-                            thickness = 2.0
-                        line_buf_ratio = thickness / (w * 2.0)
-                        line_removal_params = LineRemovalParams(
-                            line_buf_ratio=line_buf_ratio,
-                            blur_buf_ratio=line_buf_ratio * 4,
-                            blur_kern_ratio=line_buf_ratio * 5,
-                            blur_repeat=2
-                        )
-                        self.remove_line([[p1.x,p1.y], [p2.x,p2.y]], img, line_removal_params)
-                        #LineRemovalParams = namedtuple('LineRemovalParams', ['line_buf_ratio', 'blur_buf_ratio', 'blur_kern_ratio', 'blur_repeat'])
-            cv2.imwrite(str(full_img_path), img)
+            lines_with_params = []
+            for color, lines, thickness in [('blue', blue_lines, blue_line_width), ('black', black_lines, black_line_width)]:
+                for line in lines:
+                    p1, p2 = line
+                    p1, p2 = (Point(p1[0], p1[1]), Point(p2[0], p2[1]))
+                    if thickness < 2.0:
+                        thickness = 2.0
+                    line_buf_ratio = thickness / (w * 2.0)
+                    line_removal_params = LineRemovalParams(
+                        line_buf_ratio=line_buf_ratio,
+                        blur_buf_ratio=line_buf_ratio * 4,
+                        blur_kern_ratio=line_buf_ratio * 5,
+                        blur_repeat=2
+                    )
+                    lines_with_params.append(([[p1.x,p1.y], [p2.x,p2.y]], line_removal_params))
+            remove_lines(img, lines_with_params, passes=2)
+            self.handoff.put('full', img)
             return
 
         ocgs = doc.get_ocgs()
@@ -703,7 +1024,7 @@ class SOIProcessor(TopoMapProcessor):
         if self.other_layer_name is not None:
             other_layer_name = self.other_layer_name
         else:
-            other_layer_name = locate_other_layer_name(doc, check_for_blue_lines=True, blue_color_tol=self.blue_color_tol)
+            other_layer_name = locate_other_layer_name(doc, self.get_drawing_store(pdf_file_path), check_for_blue_lines=True, blue_color_tol=self.blue_color_tol)
         if other_layer_name is not None:
             for xref, props in ocgs.items():
                 print(f"Checking layer name: {props.get('name', '')}")
@@ -714,19 +1035,18 @@ class SOIProcessor(TopoMapProcessor):
         if graticule_xref is None or other2_xref is None or self.remove_lines_using_image_processing:
             print(f"One or both specified layers not found in the PDF. {GRATICULE_LAYER_NAME_PREFIXES} xref: {graticule_xref}, {OTHER_LAYER_NAME_PREFIX} xref: {other2_xref}")
 
-            pre_img_path = workdir / 'pre_full.jpg'
             workdir.mkdir(parents=True, exist_ok=True)
-            run_external(f'bin/mutool draw -n data/SOI_FONTS -r {DPI} -c rgb -o {str(pre_img_path)} {str(pdf_file_path)}')
 
             # we will locate the graticule lines and remove them using image processing instead
-            black_v_lines, black_h_lines = locate_lines(doc, angle_tol=1, color=(0.0, 0.0, 0.0), color_tol=self.black_color_tol, min_line_scale=self.black_line_scale)
+            drawings = self.get_drawing_store(pdf_file_path)
+            black_v_lines, black_h_lines = locate_lines(doc, drawings, angle_tol=1, color=(0.0, 0.0, 0.0), color_tol=self.black_color_tol, min_line_scale=self.black_line_scale)
             black_lines = black_v_lines + black_h_lines
             to_disp = [ (li[0], li[1]) for li in black_lines ]
             display_lines([], to_disp, title="Black Lines")
             pprint(f"Removing {len(black_lines)} black lines")
 
             print(f"Using blue color tolerance of {self.blue_color_tol}")
-            blue_v_lines, blue_h_lines = locate_lines(doc, angle_tol=2, color=(0.0, 0.0, 1.0), color_tol=self.blue_color_tol, min_line_scale=self.blue_line_scale)
+            blue_v_lines, blue_h_lines = locate_lines(doc, drawings, angle_tol=2, color=(0.0, 0.0, 1.0), color_tol=self.blue_color_tol, min_line_scale=self.blue_line_scale)
             blue_lines = blue_v_lines + blue_h_lines
             to_disp = [ (li[0], li[1]) for li in blue_lines ]
             #display_lines([], to_disp, title="Black Lines")
@@ -735,28 +1055,28 @@ class SOIProcessor(TopoMapProcessor):
             if len(black_lines) < 4 or len(blue_lines) < 24:
                 raise ValueError(f"Could not find enough lines to remove graticule, black lines {len(black_lines)}, blue lines {len(blue_lines)}")
 
-            img = cv2.imread(str(pre_img_path))
+            img = self.get_page_img(pdf_file_path)
             w = img.shape[1]
             factor = DPI / 72.0
-            for i in range(2):
-                for color, lines in [('blue', blue_lines), ('black', black_lines)]:
-                    for line in lines:
-                        p1, p2, thickness = line
-                        p1 = Point(p1.x*factor, p1.y*factor)
-                        p2 = Point(p2.x*factor, p2.y*factor)
-                        thickness = thickness * factor
-                        if thickness < 2.0:
-                            thickness = 2.0
-                        line_buf_ratio = thickness / (w * 2.0)
-                        line_removal_params = LineRemovalParams(
-                            line_buf_ratio=line_buf_ratio,
-                            blur_buf_ratio=line_buf_ratio * 4,
-                            blur_kern_ratio=line_buf_ratio * 5,
-                            blur_repeat=2
-                        )
-                        self.remove_line([[p1.x,p1.y], [p2.x,p2.y]], img, line_removal_params)
-                        #LineRemovalParams = namedtuple('LineRemovalParams', ['line_buf_ratio', 'blur_buf_ratio', 'blur_kern_ratio', 'blur_repeat'])
-            cv2.imwrite(str(full_img_path), img)
+            lines_with_params = []
+            for color, lines in [('blue', blue_lines), ('black', black_lines)]:
+                for line in lines:
+                    p1, p2, thickness = line
+                    p1 = Point(p1.x*factor, p1.y*factor)
+                    p2 = Point(p2.x*factor, p2.y*factor)
+                    thickness = thickness * factor
+                    if thickness < 2.0:
+                        thickness = 2.0
+                    line_buf_ratio = thickness / (w * 2.0)
+                    line_removal_params = LineRemovalParams(
+                        line_buf_ratio=line_buf_ratio,
+                        blur_buf_ratio=line_buf_ratio * 4,
+                        blur_kern_ratio=line_buf_ratio * 5,
+                        blur_repeat=2
+                    )
+                    lines_with_params.append(([[p1.x,p1.y], [p2.x,p2.y]], line_removal_params))
+            remove_lines(img, lines_with_params, passes=2)
+            self.handoff.put('full', img)
         else:
             layers_to_turn_off = [ graticule_xref, other2_xref ]
 
@@ -767,13 +1087,20 @@ class SOIProcessor(TopoMapProcessor):
             remaining_xrefs = [oxref for oxref in all_ocg_xrefs if oxref not in layers_to_turn_off]
             print(f"Turning off layers: {', '.join([doc.get_ocgs()[xref]['name'] for xref in layers_to_turn_off])}")
             print(f"Keeping on layers: {', '.join([doc.get_ocgs()[xref]['name'] for xref in remaining_xrefs])}")
+            workdir.mkdir(parents=True, exist_ok=True)
+
+            # a fresh copy, the layer checks above have switched layers on in doc
+            render_doc = pymupdf.open(pdf_file_path)
+            if can_render_in_process(render_doc[0]) and set_layers_off(render_doc, layers_to_turn_off):
+                self.handoff.put('full', render_page(render_doc[0]))
+                return
+
             doc.set_layer(config=-1, on=remaining_xrefs, off=layers_to_turn_off)
 
-            workdir.mkdir(parents=True, exist_ok=True)
             temp_pdf_path = workdir / 'graticule_removed.pdf'
             doc.save(str(temp_pdf_path), garbage=4, deflate=True, clean=True)
 
-            run_external(f'bin/mutool draw -n data/SOI_FONTS -r {DPI} -c rgb -o {str(full_img_path)} {str(temp_pdf_path)}')
+            run_mutool_draw(temp_pdf_path, full_img_path)
         #temp_pdf_path.unlink()
 
     def get_crs_proj(self):
@@ -805,41 +1132,32 @@ class SOIProcessor(TopoMapProcessor):
 
         renamed_pdf_path = workdir / 'renamed.pdf'
         if renamed_pdf_path.exists():
-            doc = pymupdf.open(renamed_pdf_path)
+            pdf_path = renamed_pdf_path
         else:
-            doc = pymupdf.open(self.filepath)
+            pdf_path = self.filepath
+        doc = pymupdf.open(pdf_path)
+        drawings = self.get_drawing_store(pdf_path)
 
         page = doc[0]
 
-        graticule_drawings = []
-        #graticule_layer_prefix_picked = None
-        for drawing in page.get_drawings("rawdict"):
-            layer = drawing.get('layer')
-            if layer is None:
-                continue
-            is_graticule_layer = False
+        def is_graticule_layer(layer):
             for prefix in GRATICULE_LAYER_NAME_PREFIXES:
                 if layer.startswith(prefix):
-                    is_graticule_layer = True
-                    #graticule_layer_prefix_picked = prefix
-                    break
-            if not is_graticule_layer:
-                continue
-
-            #if not is_color_match(drawing.get('color', (0,0,0)), (0.0, 0.0, 0.0), BLACK_COLOR_TOL):
-            #    continue
+                    return True
+            return False
 
-            graticule_drawings.append(drawing)
-        pprint(f"Found {len(graticule_drawings)} graticule drawings")
-        #pprint(graticule_drawings)
+        # same as the drawings from page.get_drawings("rawdict"), which includes clips
+        graticule_mask = drawings.layer_mask(is_graticule_layer) & drawings.visible_mask_all_types(doc)
+        graticule_segments = drawings.get_segments(graticule_mask)
+        pprint(f"Found {np.count_nonzero(graticule_mask)} graticule drawings")
         corners = None
-        if len(graticule_drawings) > 0:
+        if np.count_nonzero(graticule_mask) > 0:
             print("Using graticule layer for corner detection")
-            corners = get_corners_from_drawings(page, graticule_drawings, join_tol=1.0, join_angle_tol=1.0)
+            corners = get_corners_from_drawings(page, graticule_segments, join_tol=1.0, join_angle_tol=1.0)
 
         if corners is None or len(corners) != 4:
             print(f"No graticule layers found in {self.filepath}, trying an alternate approach")
-            v_lines, h_lines = locate_lines(doc, angle_tol=1, color=(0.0, 0.0, 0.0), color_tol=0.5, min_line_scale=1000)
+            v_lines, h_lines = locate_lines(doc, drawings, angle_tol=1, color=(0.0, 0.0, 0.0), color_tol=0.5, min_line_scale=1000)
             pprint(f"Located {len(v_lines)} vertical and {len(h_lines)} horizontal lines")
             if len(v_lines) < 2 or len(h_lines) < 2:
                 raise ValueError(f"Could not find enough graticule lines in {self.filepath}")
@@ -864,6 +1182,44 @@ class SOIProcessor(TopoMapProcessor):
         return corners
 
  
+STAGE_NAMES = [ 'rotate', 'get_corners', 'georeference', 'warp', 'export' ]
+
+# stages tracked in the per sheet manifest, with the special case parameters
+# each one starts depending on, anything not listed counts towards 'rotate'
+MANIFEST_STAGE_PARAMS = [
+    ('rotate', [ 'auto_remove_lines', 'lines_to_remove', 'lines_to_remove_widths',
+                 'remove_lines_using_image_processing', 'other_layer_name', 'blue_color_tol',
+                 'black_color_tol', 'blue_line_scale', 'black_line_scale' ]),
+    ('get_corners', [ 'corner_overrides' ]),
+    ('georeference', []),
+    ('warp', [ 'index_box' ]),
+    ('export', []),
+]
+
+# bump when a change alters what any stage produces, every sheet is then redone
+# from its first stage, edits that don't change the outputs leave it as is
+CODE_VERSION = 2
+
+def get_stage_outputs(processor):
+    workdir = processor.get_workdir()
+    handoff = processor.handoff
+    pdf_stem = Path(processor.filepath).stem
+    return {
+        'rotate': [ workdir / 'full.jpg', workdir / 'pre_full.jpg', workdir / 'renamed.pdf',
+                    workdir / 'graticule_removed.pdf', workdir / f'{pdf_stem}.drawings.npz',
+                    workdir / 'renamed.drawings.npz', handoff.get_file('full'), handoff.get_gdal_file('full') ],
+        'get_corners': [ workdir / 'corners.json' ],
+        'georeference': [ workdir / 'georef.tif' ],
+        'warp': [ workdir / 'final.tif', workdir / 'cutline.geojson' ],
+        'export': [ processor.get_export_file(), processor.get_bounds_dir() / f'{processor.get_id()}.geojsonl' ],
+    }
+
+def get_manifest(processor):
+    params = dict(processor.extra)
+    params['index_box'] = processor.index_box
+    return StageManifest(processor.get_id(), processor.filepath, params,
+                         MANIFEST_STAGE_PARAMS, get_code_version(CODE_VERSION))
+
 def get_sheetmap():
     sheetmap_file = Path('data/index_25k.geojson')
     data = json.loads(sheetmap_file.read_text())
@@ -922,12 +1278,22 @@ def process_files():
             print(f"Skipping known bad file {filepath.name}")
             continue
 
+        stats = None
         try:
             processor = SOIProcessor(filepath, extra, sheet_map[id])
+            stats = StageStats(id, [processor.get_workdir(), processor.get_export_file()])
+            stats.instrument(processor, STAGE_NAMES)
+            # clears whatever was made with other parameters or code before the usual skip checks see it
+            manifest = get_manifest(processor)
+            manifest.invalidate(get_stage_outputs(processor))
+            manifest.instrument(processor)
             processor.process()
+            stats.save('ok')
             success_count += 1
         except Exception as ex:
             print(f'parsing {filepath} failed with exception: {ex}')
+            if stats is not None:
+                stats.save('failed', str(ex))
             failed_count += 1
             traceback.print_exc()
             raise
@@ -9,9 +9,9 @@
 # ///
 
 import logging
+import sys
 import shutil
 import json
-import time
 import zipfile
 import io
 
@@ -36,14 +36,27 @@ from soi_common.common import (
     reset_session,
 )
 
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from rate_limit import RateLimiter
+from download_ledger import DownloadLedger
+from form_state import find_fragment, find_text
+
 
-DELAY = 1
 logger = logging.getLogger(__name__)
 
 data_dir = 'data/'
 raw_data_dir = data_dir + 'raw/'
 list_data_dir = data_dir + 'list/'
 
+# takes the place of a fixed sleep before each post
+limiter = RateLimiter('scrape_available')
+session.hooks['response'].append(limiter.on_response)
+
+# keeps which states and districts are listed, keyed by their directory under list_data_dir
+ledger = DownloadLedger(raw_dir=raw_data_dir, list_dir=list_data_dir)
+
 class DelayedRetriableException(Exception):
     pass
 class KnownException(Exception):
@@ -54,10 +67,8 @@ def check_for_error(resp, err_file=None):
     resps = list(resp.history) + [resp]
     for r in resps:
         if '/Errorpage.aspx' in str(r.url):
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            main_div = soup.find('div', { 'id': 'divMain'})
-            err_div = main_div.find('div', { 'class': 'errorHeading'})
-            err_text = err_div.text
+            main_html = find_fragment(resp.text, 'div', id='divMain') or ''
+            err_text = find_text(main_html, 'div', class_='errorHeading') or ''
             err_strings = [ 'Ooops! Something went wrong.',
                             'We apologize for the inconvenience. Please try again later.']
             for e in err_strings:
@@ -102,8 +113,7 @@ def scrape():
         raise Exception('Unable to post to get village shapefile listing')
     check_for_error(resp)
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     key = 'ctl00$ContentPlaceHolder1$ListViewSingleProduct$ctrl1$Button4'
 
     form_data.update({
@@ -117,8 +127,7 @@ def scrape():
     if not resp.ok:
         raise Exception('Unable to navigate to the Product Specification page')
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     
     form_data.update({
         'ctl00$ContentPlaceHolder1$ddlFormateTyoe': 'pdf',
@@ -134,8 +143,7 @@ def scrape():
         raise Exception('Unable to post to change to pdf listing')
 
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         'ctl00$ContentPlaceHolder1$ddlFormateTyoe': 'pdf',
         'ctl00$ContentPlaceHolder1$txtSheetNumber': '',
@@ -155,8 +163,7 @@ def scrape():
     states = state_select.find_all('option')
     state_map = { x['value']: x.text.strip() for x in states if x['value'] != '0' }
     for k, v in state_map.items():
-        state_done_file = Path(list_data_dir) / v / 'done.txt'
-        if state_done_file.exists():
+        if ledger.is_listing_done(v):
             logging.info(f'State {v} already done, skipping')
             continue
 
@@ -170,7 +177,7 @@ def scrape():
             'ctl00$ContentPlaceHolder1$ddlProductsType': '',
             '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$ddlstate'
         })
-        time.sleep(DELAY)
+        limiter.wait()
         logging.info(f'Getting districts for state {v}')
         resp = session.post(sheet_picker_url, headers=headers, data=form_data)
         if not resp.ok:
@@ -186,8 +193,7 @@ def scrape():
             if dv == 'All Districts':
                 continue
             logging.info(f'District code {dk}: {dv}')
-            dist_done_file = Path(list_data_dir) / v / dv / 'done.txt'
-            if dist_done_file.exists():
+            if ledger.is_listing_done(f'{v}/{dv}'):
                 logging.info(f'District {dv}, state {v} already done, skipping')
                 continue
 
@@ -200,15 +206,14 @@ def scrape():
                 'ctl00$ContentPlaceHolder1$ddlProductsType': '',
                 '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$ddldist'
             })
-            time.sleep(DELAY)
+            limiter.wait()
             logging.info(f'Getting products for district {dv}, state {v}')
             resp = session.post(sheet_picker_url, headers=headers, data=form_data)
             if not resp.ok:
                 raise Exception(f'Unable to post to get products for district {dv}, state {v}')
 
             check_for_error(resp)
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            prod_form_data = get_form_data(soup)
+            prod_form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
             prod_form_data.update({
                 'ctl00$ContentPlaceHolder1$ddlFormateTyoe': 'pdf',
                 'ctl00$ContentPlaceHolder1$txtSheetNumber': '',
@@ -217,7 +222,7 @@ def scrape():
                 'ctl00$ContentPlaceHolder1$ddlProductsType': 'pdf',
                 '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$ddlProductsType'
             })
-            time.sleep(DELAY)
+            limiter.wait()
             logging.info(f'Getting sheet listing for district {dv}, state {v}')
             resp = session.post(sheet_picker_url, headers=headers, data=prod_form_data)
             if not resp.ok:
@@ -291,7 +296,7 @@ def scrape():
                     '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$GridView1',
                     '__EVENTARGUMENT': f'Page${next_pno}',
                 })
-                time.sleep(DELAY)
+                limiter.wait()
                 logging.info(f'Getting the sheet listing page {next_pno} for district {dv}, state {v}')
                 resp = session.post(sheet_picker_url, headers=headers, data=form_data)
                 if not resp.ok:
@@ -302,8 +307,8 @@ def scrape():
             sheet_list_file = Path(list_data_dir) / v / dv / 'sheets.txt'
             sheet_list_file.parent.mkdir(parents=True, exist_ok=True)
             sheet_list_file.write_text('\n'.join(sheet_list) + '\n')
-            dist_done_file.write_text('done')
-        state_done_file.write_text('done')
+            ledger.mark_listing_done(f'{v}/{dv}', len(sheet_list))
+        ledger.mark_listing_done(v)
 
 
 
@@ -335,5 +340,8 @@ if __name__ == '__main__':
     #sheet_list.extend([ f['properties']['id'] for f in features ])
     #sheet_list = Path('data/sheet_nos.txt').read_text().split('\n')
     #sheet_list = [ x.strip() for x in sheet_list if x.strip() != '' ]
-    scrape()
+    try:
+        scrape()
+    finally:
+        limiter.save()
 
@@ -8,12 +8,16 @@
 # soi-common = { git = "https://github.com/ramseraph/soi_common" }
 # ///
 
+import os
+import sys
+import re
 import logging
 import shutil
 import json
 import time
-import zipfile
-import io
+import queue
+import multiprocessing
+import contextlib
 
 from pathlib import Path
 from pprint import pprint
@@ -34,27 +38,52 @@ from soi_common.common import (
     reset_session,
 )
 
-
-DELAY = 1
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from rate_limit import RateLimiter, get_backoff
+from zip_download import save_pdf_from_zip_response, ZipContentsError, WrongSheetError, BrokenDownloadError
+from download_ledger import DownloadLedger, STATUS_DOWNLOADED, STATUS_UNAVAILABLE, STATUS_FAILED, STATUS_ERROR
+from form_state import find_fragment, find_text
+
+# an account that hit a retriable error is rested for COOLDOWN_BASE secs,
+# doubling with each further consecutive failure up to COOLDOWN_MAX
+COOLDOWN_BASE = 60
+COOLDOWN_MAX = 960
+# a sheet is handed to other accounts this many times before giving up on it
+MAX_SHEET_ATTEMPTS = 3
+# number of accounts to download with at once, all of them by default
+NUM_ACCOUNTS = int(os.environ.get('NUM_ACCOUNTS', '0'))
+# sheets put in the cart and ordered together, 1 orders each sheet on its own
+ORDER_BATCH_SIZE = int(os.environ.get('ORDER_BATCH_SIZE', '1'))
+ORDER_ROW_RE = re.compile(r'^(ctl00\$ContentPlaceHolder1\$gvOrders\$ctl\d+)\$')
 logger = logging.getLogger(__name__)
 
 data_dir = 'data/'
 raw_data_dir = data_dir + 'raw/'
 
+# takes the place of a fixed sleep before each post, shared by the worker processes
+limiter = RateLimiter('scrape_sheets')
+session.hooks['response'].append(limiter.on_response)
+
+# status of every sheet tried, shared by the worker processes
+ledger = DownloadLedger(raw_dir=raw_data_dir)
+
 class DelayedRetriableException(Exception):
     pass
 class KnownException(Exception):
     pass
 
+done_sheets = set()
+force_map_tried = {}
+
 def check_for_error(resp, err_file=None):
     global force_map_tried
     resps = list(resp.history) + [resp]
     for r in resps:
         if '/Errorpage.aspx' in str(r.url):
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            main_div = soup.find('div', { 'id': 'divMain'})
-            err_div = main_div.find('div', { 'class': 'errorHeading'})
-            err_text = err_div.text
+            main_html = find_fragment(resp.text, 'div', id='divMain') or ''
+            err_text = find_text(main_html, 'div', class_='errorHeading') or ''
             err_strings = [ 'Ooops! Something went wrong.',
                             'We apologize for the inconvenience. Please try again later.']
             for e in err_strings:
@@ -73,11 +102,9 @@ def check_for_error(resp, err_file=None):
                     raise KnownException(err_text)
             raise Exception('Some Error Happened')
 
-def scrape(phone_num, password, otp_from_pb, typ, sheet_list):
-    global done_sheets
-    global force_map_tried
-
+def open_sheet_picker(phone_num, password, otp_from_pb, typ):
     login_wrap(phone_num, password, otp_from_pb)
+    ledger.account = phone_num
 
     logging.info('Product Show page scraping')
     dp_page = base_url + 'Digital_Product_Show.aspx'
@@ -103,8 +130,7 @@ def scrape(phone_num, password, otp_from_pb, typ, sheet_list):
         raise Exception('Unable to post to get village shapefile listing')
     check_for_error(resp)
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     if typ == 'NHP':
         key = 'ctl00$ContentPlaceHolder1$ListViewSingleProduct$ctrl1$Button4'
     else:
@@ -121,8 +147,7 @@ def scrape(phone_num, password, otp_from_pb, typ, sheet_list):
     if not resp.ok:
         raise Exception(f'Unable to navigate to the {typ} Product Specification page')
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     
     logging.info('Change to pdf listing')
     form_data.update({
@@ -138,24 +163,242 @@ def scrape(phone_num, password, otp_from_pb, typ, sheet_list):
         raise Exception('Unable to post to change to pdf listing')
 
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    sheet_picker_form_data = get_form_data(soup)
+    sheet_picker_form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    return headers, sheet_picker_url, sheet_picker_form_data
 
-    total_count = len(sheet_list)
-    logging.info(f'Total sheets to download: {total_count}')
-    done_count = 0
-    for sheet_no in sheet_list:
+def get_sheet_files(sheet_no):
+    # the html file only holds the failed page for a look, the ledger has the status
+    out_file = Path(raw_data_dir) / f'{sheet_no}.pdf'
+    return out_file, out_file.with_suffix('.html')
 
-        logging.info(f'Downloading sheet {done_count + 1}/{total_count}: {sheet_no}')
-        out_file = Path(raw_data_dir) / f'{sheet_no}.pdf'
-        out_unavailable_file = out_file.with_suffix('.pdf.unavailable')
-        out_html_file = out_file.with_suffix('.html')
-        if out_file.exists() or out_unavailable_file.exists() or out_html_file.exists():
-            logging.info(f'Sheet {sheet_no} already done, skipping')
-            done_count += 1
-            continue
+def is_sheet_done(sheet_no):
+    return ledger.is_done(sheet_no)
+
+def save_sheet_zip(resp, sheet_no, attempt):
+    out_file, out_html_file = get_sheet_files(sheet_no)
+    # resp was requested with stream=True, the body is only read from here on
+    try:
+        try:
+            check_for_error(resp, err_file=out_html_file)
+        except KnownException as ex:
+            # the error page is kept for a look, the sheet goes to another account
+            attempt.finish(STATUS_ERROR, error=str(ex))
+            raise DelayedRetriableException(f'{ex} while downloading sheet {sheet_no}, trying again')
+        if resp.headers.get('content-type', '').lower() != 'application/x-zip-compressed':
+            out_html_file.write_text(resp.text)
+            attempt.finish(STATUS_ERROR, error='Zip file not received')
+            logger.error(f'Zip file not received for sheet {sheet_no}, check the html file')
+            raise DelayedRetriableException('Unable to get zip file, trying again')
+        try:
+            size, sha256 = save_pdf_from_zip_response(resp, out_file, sheet_no=sheet_no)
+        except WrongSheetError as ex:
+            # some other row of the orders got clicked, the sheet itself may be fine
+            out_html_file.write_text('\n'.join(ex.namelist))
+            logger.error(f'{ex}, check the html file')
+            raise DelayedRetriableException(f'{ex}, trying again')
+        except ZipContentsError as ex:
+            out_html_file.write_text('\n'.join(ex.namelist))
+            attempt.finish(STATUS_FAILED, error=str(ex))
+            raise Exception(f'{ex} for sheet {sheet_no}, check the html file')
+        except BrokenDownloadError as ex:
+            attempt.finish(STATUS_ERROR, error=str(ex))
+            raise DelayedRetriableException(f'{ex} for sheet {sheet_no}, trying again')
+    finally:
+        resp.close()
+    attempt.finish(STATUS_DOWNLOADED, size=size, sha256=sha256)
+    logging.info(f'Sheet {sheet_no} written to {out_file}')
+
+def download_sheet(sheet_no, headers, sheet_picker_url, sheet_picker_form_data):
+    with ledger.attempt(sheet_no) as attempt:
+        order_sheet(sheet_no, attempt, headers, sheet_picker_url, sheet_picker_form_data)
+
+def order_sheet(sheet_no, attempt, headers, sheet_picker_url, sheet_picker_form_data):
+
+    form_data = sheet_picker_form_data.copy()
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$ddlFormateTyoe': 'pdf',
+        'ctl00$ContentPlaceHolder1$txtSheetNumber': sheet_no.replace('_', ''),
+        'ctl00$ContentPlaceHolder1$ddlstate': '0',
+        'ctl00$ContentPlaceHolder1$ddldist': '0',
+        '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$lbtnAddToCart'
+    })
+    limiter.wait()
+    logging.info(f'Adding sheet {sheet_no} to cart')
+    resp = session.post(sheet_picker_url, headers=headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to add sheet {sheet_no} to cart')
+
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$btnViewCart': 'View Cart'
+    })
+
+    limiter.wait()
+    logging.info(f'Viewing cart for sheet {sheet_no}')
+    resp = session.post(sheet_picker_url, headers=headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to view cart for sheet {sheet_no}')
+
+    new_headers = headers.copy()
+    new_headers['referer'] = resp.url
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$btnplaceorder': 'Place Order',
+        'ctl00$ContentPlaceHolder1$HiddenField1': ''
+    })
 
-        form_data = sheet_picker_form_data.copy()
+    limiter.wait()
+    logging.info(f'Placing order for sheet {sheet_no}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to place order for sheet {sheet_no}')
+
+    try:
+        check_for_error(resp)
+    except KnownException:
+        logging.warning(f'Failed to place order for sheet {sheet_no}, marking as unavailable')
+        attempt.finish(STATUS_UNAVAILABLE, error='Unable to place order')
+        raise DelayedRetriableException('Unable to place order, trying again')
+
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$btnSubmitPrivateIndenter': 'I Agree',
+        'ctl00$ContentPlaceHolder1$HiddenField1': ''
+    })
+    new_headers['referer'] = resp.url
+    limiter.wait()
+    logging.info(f'Agree to terms and conditions for sheet {sheet_no}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to agree to T&C for sheet {sheet_no}')
+
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$gvCustomers$ctl02$btnProceedDownload': 'Proceed for Download',
+        'ctl00$ContentPlaceHolder1$HiddenField1': ''
+    })
+    new_headers['referer'] = resp.url
+    logging.info(f'Proceeding to download for sheet {sheet_no}')
+
+    limiter.wait()
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to proceed to download for sheet {sheet_no}')
+
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnRequest': 'Request',
+        'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
+    })
+    new_headers['referer'] = resp.url
+    limiter.wait()
+    logging.info(f'Requesting download for sheet {sheet_no}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to request download for sheet {sheet_no}')
+
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnGenerateDownloadLink': 'Generate Download Link',
+        'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
+    })
+    new_headers['referer'] = resp.url
+    limiter.wait()
+    logging.info(f'Generating download link for sheet {sheet_no}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to generate download link for sheet {sheet_no}')
+
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnDownloadMap': 'Download',
+        'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
+    })
+    new_headers['referer'] = resp.url
+    limiter.wait()
+    logging.info(f'Downloading sheet {sheet_no}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data, stream=True)
+    if not resp.ok:
+        raise Exception(f'Unable to post to download sheet {sheet_no}')
+    save_sheet_zip(resp, sheet_no, attempt)
+
+def get_order_rows(page_html, sheet_list):
+    """
+    Maps the sheet numbers of sheet_list, without underscores, to the control
+    prefix of their row in the gvOrders grid. Only the cell holding one of the
+    sheet numbers keys a row, the grid has other columns.
+    """
+    wanted = { x.replace('_', '') for x in sheet_list }
+    rows = {}
+    # only the grid is parsed, the view state makes up most of the page
+    table_html = find_fragment(page_html, 'table', id='ContentPlaceHolder1_gvOrders')
+    if table_html is None:
+        return rows
+    table = BeautifulSoup(table_html, 'html.parser')
+    for row in table.find_all('tr', recursive=False)[1:]:
+        prefix = None
+        for inp in row.find_all('input'):
+            m = ORDER_ROW_RE.match(inp.get('name', ''))
+            if m is not None:
+                prefix = m.group(1)
+                break
+        if prefix is None:
+            continue
+        for td in row.find_all('td'):
+            text = td.text.strip().replace('_', '')
+            if text in wanted:
+                rows[text] = prefix
+                break
+    return rows
+
+def post_order_row(sheet_no, page_html, url, headers, button, label, stream=False):
+    prefix = get_order_rows(page_html, [sheet_no]).get(sheet_no.replace('_', ''))
+    if prefix is None:
+        raise DelayedRetriableException(f'Sheet {sheet_no} not found in the orders grid')
+    form_data = get_form_data(BeautifulSoup(page_html, 'html.parser'))
+    form_data.update({
+        f'{prefix}${button}': label,
+        'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
+        'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
+    })
+    limiter.wait()
+    resp = session.post(url, headers=headers, data=form_data, stream=stream)
+    if not resp.ok:
+        raise Exception(f'Unable to post {label} for sheet {sheet_no}')
+    return resp
+
+def download_batch(sheet_list, headers, sheet_picker_url, sheet_picker_form_data):
+    """
+    Adds all of sheet_list to the cart and places a single order for them,
+    then requests, generates the link for and downloads each row of the
+    order. Sheets without a row in the order are left for the caller.
+    """
+    batch_name = f'{sheet_list[0]}..{sheet_list[-1]}'
+    form_data = sheet_picker_form_data.copy()
+    for sheet_no in sheet_list:
         form_data.update({
             'ctl00$ContentPlaceHolder1$ddlFormateTyoe': 'pdf',
             'ctl00$ContentPlaceHolder1$txtSheetNumber': sheet_no.replace('_', ''),
@@ -163,160 +406,316 @@ def scrape(phone_num, password, otp_from_pb, typ, sheet_list):
             'ctl00$ContentPlaceHolder1$ddldist': '0',
             '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$lbtnAddToCart'
         })
-        time.sleep(DELAY)
+        limiter.wait()
         logging.info(f'Adding sheet {sheet_no} to cart')
         resp = session.post(sheet_picker_url, headers=headers, data=form_data)
         if not resp.ok:
             raise Exception(f'Unable to post to add sheet {sheet_no} to cart')
 
         check_for_error(resp)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        form_data = get_form_data(soup)
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$btnViewCart': 'View Cart'
-        })
+        form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
 
-        time.sleep(DELAY)
-        logging.info(f'Viewing cart for sheet {sheet_no}')
-        resp = session.post(sheet_picker_url, headers=headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to view cart for sheet {sheet_no}')
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$btnViewCart': 'View Cart'
+    })
+    limiter.wait()
+    logging.info(f'Viewing cart for sheets {batch_name}')
+    resp = session.post(sheet_picker_url, headers=headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to view cart for sheets {batch_name}')
 
-        new_headers = headers.copy()
-        new_headers['referer'] = resp.url
-        form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$btnplaceorder': 'Place Order',
-            'ctl00$ContentPlaceHolder1$HiddenField1': ''
-        })
+    new_headers = headers.copy()
+    new_headers['referer'] = resp.url
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$btnplaceorder': 'Place Order',
+        'ctl00$ContentPlaceHolder1$HiddenField1': ''
+    })
+    limiter.wait()
+    logging.info(f'Placing order for sheets {batch_name}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to place order for sheets {batch_name}')
 
-        time.sleep(DELAY)
-        logging.info(f'Placing order for sheet {sheet_no}')
-        resp = session.post(resp.url, headers=new_headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to place order for sheet {sheet_no}')
+    # unlike with a single sheet, this doesn't tell which of the sheets is unavailable
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$btnSubmitPrivateIndenter': 'I Agree',
+        'ctl00$ContentPlaceHolder1$HiddenField1': ''
+    })
+    new_headers['referer'] = resp.url
+    limiter.wait()
+    logging.info(f'Agree to terms and conditions for sheets {batch_name}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to agree to T&C for sheets {batch_name}')
 
-        try:
-            check_for_error(resp)
-        except KnownException:
-            logging.warning(f'Failed to place order for sheet {sheet_no}, marking as unavailable')
-            out_unavailable_file.write_text('Sheet not available')
-            done_count += 1
-            raise DelayedRetriableException('Unable to place order, trying again')
-            continue
+    check_for_error(resp)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
+    form_data.update({
+        'ctl00$ContentPlaceHolder1$gvCustomers$ctl02$btnProceedDownload': 'Proceed for Download',
+        'ctl00$ContentPlaceHolder1$HiddenField1': ''
+    })
+    new_headers['referer'] = resp.url
+    limiter.wait()
+    logging.info(f'Proceeding to download for sheets {batch_name}')
+    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    if not resp.ok:
+        raise Exception(f'Unable to post to proceed to download for sheets {batch_name}')
 
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        form_data = get_form_data(soup)
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$btnSubmitPrivateIndenter': 'I Agree',
-            'ctl00$ContentPlaceHolder1$HiddenField1': ''
-        })
-        new_headers['referer'] = resp.url
-        time.sleep(DELAY)
-        logging.info(f'Agree to terms and conditions for sheet {sheet_no}')
-        resp = session.post(resp.url, headers=new_headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to agree to T&C for sheet {sheet_no}')
+    check_for_error(resp)
+    orders_url = resp.url
+    new_headers['referer'] = orders_url
+    page_html = resp.text
+    order_rows = get_order_rows(page_html, sheet_list)
+    logging.info(f'Order for sheets {batch_name} has rows for {len(order_rows)} of the {len(sheet_list)} sheets')
 
-        check_for_error(resp)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        form_data = get_form_data(soup)
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$gvCustomers$ctl02$btnProceedDownload': 'Proceed for Download',
-            'ctl00$ContentPlaceHolder1$HiddenField1': ''
-        })
-        new_headers['referer'] = resp.url
-        logging.info(f'Proceeding to download for sheet {sheet_no}')
+    # rows are looked up by sheet number each time, the grid is redrawn after every post
+    for sheet_no in sheet_list:
+        if sheet_no.replace('_', '') not in order_rows:
+            logging.warning(f'Sheet {sheet_no} missing from the order')
+            continue
 
-        time.sleep(DELAY)
-        resp = session.post(resp.url, headers=new_headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to proceed to download for sheet {sheet_no}')
+        with ledger.attempt(sheet_no) as attempt:
+            logging.info(f'Requesting download for sheet {sheet_no}')
+            resp = post_order_row(sheet_no, page_html, orders_url, new_headers, 'btnRequest', 'Request')
+            check_for_error(resp)
+            page_html = resp.text
 
-        check_for_error(resp)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        form_data = get_form_data(soup)
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnRequest': 'Request',
-            'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
-        })
-        new_headers['referer'] = resp.url
-        time.sleep(DELAY)
-        logging.info(f'Requesting download for sheet {sheet_no}')
-        resp = session.post(resp.url, headers=new_headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to request download for sheet {sheet_no}')
+            logging.info(f'Generating download link for sheet {sheet_no}')
+            resp = post_order_row(sheet_no, page_html, orders_url, new_headers, 'btnGenerateDownloadLink', 'Generate Download Link')
+            check_for_error(resp)
+            page_html = resp.text
+
+            # the download returns the zip, the page stays as it was for the next row
+            logging.info(f'Downloading sheet {sheet_no}')
+            resp = post_order_row(sheet_no, page_html, orders_url, new_headers, 'btnDownloadMap', 'Download', stream=True)
+            save_sheet_zip(resp, sheet_no, attempt)
+
+def reopen_sheet_picker(phone_num, password, otp_from_pb, typ, login_lock=None):
+    reset_account(phone_num)
+    with login_lock or contextlib.nullcontext():
+        return open_sheet_picker(phone_num, password, otp_from_pb, typ)
+
+def download_sheets(sheet_list, picker, account, login_lock=None):
+    """
+    Orders sheet_list as a batch, falling back to one sheet at a time for the
+    sheets left. Returns the picker to go on with, which is a new one after a
+    failed batch.
+    """
+    if len(sheet_list) > 1:
+        try:
+            download_batch(sheet_list, *picker)
+        except Exception as ex:
+            logger.warning(f'Batch order of {len(sheet_list)} sheets failed: {ex}, falling back to one sheet at a time')
+            # the cart can still hold the batch and the single sheet flow takes
+            # the first row of the orders, so it goes on in a new session
+            picker = reopen_sheet_picker(*account, login_lock=login_lock)
+    for sheet_no in sheet_list:
+        if is_sheet_done(sheet_no):
+            continue
+        download_sheet(sheet_no, *picker)
+    return picker
 
-        check_for_error(resp)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        form_data = get_form_data(soup)
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnGenerateDownloadLink': 'Generate Download Link',
-            'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
-        })
-        new_headers['referer'] = resp.url
-        time.sleep(DELAY)
-        logging.info(f'Generating download link for sheet {sheet_no}')
-        resp = session.post(resp.url, headers=new_headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to generate download link for sheet {sheet_no}')
+def scrape(phone_num, password, otp_from_pb, typ, sheet_list):
+    account = (phone_num, password, otp_from_pb, typ)
+    picker = open_sheet_picker(*account)
 
-        check_for_error(resp)
-        soup = BeautifulSoup(resp.text, 'html.parser')
-        form_data = get_form_data(soup)
-        form_data.update({
-            'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnDownloadMap': 'Download',
-            'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldpointID': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldMasterCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldStateCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
-            'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
-        })
-        new_headers['referer'] = resp.url
-        time.sleep(DELAY)
-        logging.info(f'Downloading sheet {sheet_no}')
-        resp = session.post(resp.url, headers=new_headers, data=form_data)
-        if not resp.ok:
-            raise Exception(f'Unable to post to download sheet {sheet_no}')
-        check_for_error(resp, err_file=out_file.with_suffix('.html'))
-        zip_file_contents = resp.content
-        # decode the zip file and locate the pdf inside it
-        if resp.headers.get('content-type', '').lower() != 'application/x-zip-compressed':
-            out_html_file.write_text(resp.text)
-            logger.error(f'Zip file not received for sheet {sheet_no}, check the html file')
+    total_count = len(sheet_list)
+    logging.info(f'Total sheets to download: {total_count}')
+    done_count = 0
+    batch = []
+    for sheet_no in sheet_list:
+        if is_sheet_done(sheet_no):
+            logging.info(f'Sheet {sheet_no} already done, skipping')
             done_count += 1
-            raise DelayedRetriableException('Unable to get zip file, trying again')
-        # use buffered io to treat the bytes as a file and use the zip file module to pull out the pdf
-        zip_buffer = io.BytesIO(zip_file_contents)
-        with zipfile.ZipFile(zip_buffer, 'r') as zf:
-            namelist = zf.namelist()
-            pdf_files = [ x for x in namelist if x.lower().endswith('.pdf') ]
-            if len(pdf_files) == 0:
-                out_file.with_suffix('.html').write_text(resp.text)
-                raise Exception(f'No pdf file found in the zip for sheet {sheet_no}, check the html file')
-            if len(pdf_files) > 1:
-                out_file.with_suffix('.html').write_text(resp.text)
-                raise Exception(f'Multiple pdf files found in the zip for sheet {sheet_no}, check the html file')
-            pdf_file_name = pdf_files[0]
-            with zf.open(pdf_file_name) as pdf_f, open(out_file, 'wb') as out_f:
-                shutil.copyfileobj(pdf_f, out_f)
-        logging.info(f'Sheet {sheet_no} written to {out_file}')
-        done_count += 1
+            continue
+        batch.append(sheet_no)
+        if len(batch) < ORDER_BATCH_SIZE:
+            continue
+        logging.info(f'Downloading sheets {done_count + 1}-{done_count + len(batch)}/{total_count}: {batch}')
+        picker = download_sheets(batch, picker, account)
+        done_count += len(batch)
+        batch = []
 
+    if len(batch) > 0:
+        logging.info(f'Downloading sheets {done_count + 1}-{done_count + len(batch)}/{total_count}: {batch}')
+        picker = download_sheets(batch, picker, account)
 
     return True
 
 
+def get_cooldown(failure_count):
+    return get_backoff(failure_count, COOLDOWN_BASE, COOLDOWN_MAX)
+
+def reset_account(phone_num):
+    saved_cookie_file = Path(f'data/cookies/saved_cookies.{phone_num}.pkl')
+    saved_cookie_file.unlink(missing_ok=True)
+    reset_session()
+
+
+
+class SheetQueue:
+    """
+    Sheets waiting to be downloaded, shared by the account workers. A sheet that
+    failed with one account is offered to the other accounts first.
+    """
+    def __init__(self, sheet_list):
+        self.pending = [ x for x in sheet_list if not is_sheet_done(x) ]
+        self.attempts = {}
+        self.failed_with = {}
+        self.given_up = []
+        self.in_flight = {}
+
+    def next_for(self, account, count=1):
+        taken = []
+        fallback = []
+        for sheet_no in self.pending:
+            if len(taken) == count:
+                break
+            if account not in self.failed_with.get(sheet_no, set()):
+                taken.append(sheet_no)
+            elif len(fallback) < count:
+                fallback.append(sheet_no)
+        if len(taken) == 0 and len(self.in_flight) == 0:
+            # nobody else is free to try them
+            taken = fallback
+        if len(taken) == 0:
+            return None
+        for sheet_no in taken:
+            self.pending.remove(sheet_no)
+        self.in_flight[account] = taken
+        return taken
+
+    def done(self, account):
+        return self.in_flight.pop(account, [])
+
+    def failed(self, account):
+        blamed = False
+        for sheet_no in self.in_flight.pop(account, []):
+            if is_sheet_done(sheet_no):
+                # the ledger has an outcome for it, nothing left to retry
+                continue
+            if blamed:
+                # the sheets of a batch are finished in order, the ones after
+                # the first unfinished one weren't tried
+                self.pending.append(sheet_no)
+                continue
+            blamed = True
+            self.attempts[sheet_no] = self.attempts.get(sheet_no, 0) + 1
+            self.failed_with.setdefault(sheet_no, set()).add(account)
+            if self.attempts[sheet_no] >= MAX_SHEET_ATTEMPTS:
+                logger.error(f'Giving up on sheet {sheet_no} after {self.attempts[sheet_no]} attempts')
+                self.given_up.append(sheet_no)
+                continue
+            self.pending.append(sheet_no)
+
+    def finished(self):
+        return len(self.pending) == 0 and len(self.in_flight) == 0
+
+
+def account_worker(phone_num, password, otp_from_pb, typ, login_lock, limiter_state, task_queue, result_queue):
+    # runs in its own process, soi_common keeps a single session per process
+    setup_logging(logging.INFO)
+    # all the accounts go to the same host, they pace themselves together
+    limiter.attach(limiter_state)
+    picker = None
+    failure_count = 0
+    while True:
+        result_queue.put(('ready', phone_num, None))
+        batch = task_queue.get()
+        if batch is None:
+            limiter.save()
+            return
+        try:
+            if picker is None:
+                # the logins are done one at a time so that the otps don't get mixed up
+                with login_lock:
+                    picker = open_sheet_picker(phone_num, password, otp_from_pb, typ)
+            picker = download_sheets(batch, picker, (phone_num, password, otp_from_pb, typ), login_lock)
+            failure_count = 0
+            result_queue.put(('done', phone_num, batch))
+        except (KnownException, DelayedRetriableException) as ke:
+            failure_count += 1
+            result_queue.put(('failed', phone_num, batch))
+            cooldown = get_cooldown(failure_count)
+            logger.warning(f'Known Exception for user {phone_num} on sheets {batch}: {ke}, resting for {cooldown:.0f} secs')
+            time.sleep(cooldown)
+            reset_account(phone_num)
+            picker = None
+        except Exception as ex:
+            logger.error(f'Some Exception happened with user {phone_num} on sheets {batch}, dropping the user')
+            logger.exception(ex)
+            result_queue.put(('failed', phone_num, batch))
+            result_queue.put(('exit', phone_num, None))
+            limiter.save()
+            return
+
+
+def download_concurrently(accounts, otp_from_pb, typ, sheet_list):
+    sheets = SheetQueue(sheet_list)
+    total_count = len(sheets.pending)
+    logging.info(f'Total sheets to download: {total_count} with {len(accounts)} users')
+
+    ctx = multiprocessing.get_context('spawn')
+    login_lock = ctx.Lock()
+    limiter_state = limiter.share(ctx)
+    result_queue = ctx.Queue()
+    workers = {}
+    for phone_num, password in accounts:
+        task_queue = ctx.Queue()
+        p = ctx.Process(target=account_worker,
+                        args=(phone_num, password, otp_from_pb, typ, login_lock, limiter_state, task_queue, result_queue),
+                        daemon=True)
+        p.start()
+        workers[phone_num] = (p, task_queue)
+
+    idle = set()
+    done_count = 0
+    while len(workers) > 0:
+        if sheets.finished():
+            break
+
+        try:
+            msg, phone_num, batch = result_queue.get(timeout=30)
+        except queue.Empty:
+            # a worker which died without saying so loses its sheet to the others
+            for phone_num, (p, _) in list(workers.items()):
+                if not p.is_alive():
+                    logger.error(f'Worker for user {phone_num} died')
+                    sheets.failed(phone_num)
+                    idle.discard(phone_num)
+                    del workers[phone_num]
+            continue
+
+        if msg == 'ready':
+            idle.add(phone_num)
+        elif msg == 'done':
+            done_count += len(sheets.done(phone_num))
+            logging.info(f'Sheets {batch} done with user {phone_num}, {done_count}/{total_count}')
+        elif msg == 'failed':
+            sheets.failed(phone_num)
+        elif msg == 'exit':
+            idle.discard(phone_num)
+            workers[phone_num][0].join()
+            del workers[phone_num]
+
+        for account in list(idle):
+            batch = sheets.next_for(account, ORDER_BATCH_SIZE)
+            if batch is None:
+                continue
+            idle.discard(account)
+            workers[account][1].put(batch)
+
+    for phone_num, (p, task_queue) in workers.items():
+        task_queue.put(None)
+    for phone_num, (p, task_queue) in workers.items():
+        p.join()
+
+    left = sheets.pending + [ x for b in sheets.in_flight.values() for x in b ] + sheets.given_up
+    if len(left) > 0:
+        logger.error(f'{len(left)} sheets could not be downloaded: {left}')
 
 tried_users_file = data_dir + 'tried_users.txt'
 def get_tried_users():
@@ -340,17 +739,32 @@ def scrape_wrap(otp_from_pb, typ, sheet_list):
     secrets_map = {k:v for k,v in secrets_map.items()}
     total_count = len(secrets_map)
     s_items = list(secrets_map.items())
+    if NUM_ACCOUNTS > 0:
+        s_items = s_items[:NUM_ACCOUNTS]
+
+    # the captcha prompts need the terminal, which the worker processes don't have
+    if len(s_items) > 1 and not CAPTCHA_MANUAL:
+        download_concurrently(s_items, otp_from_pb, typ, sheet_list)
+        return
+
+    failure_count = 0
+    remaining_count = None
     while True:
         phone_num, password = s_items[0]
         try:
             ret = scrape(phone_num, password, otp_from_pb, typ, sheet_list)
             return
         except (KnownException, DelayedRetriableException) as ke:
-            logger.warning('Known Exception for this user..')
-            time.sleep(60)
-            saved_cookie_file = Path(f'data/cookies/saved_cookies.{phone_num}.pkl')
-            saved_cookie_file.unlink(missing_ok=True)
-            reset_session()
+            # only back off further while no sheets are getting done
+            count = len([ x for x in sheet_list if not is_sheet_done(x) ])
+            if remaining_count is not None and count < remaining_count:
+                failure_count = 0
+            remaining_count = count
+            failure_count += 1
+            cooldown = get_cooldown(failure_count)
+            logger.warning(f'Known Exception for this user.. resting for {cooldown:.0f} secs')
+            time.sleep(cooldown)
+            reset_account(phone_num)
             # unlink cookie file
             #tried_users.append(phone_num)
             #update_tried_users(tried_users)
@@ -369,9 +783,6 @@ if __name__ == '__main__':
     if not CAPTCHA_MANUAL:
         check_captcha_models(captcha_model_dir)
 
-
-    done_sheets = set()
-    force_map_tried = {}
     otp_from_pb = True
     typ = 'NHP'
     #geojson = json.loads(Path('data/index.geojson').read_text())
@@ -383,5 +794,8 @@ if __name__ == '__main__':
     #sheet_list.extend([ f['properties']['id'] for f in features ])
     sheet_list = Path(sheets_fname).read_text().split('\n')
     sheet_list = [ x.strip() for x in sheet_list if x.strip() != '' ]
-    scrape_wrap(otp_from_pb, typ, sheet_list)
+    try:
+        scrape_wrap(otp_from_pb, typ, sheet_list)
+    finally:
+        limiter.save()
 
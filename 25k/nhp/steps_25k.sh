@@ -27,6 +27,8 @@ uv run scrape_sheets.py data/sheet_nos_kml.txt
 # 7. get the list of sheet nos around the periphary of the available sheets and scrape them
 # TODO: add steps used to create 25k index
 gh release download soi-ancillary -p "index_25k.geojson" -D data
+# the status of every sheet tried is kept in data/download_ledger.sqlite
+uv run ../../util/download_ledger.py summary
 # create data/index_annotated.geoj with available and unavailable marked
 uv run annotate_geojson.py
 uv run find_unprobed_neighbors.py > data/sheet_nos_periphery.txt
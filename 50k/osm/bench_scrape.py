@@ -0,0 +1,60 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "soi-common",
+# ]
+#
+# [tool.uv.sources]
+# soi-common = { git = "https://github.com/ramseraph/soi_common" }
+# ///
+
+import sys
+import json
+from pathlib import Path
+
+# the mock portal is shared by the benchmarks of all the scrapers
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from mock_portal import (
+    add_bench_args,
+    run_bench,
+    get_catalogue,
+    get_accounts,
+    point_at_portal,
+    bench_sheet_runs,
+    verify_downloads,
+)
+
+
+def write_index(catalogue, map_index_file):
+    # only the ids are read by the scraper
+    features = [ { 'type': 'Feature', 'properties': { 'id': x }, 'geometry': None } for x in catalogue.sheets ]
+    map_index_file.parent.mkdir(parents=True, exist_ok=True)
+    map_index_file.write_text(json.dumps({ 'type': 'FeatureCollection', 'features': features }))
+
+def bench_sheets(args, url):
+    import scrape_unavailable
+    point_at_portal(scrape_unavailable, url, args.time_scale)
+    accounts = get_accounts(args.accounts)
+    scrape_unavailable.get_secrets = lambda: accounts
+
+    catalogue = get_catalogue(args)
+    write_index(catalogue, Path(scrape_unavailable.data_dir) / 'index_50k.geojson')
+    ledger_file = scrape_unavailable.ledger.ledger_file
+    runs = bench_sheet_runs(args, url, ledger_file, catalogue.sheets,
+                            lambda: scrape_unavailable.scrape_wrap(False))
+    # the free maps are served as pdfs, not zips
+    check, problems = verify_downloads(catalogue, catalogue.sheets, ledger_file, scrape_unavailable.raw_data_dir, zipped=False)
+    return { 'runs': runs, 'check': check, 'problems': problems }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='run scrape_unavailable.py against the mock portal and check what it leaves in the ledger',
+        epilog='use --download-limit with several --accounts to go through the account switching, '
+               'the scraper settings come from the usual environment variables, like RATE_START/RATE_MIN/RATE_MAX')
+    add_bench_args(parser)
+    args = parser.parse_args()
+
+    run_bench(args, 'osm', lambda url: bench_sheets(args, url))
@@ -10,12 +10,17 @@
 # ]
 # ///
 
+import io
+import os
 import re
 import time
 import json
 import shutil
+import tempfile
+import traceback
 import subprocess
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import cv2
 
@@ -31,9 +36,12 @@ from pdfminer.layout import LTImage
 from pdfminer.pdftypes import resolve_all, PDFObjRef, PDFNotImplementedError
 
 from pypdf import PdfReader
-import PIL
+from PIL import Image
 
-PIL.Image.MAX_IMAGE_PIXELS = None
+from pdf_utils import extract_dct_image, lookup_pdf_meta, get_flavor_from_producer, get_producer
+from image_utils import get_image_density, set_jpeg_density, is_jpeg
+
+Image.MAX_IMAGE_PIXELS = None
 
 inter_dir = Path('data/inter')
 
@@ -86,15 +94,6 @@ def run_external(cmd, expected_error_fn=None):
             return
         raise Exception(f'command {cmd} failed with exit code: {res.returncode}')
 
-def get_dpi(file):
-    dpi_file = Path('dpi.txt')
-    if dpi_file.exists():
-        dpi_file.unlink()
-    run_external(f"identify -units PixelsPerInch -format '%x\\n' {file} > {dpi_file}")
-    dpi = int(dpi_file.read_text().strip())
-    dpi_file.unlink()
-    return dpi
-
 def get_images(layout):
     imgs = []
     if isinstance(layout, LTImage):
@@ -107,12 +106,45 @@ def get_images(layout):
 
 
 MAX_SIZE = 10 * 1024 * 1024
+MAX_QUALITY = 75
+MIN_QUALITY = 10
+TARGET_DPI = 300
+# what ImageMagick used when it re-encoded the images which weren't jpegs
+JPEG_REENCODE_QUALITY = 92
+
+def encode_jpeg(img, quality):
+    buf = io.BytesIO()
+    img.save(buf, format='JPEG', quality=quality, optimize=True,
+             dpi=(TARGET_DPI, TARGET_DPI))
+    return buf.getvalue()
+
+def encode_jpeg_within(img, max_size, min_quality, max_quality):
+    # most sheets fit at the top quality, so try that before searching
+    data = encode_jpeg(img, max_quality)
+    print(f'quality {max_quality} gave {len(data)} bytes')
+    if len(data) < max_size:
+        return max_quality, data
+
+    best = None
+    lo, hi = min_quality, max_quality - 1
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        data = encode_jpeg(img, quality)
+        print(f'quality {quality} gave {len(data)} bytes')
+        if len(data) < max_size:
+            best = quality, data
+            lo = quality + 1
+        else:
+            hi = quality - 1
+    return best
 
 class Converter:
-    def __init__(self, filename, extra={}, extra_ancillary={}):
+    def __init__(self, filename, extra={}, extra_ancillary={}, scratch_dir=None):
         self.filename = filename
         self.file_fp = None
         self.file_dir = get_file_dir(filename)
+        # pdfminer image exports go here, keeps parallel runs from stepping on each other
+        self.scratch_dir = Path(scratch_dir) if scratch_dir is not None else self.file_dir
         self.cur_step = None
         self.full_img = None
         self.flavor = None
@@ -130,13 +162,17 @@ class Converter:
 
 
     def image_pdf_extract(self):
+        out_filename = str(self.get_full_img_file())
+        if extract_dct_image(self.filename, out_filename):
+            return
+
         document = self.get_pdf_doc()
      
         if not document.is_extractable:
             raise PDFTextExtractionNotAllowed(
                     "Text extraction is not allowed"
             )
-        img_writer = ImageWriter('.')
+        img_writer = ImageWriter(str(self.scratch_dir))
         rsrcmgr = PDFResourceManager(caching=True)
         device = PDFPageAggregator(rsrcmgr, laparams=None)
         interpreter = PDFPageInterpreter(rsrcmgr, device)
@@ -206,27 +242,14 @@ class Converter:
             self.flavor = flav_file.read_text().strip()
             return self.flavor
 
+        meta = lookup_pdf_meta(self.filename)
+        if meta is not None and meta['flavor'] is not None:
+            self.flavor = meta['flavor']
+            return self.flavor
+
         document = self.get_pdf_doc()
-        doc_producer = document.info[0]['Producer'].decode('utf8')
-        if 'Image Conversion Plug-in' in doc_producer:
-            flavor = 'Image PDF'
-        elif 'Acrobat Distiller' in doc_producer:
-            flavor = 'Distiller'
-        elif 'PDFOut' in doc_producer:
-            flavor = 'PDFOut'
-        elif 'Adobe Photoshop' in doc_producer:
-            flavor = 'Photoshop'
-        elif 'www.adultpdf.com' in doc_producer:
-            flavor = 'Adultpdf'
-        elif 'GPL Ghostscript' in doc_producer:
-            flavor = 'Ghostscript'
-        elif 'GS PDF LIB' in doc_producer:
-            flavor = 'GSPDF'
-        elif 'Adobe PDF Library' in doc_producer:
-            flavor = 'Microstation'
-        elif 'ImageMill Imaging Library' in doc_producer:
-            flavor = 'ImageMill'
-        else:
+        flavor = get_flavor_from_producer(get_producer(document))
+        if flavor is None:
             print(document.info)
             raise Exception('Unknown flavor')
  
@@ -254,13 +277,21 @@ class Converter:
             self.convert_pdf_to_image()
 
     def fix_dpi(self, file):
-        dpi = get_dpi(file)
-        if dpi != 300:
-            temp_file = Path('temp.jpg')
-            if temp_file.exists():
-                temp_file.unlink()
-            run_external(f'convert -units PixelsPerInch {file} -density 300 {temp_file}')
-            shutil.move(temp_file, file)
+        dpi = get_image_density(file)
+        if dpi == TARGET_DPI:
+            return
+        print(f'setting density of {file} to {TARGET_DPI} from {dpi}')
+        if is_jpeg(file):
+            set_jpeg_density(file, TARGET_DPI)
+            return
+        # not really a jpeg, like an extracted png, the header can't be patched in place
+        temp_file = Path(file).with_name('temp.jpg')
+        img = Image.open(file)
+        if img.mode not in ['RGB', 'L', 'CMYK']:
+            img = img.convert('RGB')
+        img.save(temp_file, 'JPEG', quality=JPEG_REENCODE_QUALITY, dpi=(TARGET_DPI, TARGET_DPI))
+        img.close()
+        shutil.move(temp_file, file)
 
 
     def compress(self):
@@ -270,23 +301,27 @@ class Converter:
         if compressed_file.exists():
             print(f'file {compressed_file} exists.. skipping compression')
             return
-        shutil.copy(img_file, compressed_file)
-
-        curr_size = None
-        quality = 100
-        quality_list = [ 75, 50, 25, 10 ]
-        while len(quality_list) > 0:
-            curr_size = compressed_file.stat().st_size
 
-            if curr_size < MAX_SIZE:
-                break
-
-            quality = quality_list.pop(0)
-            run_external(f'bin/cjpeg -outfile {compressed_file} -quality {quality} -baseline {img_file}')
-            self.fix_dpi(compressed_file)
+        curr_size = img_file.stat().st_size
+        if curr_size < MAX_SIZE:
+            shutil.copy(img_file, compressed_file)
+            return
 
-        if curr_size > MAX_SIZE:
-            raise Exception(f'Couldn\'t compress {img_file} beyond {curr_size} bytes') 
+        # decode once and search for the best quality that fits, all in memory
+        img = Image.open(img_file)
+        if img.mode not in ['RGB', 'L', 'CMYK']:
+            img = img.convert('RGB')
+        img.load()
+        res = encode_jpeg_within(img, MAX_SIZE, MIN_QUALITY, MAX_QUALITY)
+        img.close()
+        if res is None:
+            raise Exception(f'Couldn\'t compress {img_file} below {MAX_SIZE} bytes at quality {MIN_QUALITY}')
+
+        quality, data = res
+        print(f'picked quality {quality}, {len(data)} bytes')
+        temp_file = compressed_file.with_suffix('.jpg.tmp')
+        temp_file.write_bytes(data)
+        shutil.move(temp_file, compressed_file)
 
     def close(self):
         if self.file_fp is not None:
@@ -294,16 +329,16 @@ class Converter:
             self.file_fp = None
 
     def run(self):
-        sheet_no = Path(filename).name.replace('.pdf', '')
+        sheet_no = Path(self.filename).name.replace('.pdf', '')
         export_file = export_dir / f'{sheet_no}.jpg'
         if export_file.exists():
             return
-        print(f'converting {sheet}')
-        converter.convert()
-        print(f'fixing dpi for {sheet}')
-        converter.fix_dpi(converter.get_full_img_file())
-        print(f'compressing {sheet}')
-        converter.compress()
+        print(f'converting {sheet_no}')
+        self.convert()
+        print(f'fixing dpi for {sheet_no}')
+        self.fix_dpi(self.get_full_img_file())
+        print(f'compressing {sheet_no}')
+        self.compress()
         compressed_file = self.get_compressed_file()
         shutil.copy(compressed_file, export_file)
 
@@ -321,14 +356,94 @@ def get_extra(special_cases, filename):
     return extra, extra_ancillary
 
 
+# rough peak memory of one sheet, a decoded 300 DPI sheet plus mutool/encoder buffers
+MEM_PER_JOB_GB = 3
+
+def get_available_mem():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+def get_job_count(requested, mem_per_job_gb):
+    jobs = min(requested, os.cpu_count() or 1)
+    avail = get_available_mem()
+    if avail is not None:
+        mem_jobs = max(1, int(avail // (mem_per_job_gb * 1024 * 1024 * 1024)))
+        if mem_jobs < jobs:
+            print(f'limiting jobs to {mem_jobs} because of available memory {avail} bytes')
+            jobs = mem_jobs
+    return jobs
+
+worker_scratch_dir = None
+
+def init_worker(run_scratch_dir):
+    global worker_scratch_dir
+    worker_scratch_dir = tempfile.mkdtemp(prefix='worker-', dir=run_scratch_dir)
+
+def compress_sheet(sheet, extra, extra_ancillary):
+    filename = f'data/raw/{sheet}.pdf'
+    converter = Converter(filename, extra, extra_ancillary, scratch_dir=worker_scratch_dir)
+    try:
+        converter.run()
+    finally:
+        converter.close()
+
+def run_serial(from_list, special_cases):
+    total = len(from_list)
+    count = 0
+    for sheet in from_list:
+        count += 1
+        filename = f'data/raw/{sheet}.pdf'
+        print(f'handling {sheet=} {count}/{total}')
+        extra, extra_ancillary = get_extra(special_cases, filename)
+        compress_sheet(sheet, extra, extra_ancillary)
+
+def run_parallel(from_list, special_cases, jobs):
+    total = len(from_list)
+    failed = {}
+    done_count = 0
+    inter_dir.mkdir(parents=True, exist_ok=True)
+    # the worker scratch dirs go under one made for this run, so that only those are removed at the end
+    run_scratch_dir = tempfile.mkdtemp(prefix='compress-', dir=str(inter_dir))
+    try:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(run_scratch_dir,)) as executor:
+            futures = {}
+            for sheet in from_list:
+                filename = f'data/raw/{sheet}.pdf'
+                extra, extra_ancillary = get_extra(special_cases, filename)
+                futures[executor.submit(compress_sheet, sheet, extra, extra_ancillary)] = sheet
+
+            for future in as_completed(futures):
+                sheet = futures[future]
+                done_count += 1
+                try:
+                    future.result()
+                    print(f'done {sheet=} {done_count}/{total}')
+                except Exception as ex:
+                    print(f'compressing {sheet} failed with exception: {ex}')
+                    traceback.print_exception(ex)
+                    failed[sheet] = str(ex)
+    finally:
+        shutil.rmtree(run_scratch_dir, ignore_errors=True)
+    print(f'Processed {total} sheets, success_count {total - len(failed)}, failed_count {len(failed)}')
+    return failed
+
+
 if __name__ == '__main__':
     import sys
-    from_list_file = Path(sys.argv[1])
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('from_list_file', help='file with the list of sheets to compress')
+    parser.add_argument('-j', '--jobs', help='number of sheets to compress in parallel', type=int, default=1)
+    parser.add_argument('-m', '--mem-per-job-gb', help='expected peak memory per sheet, used to cap the number of jobs', type=float, default=MEM_PER_JOB_GB)
+    args = parser.parse_args()
+
+    from_list_file = Path(args.from_list_file)
 
     from_list = from_list_file.read_text().split('\n')
     from_list = [ f.strip() for f in from_list if f.strip() != '' ]
     from_list = [ f.replace('.pdf', '') for f in from_list ]
-    total = len(from_list)
     
     special_cases = {}
     special_cases_file = Path(__file__).parent.joinpath('special_cases.json')
@@ -336,12 +451,14 @@ if __name__ == '__main__':
         special_cases = json.loads(special_cases_file.read_text())
 
     export_dir.mkdir(parents=True, exist_ok=True)
-    count = 0
-    for sheet in from_list:
-        count += 1
-        filename = f'data/raw/{sheet}.pdf'
-        print(f'handling {sheet=} {count}/{total}')
-        extra, extra_ancillary = get_extra(special_cases, filename)
-        converter = Converter(filename, extra, extra_ancillary)
-        converter.run()
-        converter.close()
+
+    jobs = get_job_count(args.jobs, args.mem_per_job_gb)
+    if jobs <= 1:
+        run_serial(from_list, special_cases)
+    else:
+        print(f'compressing with {jobs} jobs')
+        failed = run_parallel(from_list, special_cases, jobs)
+        if len(failed) > 0:
+            for sheet, err in failed.items():
+                print(f'FAILED {sheet}: {err}')
+            sys.exit(1)
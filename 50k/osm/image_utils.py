@@ -0,0 +1,156 @@
+import struct
+import shutil
+from pathlib import Path
+
+# density headers sit right at the start of the file, no need to read the pixel data
+HEADER_READ_SIZE = 64 * 1024
+
+JPEG_SOI = b'\xff\xd8'
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# markers after which no more metadata segments are expected
+JPEG_STOP_MARKERS = set([0xDA] + [ m for m in range(0xC0, 0xD0) if m not in [0xC4, 0xC8, 0xCC] ])
+
+EXIF_TAG_X_RESOLUTION = 0x011A
+EXIF_TAG_RESOLUTION_UNIT = 0x0128
+
+
+def to_dpi(value, unit):
+    # unit: 'in' or 'cm'
+    if value is None or value <= 0:
+        return None
+    if unit == 'cm':
+        value = value * 2.54
+    return round(value)
+
+def iter_jpeg_segments(data):
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+            continue
+        if marker in JPEG_STOP_MARKERS:
+            return
+        seg_len = struct.unpack('>H', data[pos + 2:pos + 4])[0]
+        yield marker, data[pos + 4:pos + 2 + seg_len], pos
+        pos += 2 + seg_len
+
+def parse_jfif_density(payload):
+    # 'JFIF\0', version(2), units(1), xdensity(2), ydensity(2)
+    if len(payload) < 12:
+        return None
+    units = payload[7]
+    x_density = struct.unpack('>H', payload[8:10])[0]
+    if units == 1:
+        return to_dpi(x_density, 'in')
+    if units == 2:
+        return to_dpi(x_density, 'cm')
+    # units == 0 only gives the aspect ratio
+    return None
+
+def parse_exif_density(payload):
+    tiff = payload[6:]
+    if len(tiff) < 8:
+        return None
+    endian = { b'II': '<', b'MM': '>' }.get(tiff[:2])
+    if endian is None:
+        return None
+    ifd_offset = struct.unpack(endian + 'I', tiff[4:8])[0]
+    if ifd_offset + 2 > len(tiff):
+        return None
+    count = struct.unpack(endian + 'H', tiff[ifd_offset:ifd_offset + 2])[0]
+    x_res = None
+    unit = 2
+    for i in range(count):
+        entry = tiff[ifd_offset + 2 + i * 12:ifd_offset + 14 + i * 12]
+        if len(entry) < 12:
+            break
+        tag, typ, _ = struct.unpack(endian + 'HHI', entry[:8])
+        if tag == EXIF_TAG_X_RESOLUTION and typ == 5:
+            val_offset = struct.unpack(endian + 'I', entry[8:12])[0]
+            if val_offset + 8 <= len(tiff):
+                num, den = struct.unpack(endian + 'II', tiff[val_offset:val_offset + 8])
+                if den != 0:
+                    x_res = num / den
+        elif tag == EXIF_TAG_RESOLUTION_UNIT and typ == 3:
+            unit = struct.unpack(endian + 'H', entry[8:10])[0]
+    if unit == 2:
+        return to_dpi(x_res, 'in')
+    if unit == 3:
+        return to_dpi(x_res, 'cm')
+    return None
+
+def get_jpeg_density(data):
+    jfif_dpi = None
+    exif_dpi = None
+    for marker, payload, _ in iter_jpeg_segments(data):
+        if marker == 0xE0 and payload.startswith(b'JFIF\x00'):
+            jfif_dpi = parse_jfif_density(payload)
+        elif marker == 0xE1 and payload.startswith(b'Exif\x00\x00'):
+            exif_dpi = parse_exif_density(payload)
+    return jfif_dpi if jfif_dpi is not None else exif_dpi
+
+def get_png_density(data):
+    pos = len(PNG_SIGNATURE)
+    while pos + 8 <= len(data):
+        length, typ = struct.unpack('>I4s', data[pos:pos + 8])
+        if typ == b'pHYs' and length >= 9:
+            x_ppu, _, unit = struct.unpack('>IIB', data[pos + 8:pos + 17])
+            if unit == 1:
+                return to_dpi(x_ppu / 100.0, 'cm')
+            return None
+        if typ in [b'IDAT', b'IEND']:
+            return None
+        pos += 12 + length
+    return None
+
+def get_image_density(filename):
+    """
+    Returns the horizontal resolution in dpi recorded in the JFIF/EXIF or PNG
+    headers of filename, None if the file doesn't record one.
+    """
+    with open(filename, 'rb') as f:
+        data = f.read(HEADER_READ_SIZE)
+    if data.startswith(JPEG_SOI):
+        return get_jpeg_density(data)
+    if data.startswith(PNG_SIGNATURE):
+        return get_png_density(data)
+    return None
+
+def is_jpeg(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(JPEG_SOI)) == JPEG_SOI
+
+def set_jpeg_density(filename, dpi):
+    """
+    Rewrites the JFIF density of a jpeg file without touching the
+    compressed image data.
+    """
+    filename = Path(filename)
+    with open(filename, 'rb') as f:
+        data = f.read(HEADER_READ_SIZE)
+    if not data.startswith(JPEG_SOI):
+        raise Exception(f'{filename} is not a jpeg file')
+
+    density = struct.pack('>BHH', 1, dpi, dpi)
+    for marker, payload, pos in iter_jpeg_segments(data):
+        if marker == 0xE0 and payload.startswith(b'JFIF\x00') and len(payload) >= 12:
+            # units and densities start 7 bytes into the payload, overwrite them in place
+            with open(filename, 'r+b') as f:
+                f.seek(pos + 4 + 7)
+                f.write(density)
+            return
+
+    # no JFIF header, add one right after SOI
+    app0 = b'JFIF\x00' + b'\x01\x01' + density + b'\x00\x00'
+    segment = b'\xff\xe0' + struct.pack('>H', len(app0) + 2) + app0
+    temp_file = filename.with_suffix(filename.suffix + '.tmp')
+    with open(filename, 'rb') as inp, open(temp_file, 'wb') as out:
+        out.write(inp.read(2))
+        out.write(segment)
+        shutil.copyfileobj(inp, out)
+    shutil.move(temp_file, filename)
@@ -0,0 +1,121 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "pdfminer-six",
+# ]
+# ///
+
+import os
+import json
+import traceback
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pdf_utils import (
+    PDF_INDEX_FILE,
+    open_pdf_index,
+    read_pdf_meta,
+    save_pdf_meta,
+    row_to_meta,
+    is_meta_current,
+)
+
+COMMIT_EVERY = 100
+
+
+def build_index(data_dir, index_file, jobs, keep_missing=False):
+    files = sorted(Path(data_dir).glob('**/*.pdf'))
+    print(f'Found {len(files)} pdf files in {data_dir}')
+
+    conn = open_pdf_index(index_file)
+    existing = { row['name']: row_to_meta(row) for row in conn.execute('SELECT * FROM pdfs') }
+
+    to_read = [ f for f in files if f.name not in existing or not is_meta_current(existing[f.name], f) ]
+    print(f'{len(to_read)} files are new or changed')
+
+    # unchanged files with a new mtime are only hashed once
+    to_read_names = set(f.name for f in to_read)
+    moved = [ (f.stat().st_mtime, f.name) for f in files
+              if f.name in existing and f.name not in to_read_names and existing[f.name]['mtime'] != f.stat().st_mtime ]
+    conn.executemany('UPDATE pdfs SET mtime = ? WHERE name = ?', moved)
+
+    failed = {}
+    done_count = 0
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = { executor.submit(read_pdf_meta, f): f for f in to_read }
+        for future in as_completed(futures):
+            filepath = futures[future]
+            done_count += 1
+            try:
+                meta = future.result()
+            except Exception as ex:
+                print(f'reading {filepath} failed with exception: {ex}')
+                traceback.print_exception(ex)
+                failed[filepath.name] = str(ex)
+                continue
+            save_pdf_meta(conn, meta)
+            if done_count % COMMIT_EVERY == 0:
+                conn.commit()
+                print(f'indexed {done_count}/{len(to_read)}')
+
+    present = set(f.name for f in files)
+    removed = [] if keep_missing else [ name for name in existing if name not in present ]
+    conn.executemany('DELETE FROM pdfs WHERE name = ?', [ (name,) for name in removed ])
+    conn.commit()
+    conn.close()
+
+    print(f'Indexed {done_count - len(failed)} files, removed {len(removed)} stale entries, failed_count {len(failed)}')
+    for name, err in failed.items():
+        print(f'FAILED {name}: {err}')
+    return failed
+
+
+def query_index(index_file, flavor=None, image_filter=None, dpi=None, as_json=False):
+    conn = open_pdf_index(index_file)
+    conds = []
+    params = []
+    if flavor is not None:
+        conds.append('flavor = ?')
+        params.append(flavor)
+    if image_filter is not None:
+        conds.append('image_filter = ?')
+        params.append(image_filter)
+    if dpi is not None:
+        conds.append('image_dpi = ?')
+        params.append(dpi)
+    where = f'WHERE {" AND ".join(conds)}' if len(conds) > 0 else ''
+    rows = conn.execute(f'SELECT * FROM pdfs {where} ORDER BY name', params).fetchall()
+    conn.close()
+
+    for row in rows:
+        if as_json:
+            print(json.dumps(row_to_meta(row)))
+        else:
+            print(row['name'])
+
+
+if __name__ == '__main__':
+    import sys
+    import argparse
+    parser = argparse.ArgumentParser(description='build and query the metadata index of the downloaded pdfs')
+    parser.add_argument('-i', '--index-file', help='sqlite index file', default=str(PDF_INDEX_FILE))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help='(re)index new and changed pdfs')
+    build_parser.add_argument('-d', '--data-dir', help='directory with the pdfs', default='data/raw')
+    build_parser.add_argument('-j', '--jobs', help='number of files to read in parallel', type=int, default=os.cpu_count())
+    build_parser.add_argument('-k', '--keep-missing', help='keep the entries of pdfs not in the data dir, for runs that only have some of them', action='store_true')
+
+    query_parser = subparsers.add_parser('query', help='list indexed pdfs, optionally filtered')
+    query_parser.add_argument('--flavor', help='only pdfs of this flavor, eg: "Image PDF"')
+    query_parser.add_argument('--image-filter', help='only pdfs whose page image uses this filter, eg: DCTDecode')
+    query_parser.add_argument('--dpi', help='only pdfs whose page image has this resolution', type=int)
+    query_parser.add_argument('--json', help='print full records as json lines', action='store_true')
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        failed = build_index(args.data_dir, args.index_file, args.jobs, args.keep_missing)
+        if len(failed) > 0:
+            sys.exit(1)
+    else:
+        query_index(args.index_file, args.flavor, args.image_filter, args.dpi, args.json)
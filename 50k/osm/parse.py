@@ -10,10 +10,15 @@
 
 
 import os
+import sys
 import json
+import time
 import shutil
-import subprocess
+import resource
+import traceback
+import multiprocessing
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
 
 from pdfminer.image import ImageWriter
 from pdfminer.pdfparser import PDFParser
@@ -34,6 +39,30 @@ import numpy as np
 
 from topo_map_processor.processor import TopoMapProcessor, LineRemovalParams
 
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from pdf_utils import extract_dct_image, lookup_pdf_meta, get_flavor_from_producer, get_producer, get_pdf_image_dpi
+from image_utils import get_image_density
+from stage_stats import StageStats
+from raster_utils import load_raster, rotate_raster_bound
+from line_removal import remove_lines
+from stage_handoff import StageHandoff
+from stage_manifest import StageManifest, get_code_version, MANIFEST_DIR
+
+# resolutions the extracted page images come in
+SUPPORTED_DPIS = [72, 300]
+# the page geometry is off by a little when the mediabox is, within this ratio it still counts
+GEOMETRY_DPI_TOLERANCE = 0.02
+
+def snap_dpi(dpi):
+    if dpi is None:
+        return None
+    for supported in SUPPORTED_DPIS:
+        if abs(dpi - supported) <= supported * GEOMETRY_DPI_TOLERANCE:
+            return supported
+    return None
+
 def get_images(layout):
     imgs = []
     if isinstance(layout, LTImage):
@@ -48,6 +77,7 @@ class SOIProcessor(TopoMapProcessor):
 
     def __init__(self, filepath, extra, index_map):
         super().__init__(filepath, extra, index_map)
+        self.extra = extra
         self.flavor = None
         self.warp_jpeg_export_quality = extra.get('warp_jpeg_export_quality', 100)
         self.jpeg_export_quality = extra.get('jpeg_export_quality', 50)
@@ -85,6 +115,13 @@ class SOIProcessor(TopoMapProcessor):
         self.line_color = extra.get('line_color', None)
         self.line_color_choices = extra.get('line_color_choices', ['black', ['black', 'greyish'], ['not_white']])
 
+        # corner search on a shrunk mask first, refined in a small full resolution window
+        # '1' to use it, 'check' to also run the full search and compare
+        self.pyramid_corners = extra.get('pyramid_corners', os.getenv('PYRAMID_CORNERS', '0'))
+        self.pyramid_factor = extra.get('pyramid_factor', 8)
+        self.pyramid_refine_radius = extra.get('pyramid_refine_radius', 4 * self.pyramid_factor)
+        self.pyramid_tolerance = extra.get('pyramid_tolerance', 2)
+
         self.color_map.update({
             'pink': ((140, 74, 76), (166, 255, 255)),
             'pinkish': ((130, 40, 76), (170, 255, 255)),
@@ -97,7 +134,68 @@ class SOIProcessor(TopoMapProcessor):
 
         self.index_box = extra.get('index_override', self.index_box)
 
+        # per sheet cache of hsv conversions and single color masks, shared by the
+        # map area search, the corner searches and their retries with other colors
+        self.hsv_cache = {}
+        self.color_mask_cache = {}
+
+        # the rotated image is passed on as a raw raster, without a jpeg decode
+        self.handoff = StageHandoff(self.get_workdir())
+
+
+    def get_roi_key(self, img):
+        # crops are views, so the start address with the shape and strides identifies the region
+        return (img.__array_interface__['data'][0], img.shape, img.strides)
+
+    def get_hsv(self, img):
+        key = self.get_roi_key(img)
+        if key not in self.hsv_cache:
+            # the img is held on to so that its memory can't be reused by another region
+            self.hsv_cache[key] = (img, cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
+        return self.hsv_cache[key][1]
+
+    def get_single_color_mask(self, img, color):
+        key = (self.get_roi_key(img), color)
+        if key not in self.color_mask_cache:
+            if color.startswith('not_'):
+                img_mask = self.get_single_color_mask(img, color[4:]) ^ 255
+            else:
+                upper, lower = self.get_color_ranges(color)
+                img_mask = cv2.inRange(self.get_hsv(img), lower, upper)
+            self.color_mask_cache[key] = img_mask
+        return self.color_mask_cache[key]
+
+    def get_color_mask(self, img, color):
+        if not isinstance(color, list):
+            colors = [color]
+        else:
+            colors = color
+
+        # callers modify the returned mask, so hand out copies
+        img_masks = [ self.get_single_color_mask(img, c) for c in colors ]
+        if len(img_masks) == 1:
+            return img_masks[0].copy()
+
+        final_mask = img_masks[0]
+        for img_mask in img_masks[1:]:
+            final_mask = np.logical_or(final_mask, img_mask)*255
+        return final_mask.astype(np.uint8)
 
+    def clear_color_mask_cache(self):
+        self.hsv_cache = {}
+        self.color_mask_cache = {}
+
+    def get_maparea(self):
+        try:
+            return super().get_maparea()
+        finally:
+            self.clear_color_mask_cache()
+
+    def get_corners(self):
+        try:
+            return super().get_corners()
+        finally:
+            self.clear_color_mask_cache()
 
     def get_resolution(self):
         return "auto"
@@ -105,12 +203,14 @@ class SOIProcessor(TopoMapProcessor):
     def get_crs_proj(self):
         return "EPSG:4326"
 
-    def get_intersection_point(self, img, direction, anchor_angle):
-
+    def get_line_color_choices(self):
         if self.line_color is not None:
-            line_color_choices = [self.line_color]
-        else:
-            line_color_choices = self.line_color_choices
+            return [self.line_color]
+        return self.line_color_choices
+
+    def get_intersection_point_full(self, img, direction, anchor_angle):
+
+        line_color_choices = self.get_line_color_choices()
 
         ip = None
         for line_color in line_color_choices:
@@ -134,6 +234,71 @@ class SOIProcessor(TopoMapProcessor):
         return ip
 
 
+    def refine_intersection_point(self, img_mask, estimate):
+        h, w = img_mask.shape[:2]
+        r = self.pyramid_refine_radius
+        x0, y0 = max(estimate[0] - r, 0), max(estimate[1] - r, 0)
+        x1, y1 = min(estimate[0] + r, w), min(estimate[1] + r, h)
+        win_mask = img_mask[y0:y1, x0:x1]
+        ips = self.get_line_intersections(win_mask, self.find_line_scale, self.find_line_iter, print_lines=False)
+        if len(ips) == 0:
+            return None
+        ips = [ (x0 + p[0], y0 + p[1]) for p in ips ]
+        return min(ips, key=lambda p: self.get_distance(p, estimate))
+
+    def get_intersection_point_coarse_to_fine(self, img, direction, anchor_angle):
+        f = self.pyramid_factor
+        h, w = img.shape[:2]
+        for line_color in self.get_line_color_choices():
+            img_mask = self.get_color_mask(img, line_color)
+            if self.remove_corner_text:
+                self.remove_text(img_mask)
+
+            # any set pixel in a block keeps the block set, so thin lines survive the shrinking
+            coarse_mask = cv2.resize(img_mask, (w // f, h // f), interpolation=cv2.INTER_AREA)
+            coarse_img = np.full(coarse_mask.shape + (3,), 255, dtype=np.uint8)
+            coarse_img[coarse_mask > 0] = 0
+            try:
+                cip = self.get_nearest_intersection_point(coarse_img, direction, anchor_angle,
+                                                          'black', False, 0,
+                                                          self.find_line_scale, self.find_line_iter,
+                                                          self.max_corner_dist_ratio, self.min_corner_dist_ratio,
+                                                          1, self.max_corner_angle_diff,
+                                                          self.max_corner_angle_diff_cutoff)
+            except Exception as ex:
+                print(f'Failed to find coarse intersection for {line_color}: {ex}')
+                continue
+
+            estimate = (cip[0] * f + f // 2, cip[1] * f + f // 2)
+            ip = self.refine_intersection_point(img_mask, estimate)
+            if ip is None:
+                print(f'Failed to refine coarse intersection {estimate} for {line_color}')
+                continue
+            print(f'coarse intersection {cip} refined to {ip}')
+            return ip
+
+        return None
+
+    def get_intersection_point(self, img, direction, anchor_angle):
+        if self.pyramid_corners not in ['1', 'check', True]:
+            return self.get_intersection_point_full(img, direction, anchor_angle)
+
+        ip = self.get_intersection_point_coarse_to_fine(img, direction, anchor_angle)
+        if ip is None:
+            print('coarse to fine corner search failed, falling back to full resolution search')
+            return self.get_intersection_point_full(img, direction, anchor_angle)
+
+        if self.pyramid_corners != 'check':
+            return ip
+
+        full_ip = self.get_intersection_point_full(img, direction, anchor_angle)
+        diff = self.get_distance(ip, full_ip)
+        print(f'coarse to fine: {ip}, full: {full_ip}, diff: {diff}')
+        if diff > self.pyramid_tolerance:
+            raise Exception(f'coarse to fine corner {ip} is off from {full_ip} by {diff} pixels')
+        return full_ip
+
+
     def locate_grid_lines(self):
         full_img = self.get_full_img()
         h,w = full_img.shape[:2]
@@ -143,6 +308,7 @@ class SOIProcessor(TopoMapProcessor):
         transformer = self.get_transformer_from_gcps(gcps)
 
         lines, lines_xy = self.locate_grid_lines_using_trasformer(transformer, 24, 1, bounds_check_buffer)
+        self.clear_color_mask_cache()
         #print(f'found {len(lines)} grid lines')
         #from pprint import pprint
         #pprint(lines)
@@ -154,11 +320,71 @@ class SOIProcessor(TopoMapProcessor):
         )
         return [ (line, params) for line in lines ]
 
+    def get_full_file_path(self):
+        if self.handoff.has('full.rotated'):
+            return self.handoff.get_gdal_file('full.rotated')
+        return super().get_full_file_path()
+
+    def get_full_img(self):
+        # memory mapped, so that only the parts of the sheet being worked on are in memory
+        if self.full_img is not None:
+            return self.full_img
+
+        full_file = self.get_full_file_path()
+        print(f'mapping full image {full_file}')
+        name = self.handoff.find(full_file)
+        if name is not None:
+            self.full_img = self.handoff.get(name)
+        else:
+            self.full_img = load_raster(full_file)
+        return self.full_img
+
+    def rotate_image_bound(self, img, angle, fill_color=(255, 255, 255)):
+        # the later stages read the rotated sheet from the handoff, the jpeg
+        # TopoMapProcessor.rotate() writes from it is only for resuming and looking at
+        self.handoff.remove('full.rotated')
+        rotate_raster_bound(img, angle, self.handoff.get_file('full.rotated'), fill_color)
+        self.handoff.commit('full.rotated')
+        return self.handoff.get('full.rotated')
+
+    def remove_line(self, line, map_img, removal_params):
+        remove_lines(map_img, [ (line, removal_params) ])
+
     def get_full_img_file(self):
         workdir = self.get_workdir()
         return workdir / 'full.jpg'
 
+    def use_extracted_image(self, fname):
+        out_filename = str(self.get_full_img_file())
+        print(f'writing {out_filename}')
+        res_x = get_image_density(fname)
+        if res_x is None:
+            geometry_dpi = get_pdf_image_dpi(self.filepath)
+            res_x = snap_dpi(geometry_dpi)
+            print(f'No resolution in image headers, the pdf page geometry gives {geometry_dpi} dpi')
+
+        if res_x is None:
+            print("Could not determine resolution, assuming 300dpi and moving on")
+            shutil.move(fname, out_filename)
+            return
+
+        print(f'Image resolution: {res_x} dpi')
+
+        if res_x == 72:
+            Path(fname).unlink()
+            self.convert_pdf_to_image()
+        elif res_x == 300:
+            shutil.move(fname, out_filename)
+        else:
+            Path(fname).unlink()
+            raise Exception(f"Unsupported image resolution {res_x} dpi, only 72 and 300 are supported.")
+
     def image_pdf_extract(self):
+        extracted_file = self.get_workdir() / 'extracted.jpg'
+        if extract_dct_image(self.filepath, extracted_file):
+            self.use_extracted_image(str(extracted_file))
+            return
+
         document = self.get_pdf_doc()
      
         if not document.is_extractable:
@@ -195,32 +421,12 @@ class SOIProcessor(TopoMapProcessor):
             try:
                 fname = img_writer.export_image(image)
                 print(f'image extracted to {fname}')
-                out_filename = str(self.get_full_img_file())
-                print(f'writing {out_filename}')
                 if fname.endswith('.bmp') or fname.endswith('.img'):
                     # give up
                     Path(fname).unlink()
                     self.convert_pdf_to_image()
                 else:
-                    try:
-                        res_x_str = subprocess.check_output(
-                            f'identify -format "%x" {fname}', shell=True, text=True
-                        ).strip()
-                        res_x = int(float(res_x_str))
-                    except (subprocess.CalledProcessError, FileNotFoundError, ValueError):
-                        print("Could not determine resolution, assuming 300dpi and moving on")
-                        shutil.move(fname, out_filename)
-                    else:
-                        print(f'Image resolution: {res_x} dpi')
-
-                        if res_x == 72:
-                            Path(fname).unlink()
-                            self.convert_pdf_to_image()
-                        elif res_x == 300:
-                            shutil.move(fname, out_filename)
-                        else:
-                            Path(fname).unlink()
-                            raise Exception(f"Unsupported image resolution {res_x} dpi, only 72 and 300 are supported.")
+                    self.use_extracted_image(fname)
             except PDFNotImplementedError:
                 self.convert_pdf_to_image()
             pno += 1
@@ -234,14 +440,9 @@ class SOIProcessor(TopoMapProcessor):
         print(f'ROTATE: {rotate}')
         img_filename = str(self.get_full_img_file())
         print('converting pdf to image using mupdf')
-        self.run_external(f'bin/mutool draw -n data/SOI_FONTS -r 300 -c rgb -o {img_filename} {self.filepath}')
-        if rotate == 90 or rotate == 270:
-            print('rotating image')
-            img = cv2.imread(img_filename)
-            img_rotate = cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE if rotate == 90 else cv2.ROTATE_90_COUNTERCLOCKWISE)
-            rotate_filename = img_filename.replace('.jpg', '.rotated.jpg')
-            cv2.imwrite(rotate_filename, img_rotate)
-            shutil.move(rotate_filename, img_filename)
+        # mutool turns the page clockwise while rendering, so the sheet is never decoded here
+        rotate_option = f'-R {rotate} ' if rotate == 90 or rotate == 270 else ''
+        self.run_external(f'bin/mutool draw -n data/SOI_FONTS -r 300 {rotate_option}-c rgb -o {img_filename} {self.filepath}')
 
 
 
@@ -274,27 +475,14 @@ class SOIProcessor(TopoMapProcessor):
             self.flavor = flav_file.read_text().strip()
             return self.flavor
 
+        meta = lookup_pdf_meta(self.filepath)
+        if meta is not None and meta['flavor'] is not None:
+            self.flavor = meta['flavor']
+            return self.flavor
+
         document = self.get_pdf_doc()
-        doc_producer = document.info[0]['Producer'].decode('utf8')
-        if 'Image Conversion Plug-in' in doc_producer:
-            flavor = 'Image PDF'
-        elif 'Acrobat Distiller' in doc_producer:
-            flavor = 'Distiller'
-        elif 'PDFOut' in doc_producer:
-            flavor = 'PDFOut'
-        elif 'Adobe Photoshop' in doc_producer:
-            flavor = 'Photoshop'
-        elif 'www.adultpdf.com' in doc_producer:
-            flavor = 'Adultpdf'
-        elif 'GPL Ghostscript' in doc_producer:
-            flavor = 'Ghostscript'
-        elif 'GS PDF LIB' in doc_producer:
-            flavor = 'GSPDF'
-        elif 'Adobe PDF Library' in doc_producer:
-            flavor = 'Microstation'
-        elif 'ImageMill Imaging Library' in doc_producer:
-            flavor = 'ImageMill'
-        else:
+        flavor = get_flavor_from_producer(get_producer(document))
+        if flavor is None:
             print(document.info)
             raise Exception('Unknown flavor')
  
@@ -378,6 +566,218 @@ def handle_55J_16(processor):
     processor.process()
 
 
+STAGE_NAMES = [
+    'convert', 'rotate', 'get_maparea', 'get_corners', 'georeference',
+    'locate_grid_lines', 'remove_grid_lines', 'warp', 'export',
+]
+
+# stages tracked in the per sheet manifest, with the special case parameters
+# each one starts depending on, anything not listed counts towards 'convert'
+MANIFEST_STAGE_PARAMS = [
+    ('convert', [ 'pdf_rotate' ]),
+    ('rotate', [ 'auto_rotate_thresh', 'use_bbox_area', 'map_area_ratio_thresh', 'band_color',
+                 'band_color_choices', 'collar_erode' ]),
+    ('get_corners', [ 'corner_overrides', 'cwidth', 'ext_thresh_ratio', 'find_line_iter', 'find_line_scale',
+                      'max_corner_angle_diff', 'max_corner_angle_diff_cutoff', 'min_corner_dist_ratio',
+                      'max_corner_dist_ratio', 'remove_corner_text', 'line_color', 'line_color_choices',
+                      'poly_approx_factor', 'pyramid_corners', 'pyramid_factor', 'pyramid_refine_radius',
+                      'pyramid_tolerance' ]),
+    ('georeference', [ 'should_remove_grid_lines', 'grid_lines', 'grid_bounds_check_buffer_ratio',
+                       'remove_line_buf_ratio', 'remove_blur_buf_ratio', 'remove_blur_kern_ratio',
+                       'remove_line_blur_repeat' ]),
+    ('warp', [ 'warp_jpeg_export_quality', 'index_override', 'index_box' ]),
+    ('export', [ 'jpeg_export_quality' ]),
+]
+
+# keep the raw arrays of a failed sheet in its workdir, they run to gigabytes
+INSPECT = os.environ.get('INSPECT', '0') == '1'
+
+# bump when a change alters what any stage produces, every sheet is then redone
+# from its first stage, edits that don't change the outputs leave it as is
+CODE_VERSION = 2
+
+def get_stage_outputs(processor):
+    workdir = processor.get_workdir()
+    handoff = processor.handoff
+    export_file = processor.get_export_file()
+    return {
+        'convert': [ workdir / 'full.jpg', workdir / 'full.raw.npy', workdir / 'flav.txt' ],
+        'rotate': [ workdir / 'rotated_info.txt', workdir / 'small.jpg', workdir / 'maparea_info.pkl',
+                    workdir / 'full.rotated.jpg', handoff.get_file('full.rotated'), handoff.get_gdal_file('full.rotated') ],
+        'get_corners': [ workdir / 'corners.json' ],
+        'georeference': [ workdir / 'georef.tif', workdir / 'nogrid.jpg' ],
+        'warp': [ workdir / 'final.tif', workdir / 'cutline.geojson' ],
+        'export': [ export_file, processor.get_bounds_dir() / f'{processor.get_id()}.geojsonl' ],
+    }
+
+def remove_raw_arrays(processor, manifest):
+    # the stages that handed off a raster are redone by the next run, and the
+    # decoded copies of the jpegs are just decoded again
+    workdir = processor.get_workdir()
+    stage_outputs = get_stage_outputs(processor)
+    for stage in manifest.stage_names:
+        if any(f.name.endswith(('.stage.npy', '.stage.vrt')) and f.exists() for f in stage_outputs.get(stage, [])):
+            manifest.clear(stage_outputs, stage)
+            break
+    processor.handoff.clear()
+    for f in list(workdir.glob('*.raw.npy')) + list(workdir.glob('*.raw.npy.tmp')):
+        print(f'deleting {f}')
+        f.unlink()
+
+def get_manifest(processor):
+    params = dict(processor.extra)
+    params['index_box'] = processor.index_box
+    # can come from the environment instead of the special cases
+    params['pyramid_corners'] = processor.pyramid_corners
+    return StageManifest(processor.get_id(), processor.filepath, params,
+                         MANIFEST_STAGE_PARAMS, get_code_version(CODE_VERSION))
+
+def run_processor(processor):
+    id = processor.get_id()
+    stats = StageStats(id, [processor.get_workdir(), processor.get_export_file()])
+    stats.instrument(processor, STAGE_NAMES)
+    manifest = get_manifest(processor)
+    try:
+        # clears whatever was made with other parameters or code before the usual skip checks see it
+        manifest.invalidate(get_stage_outputs(processor))
+        manifest.instrument(processor)
+
+        if id == '65A_11':
+            handle_65A_11(processor)
+        elif id == '55J_16':
+            handle_55J_16(processor)
+        else:
+            processor.process()
+    except Exception as ex:
+        stats.save('failed', str(ex))
+        if not INSPECT:
+            remove_raw_arrays(processor, manifest)
+        raise
+    stats.save('ok')
+
+
+def get_available_mem():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError):
+        return None
+
+def init_worker(max_worker_mem):
+    # caps the heap of the worker and the mutool/gdal processes it spawns,
+    # a runaway sheet then fails with a MemoryError instead of taking the runner down
+    if max_worker_mem is not None:
+        resource.setrlimit(resource.RLIMIT_DATA, (max_worker_mem, max_worker_mem))
+
+def process_sheet_in_worker(filepath, extra, index_box):
+    start = time.time()
+    run_processor(SOIProcessor(filepath, extra, index_box))
+    # each worker handles a single sheet, so these are the peaks for this sheet
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return { 'time': time.time() - start, 'max_rss_kb': max(self_rss, child_rss) }
+
+class ProgressTracker:
+    def __init__(self, total):
+        self.total = total
+        self.start = time.time()
+        self.success_count = 0
+        self.failed_count = 0
+        self.skipped_count = 0
+
+    def processed_count(self):
+        return self.success_count + self.failed_count + self.skipped_count
+
+    def report(self):
+        elapsed = time.time() - self.start
+        worked = self.success_count + self.failed_count
+        rate = worked * 60.0 / elapsed if elapsed > 0 else 0
+        remaining = self.total - self.processed_count()
+        eta = f'{remaining / rate:.1f} mins' if rate > 0 else 'unknown'
+        print(f'==========  Processed: {self.processed_count()}/{self.total} Success: {self.success_count} '
+              f'Failed: {self.failed_count} Rate: {rate:.2f} sheets/min ETA: {eta} ==========')
+
+
+def process_files_parallel(work, jobs, max_worker_mem, failures_file):
+    tracker = ProgressTracker(len(work))
+    failures = {}
+
+    # one sheet per worker process so that memory is handed back after every sheet
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=ctx, max_tasks_per_child=1,
+                             initializer=init_worker, initargs=(max_worker_mem,)) as executor:
+        pending = list(work)
+        in_flight = {}
+        while len(pending) > 0 or len(in_flight) > 0:
+            # only start another sheet when there is room for it
+            while len(pending) > 0 and len(in_flight) < jobs:
+                avail = get_available_mem()
+                if len(in_flight) > 0 and max_worker_mem is not None and avail is not None and avail < max_worker_mem:
+                    print(f'waiting for memory, available: {avail} bytes, needed: {max_worker_mem} bytes')
+                    break
+                filepath, extra, index_box = pending.pop(0)
+                print(f'submitting {filepath.name}')
+                future = executor.submit(process_sheet_in_worker, filepath, extra, index_box)
+                in_flight[future] = filepath
+
+            done, _ = wait(in_flight.keys(), timeout=30, return_when=FIRST_COMPLETED)
+            for future in done:
+                filepath = in_flight.pop(future)
+                try:
+                    stats = future.result()
+                    tracker.success_count += 1
+                    print(f'parsed {filepath.name} in {stats["time"]:.1f} secs, max rss {stats["max_rss_kb"] / 1024:.0f} MB')
+                except Exception as ex:
+                    tracker.failed_count += 1
+                    print(f'parsing {filepath} failed with exception: {ex}')
+                    traceback.print_exception(ex)
+                    failures[filepath.name] = {
+                        'error': str(ex),
+                        'traceback': ''.join(traceback.format_exception(ex)),
+                    }
+                tracker.report()
+
+    failures_file.parent.mkdir(parents=True, exist_ok=True)
+    failures_file.write_text(json.dumps(failures, indent=2))
+    print(f'Processed {tracker.processed_count()} images, failed_count {tracker.failed_count}, success_count {tracker.success_count}')
+    if len(failures) > 0:
+        print(f'failures written to {failures_file}')
+    return failures
+
+
+def get_special_cases():
+    special_cases_file = Path(__file__).parent / 'special_cases.json'
+    if not special_cases_file.exists():
+        return {}
+    return json.loads(special_cases_file.read_text())
+
+def get_bad_files():
+    bad_files = set()
+    with open('bad_files.txt', 'r') as f:
+        for line in f:
+            bad_files.add(line.strip())
+    return bad_files
+
+def list_stale_sheets(out_file):
+    """
+    Writes the sheets whose recorded stages were made with other code or
+    parameters to out_file. They already have a tif, so the usual work list
+    leaves them out.
+    """
+    special_cases = get_special_cases()
+    bad_files = get_bad_files()
+    index_map = get_index_map()
+    stale = []
+    for manifest_file in sorted(MANIFEST_DIR.glob('*.json')):
+        id = manifest_file.stem
+        fname = f'{id}.pdf'
+        if fname in bad_files:
+            continue
+        processor = SOIProcessor(Path('data/raw') / fname, special_cases.get(fname, {}), index_map.get(id, None))
+        if not get_manifest(processor).is_current():
+            stale.append(fname)
+    Path(out_file).write_text(''.join(f'{x}\n' for x in stale))
+    print(f'{len(stale)} sheets to parse again, listed in {out_file}')
+
 def process_files():
     
     data_dir = Path('data/raw')
@@ -393,62 +793,68 @@ def process_files():
     print(f"Found {len(image_files)} jpg files")
     
     
-    special_cases_file = Path(__file__).parent / 'special_cases.json'
-
-    special_cases = {}
-    if special_cases_file.exists():
-        special_cases = json.loads(special_cases_file.read_text())
+    special_cases = get_special_cases()
 
     #new_set = set()
     #with open('new_set.txt', 'r') as f:
     #    for line in f:
     #        new_set.add(line.strip())
 
-    bad_files = set()
-    with open('bad_files.txt', 'r') as f:
-        for line in f:
-            bad_files.add(line.strip())
+    bad_files = get_bad_files()
 
     index_map = get_index_map()
 
-    total = len(image_files)
-    processed_count = 0
-    failed_count = 0
-    success_count = 0
+    jobs = int(os.environ.get('JOBS', '1'))
+    max_worker_mem_gb = os.environ.get('MAX_WORKER_MEM_GB', None)
+    max_worker_mem = int(float(max_worker_mem_gb) * 1024 * 1024 * 1024) if max_worker_mem_gb is not None else None
+    failures_file = Path(os.environ.get('FAILURES_FILE', 'data/parse_failures.json'))
+
+    if jobs > 1:
+        work = []
+        for filepath in image_files:
+            if filepath.name in bad_files:
+                continue
+            extra = special_cases.get(filepath.name, {})
+            id = filepath.name.replace('.pdf', '')
+            work.append((filepath, extra, index_map.get(id, None)))
+        failures = process_files_parallel(work, jobs, max_worker_mem, failures_file)
+        return len(failures) == 0
+
+    tracker = ProgressTracker(len(image_files))
     # Process each file
     for filepath in image_files:
-        print(f'==========  Processed: {processed_count}/{total} Success: {success_count} Failed: {failed_count} processing {filepath.name} ==========')
+        tracker.report()
+        print(f'processing {filepath.name}')
         if filepath.name in bad_files:
+            tracker.skipped_count += 1
             continue
         extra = special_cases.get(filepath.name, {})
         id = filepath.name.replace('.pdf', '')
 
         index_box = index_map.get(id, None)
 
-
         processor = SOIProcessor(filepath, extra, index_box)
 
         try:
-            if id == '65A_11':
-                handle_65A_11(processor)
-            elif id == '55J_16':
-                handle_55J_16(processor)
-            else:
-                processor.process()
-            success_count += 1
+            run_processor(processor)
+            tracker.success_count += 1
         except Exception as ex:
             print(f'parsing {filepath} failed with exception: {ex}')
-            failed_count += 1
-            import traceback
+            tracker.failed_count += 1
             traceback.print_exc()
-            raise
             processor.prompt()
-        processed_count += 1
+            raise
 
-    print(f"Processed {processed_count} images, failed_count {failed_count}, success_count {success_count}")
+    print(f"Processed {tracker.processed_count()} images, failed_count {tracker.failed_count}, success_count {tracker.success_count}")
+    return True
 
 
 if __name__ == "__main__":
+    import sys
 
-    process_files()
- 
+    if len(sys.argv) > 1 and sys.argv[1] == 'stale':
+        list_stale_sheets(sys.argv[2])
+        sys.exit(0)
+
+    if not process_files():
+        sys.exit(1)
@@ -0,0 +1,302 @@
+import json
+import shutil
+import sqlite3
+import hashlib
+import functools
+from pathlib import Path
+
+from pdfminer.psparser import LIT, PSLiteral
+from pdfminer.pdfparser import PDFParser
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdftypes import resolve1, PDFStream
+
+LITERAL_IMAGE = LIT('Image')
+LITERAL_DCT_DECODE = LIT('DCTDecode')
+LITERAL_DEVICE_CMYK = LIT('DeviceCMYK')
+
+PDF_INDEX_FILE = Path('data/pdf_index.sqlite')
+
+FLAVOR_PRODUCERS = [
+    ('Image Conversion Plug-in', 'Image PDF'),
+    ('Acrobat Distiller', 'Distiller'),
+    ('PDFOut', 'PDFOut'),
+    ('Adobe Photoshop', 'Photoshop'),
+    ('www.adultpdf.com', 'Adultpdf'),
+    ('GPL Ghostscript', 'Ghostscript'),
+    ('GS PDF LIB', 'GSPDF'),
+    ('Adobe PDF Library', 'Microstation'),
+    ('ImageMill Imaging Library', 'ImageMill'),
+]
+
+
+def get_page_images(page):
+    resources = resolve1(page.resources) or {}
+    xobjects = resolve1(resources.get('XObject', {})) or {}
+    imgs = []
+    others = []
+    for name, obj in xobjects.items():
+        obj = resolve1(obj)
+        if not isinstance(obj, PDFStream):
+            continue
+        if obj.get('Subtype') is LITERAL_IMAGE:
+            imgs.append(obj)
+        else:
+            others.append(obj)
+    return imgs, others
+
+def is_passthrough_jpeg(stream):
+    filters = stream.get_filters()
+    if len(filters) != 1 or filters[0][0] is not LITERAL_DCT_DECODE:
+        return False
+
+    # a Decode array or a CMYK colorspace means the pixels need fixing up
+    if stream.get('Decode') is not None:
+        return False
+
+    colorspace = resolve1(stream.get('ColorSpace'))
+    if not isinstance(colorspace, list):
+        colorspace = [ colorspace ]
+    colorspace = [ resolve1(c) for c in colorspace ]
+    if LITERAL_DEVICE_CMYK in colorspace:
+        return False
+
+    return True
+
+def extract_dct_image(filename, out_filename):
+    """
+    Copies the JPEG stream of the only image on the only page of an image
+    PDF straight to out_filename, without decoding it.
+
+    Returns False when the PDF doesn't fit that shape, callers are expected
+    to fall back to the slower extraction paths.
+    """
+    with open(filename, 'rb') as f:
+        parser = PDFParser(f)
+        document = PDFDocument(parser)
+
+        pages = list(PDFPage.create_pages(document))
+        if len(pages) != 1:
+            return False
+
+        imgs, others = get_page_images(pages[0])
+        if len(imgs) != 1 or len(others) != 0:
+            return False
+
+        stream = imgs[0]
+        if not is_passthrough_jpeg(stream):
+            print(f'image stream with filters {stream.get_filters()} needs decoding, not passing through')
+            return False
+
+        data = stream.get_data()
+
+    out_file = Path(out_filename)
+    out_file.parent.mkdir(parents=True, exist_ok=True)
+    temp_file = out_file.with_suffix(out_file.suffix + '.tmp')
+    temp_file.write_bytes(data)
+    shutil.move(temp_file, out_file)
+    print(f'copied jpeg stream of {len(data)} bytes to {out_file}')
+    return True
+
+
+def get_flavor_from_producer(producer):
+    for pattern, flavor in FLAVOR_PRODUCERS:
+        if pattern in producer:
+            return flavor
+    return None
+
+def get_producer(document):
+    if len(document.info) == 0:
+        return ''
+    producer = resolve1(document.info[0].get('Producer', b''))
+    if isinstance(producer, bytes):
+        producer = producer.decode('utf8')
+    return producer
+
+def get_file_hash(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def literal_name(obj):
+    obj = resolve1(obj)
+    if isinstance(obj, PSLiteral):
+        return obj.name
+    if isinstance(obj, list):
+        return ','.join(literal_name(o) for o in obj)
+    return None
+
+def get_ocg_names(document):
+    oc_props = resolve1(document.catalog.get('OCProperties'))
+    if oc_props is None:
+        return []
+    names = []
+    for ocg in resolve1(oc_props.get('OCGs', [])):
+        name = resolve1(resolve1(ocg).get('Name', b''))
+        if isinstance(name, bytes):
+            name = name.decode('utf8', errors='surrogateescape')
+        names.append(name)
+    return names
+
+def read_pdf_meta(filepath):
+    """
+    Collects the metadata needed to plan work on a sheet. Only the trailer,
+    the xref, the info and catalog dictionaries and the page/image object
+    headers are read, no content streams are parsed.
+    """
+    filepath = Path(filepath)
+    stat = filepath.stat()
+    meta = {
+        'name': filepath.name,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'sha256': get_file_hash(filepath),
+    }
+    with open(filepath, 'rb') as f:
+        parser = PDFParser(f)
+        document = PDFDocument(parser)
+        meta['producer'] = get_producer(document)
+        meta['flavor'] = get_flavor_from_producer(meta['producer'])
+        meta['ocg_names'] = get_ocg_names(document)
+
+        pages = list(PDFPage.create_pages(document))
+        meta['num_pages'] = len(pages)
+        page = pages[0]
+        meta['rotate'] = page.rotate
+        x0, y0, x1, y1 = page.mediabox
+        meta['media_width'] = abs(x1 - x0)
+        meta['media_height'] = abs(y1 - y0)
+
+        meta.update(get_page_image_info(page))
+    return meta
+
+def get_page_image_info(page):
+    imgs, _ = get_page_images(page)
+    info = {
+        'image_count': len(imgs),
+        'image_width': None,
+        'image_height': None,
+        'image_filter': None,
+        'image_dpi': None,
+    }
+    if len(imgs) == 0:
+        return info
+
+    img = max(imgs, key=lambda i: resolve1(i.get('Width', 0)) * resolve1(i.get('Height', 0)))
+    info['image_width'] = resolve1(img.get('Width'))
+    info['image_height'] = resolve1(img.get('Height'))
+    info['image_filter'] = literal_name(img.get('Filter'))
+    x0, y0, x1, y1 = page.mediabox
+    info['image_dpi'] = get_image_dpi(info['image_width'], info['image_height'], abs(x1 - x0), abs(y1 - y0))
+    return info
+
+def get_pdf_image_dpi(filepath):
+    """
+    Resolution of the page image worked out from its /Width against the page
+    MediaBox, uses the index when it is current.
+    """
+    meta = lookup_pdf_meta(filepath)
+    if meta is not None:
+        return meta['image_dpi']
+
+    with open(filepath, 'rb') as f:
+        parser = PDFParser(f)
+        document = PDFDocument(parser)
+        for page in PDFPage.create_pages(document):
+            return get_page_image_info(page)['image_dpi']
+    return None
+
+def get_image_dpi(img_width, img_height, media_width, media_height):
+    # assumes the image covers the whole page, which is how the image pdfs are laid out,
+    # an image placed on its side shows up as a flipped aspect ratio
+    if not img_width or not img_height or not media_width or not media_height:
+        return None
+    if (img_width > img_height) != (media_width > media_height):
+        media_width, media_height = media_height, media_width
+    return round(img_width * 72.0 / media_width)
+
+
+INDEX_COLUMNS = [
+    'name', 'size', 'mtime', 'sha256', 'producer', 'flavor', 'num_pages', 'rotate',
+    'media_width', 'media_height', 'image_count', 'image_width', 'image_height',
+    'image_filter', 'image_dpi', 'ocg_names',
+]
+
+def open_pdf_index(index_file=PDF_INDEX_FILE):
+    index_file = Path(index_file)
+    index_file.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(index_file), timeout=60)
+    conn.row_factory = sqlite3.Row
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS pdfs (
+            name TEXT PRIMARY KEY,
+            size INTEGER,
+            mtime REAL,
+            sha256 TEXT,
+            producer TEXT,
+            flavor TEXT,
+            num_pages INTEGER,
+            rotate INTEGER,
+            media_width REAL,
+            media_height REAL,
+            image_count INTEGER,
+            image_width INTEGER,
+            image_height INTEGER,
+            image_filter TEXT,
+            image_dpi INTEGER,
+            ocg_names TEXT
+        )
+    """)
+    conn.execute('CREATE INDEX IF NOT EXISTS pdfs_flavor ON pdfs (flavor)')
+    return conn
+
+def save_pdf_meta(conn, meta):
+    row = dict(meta)
+    row['ocg_names'] = json.dumps(row['ocg_names'])
+    cols = ', '.join(INDEX_COLUMNS)
+    vals = ', '.join(['?'] * len(INDEX_COLUMNS))
+    conn.execute(f'INSERT OR REPLACE INTO pdfs ({cols}) VALUES ({vals})', [ row[c] for c in INDEX_COLUMNS ])
+
+def row_to_meta(row):
+    meta = dict(row)
+    meta['ocg_names'] = json.loads(meta['ocg_names'])
+    return meta
+
+@functools.lru_cache(maxsize=256)
+def get_cached_file_hash(filepath, size, mtime):
+    # size and mtime are in the key so that a file changed in between is hashed again
+    return get_file_hash(filepath)
+
+def is_meta_current(meta, filepath):
+    # a release download or a new checkout gives the file a new mtime, only the hash
+    # tells whether it changed, and hashing costs much less than reading the pdf again
+    stat = Path(filepath).stat()
+    if meta['size'] != stat.st_size:
+        return False
+    if meta['mtime'] == stat.st_mtime:
+        return True
+    return meta['sha256'] == get_cached_file_hash(str(filepath), stat.st_size, stat.st_mtime)
+
+def lookup_pdf_meta(filepath, index_file=PDF_INDEX_FILE):
+    """
+    Returns the indexed metadata for filepath, or None if the file isn't in
+    the index or has changed since it was indexed.
+    """
+    if not Path(index_file).exists():
+        return None
+    conn = open_pdf_index(index_file)
+    try:
+        row = conn.execute('SELECT * FROM pdfs WHERE name = ?', (Path(filepath).name,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    meta = row_to_meta(row)
+    if not is_meta_current(meta, filepath):
+        return None
+    return meta
@@ -0,0 +1,117 @@
+import os
+import mmap
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# rows handled at a time when streaming through a sheet
+STRIP_HEIGHT = 512
+
+
+def get_raster_file(img_file):
+    # full.jpg -> full.raw.npy, full.rotated.jpg -> full.rotated.raw.npy
+    img_file = Path(img_file)
+    return img_file.with_suffix('.raw.npy')
+
+def create_raster(raster_file, shape):
+    """
+    Creates raster_file as an .npy of the given shape and returns its pixels
+    along with the shared mapping they live in, for release_pages().
+    """
+    header = { 'descr': '|u1', 'fortran_order': False, 'shape': tuple(shape) }
+    with open(raster_file, 'w+b') as f:
+        np.lib.format.write_array_header_1_0(f, header)
+        offset = f.tell()
+        f.truncate(offset + int(np.prod(shape)))
+        mapping = mmap.mmap(f.fileno(), 0)
+    return np.ndarray(shape, dtype=np.uint8, buffer=mapping, offset=offset), mapping
+
+def release_pages(mapping):
+    # written pages of a shared mapping are flushed and dropped from the process,
+    # they live on in the page cache and stop counting towards the rss
+    mapping.flush()
+    mapping.madvise(mmap.MADV_DONTNEED)
+
+def decode_to_raster(img_file, raster_file):
+    print(f'decoding {img_file} to {raster_file}')
+    # decoded with opencv, same as cv2.imread, so that the pixels don't change.
+    # this holds the whole decoded sheet for a moment, the readers that decode
+    # in strips don't upsample the chroma the way opencv does
+    img = cv2.imread(str(img_file))
+    if img is None:
+        raise Exception(f'unable to read image {img_file}')
+
+    temp_file = raster_file.with_name(raster_file.name + '.tmp')
+    out, mapping = create_raster(temp_file, img.shape)
+    h = img.shape[0]
+    for y in range(0, h, STRIP_HEIGHT):
+        out[y:y+STRIP_HEIGHT] = img[y:y+STRIP_HEIGHT]
+        release_pages(mapping)
+    del img
+    del out
+    mapping.close()
+    os.replace(temp_file, raster_file)
+
+def load_raster(img_file):
+    """
+    Returns the pixels of img_file as a copy-on-write memory map of an
+    uncompressed copy kept next to it. The copy is only decoded when it is
+    missing or older than img_file.
+    """
+    img_file = Path(img_file)
+    raster_file = get_raster_file(img_file)
+    if not raster_file.exists() or raster_file.stat().st_mtime < img_file.stat().st_mtime:
+        decode_to_raster(img_file, raster_file)
+    return np.load(str(raster_file), mmap_mode='c')
+
+def rotate_raster_bound(img, angle, raster_file, fill_color=(255, 255, 255)):
+    """
+    TopoMapProcessor.rotate_image_bound, written into a memory mapped
+    raster_file one strip of rows at a time. Each strip only needs the part of
+    the source which maps into it. The shifted origins round a few pixels
+    differently, by at most one level.
+    """
+    (h, w) = img.shape[:2]
+    (cX, cY) = (w / 2, h / 2)
+
+    M = cv2.getRotationMatrix2D((cX, cY), -angle, 1.0)
+    cos = np.abs(M[0, 0])
+    sin = np.abs(M[0, 1])
+
+    nW = int((h * sin) + (w * cos))
+    nH = int((h * cos) + (w * sin))
+
+    M[0, 2] += (nW / 2) - cX
+    M[1, 2] += (nH / 2) - cY
+
+    M_inv = cv2.invertAffineTransform(M)
+    out, mapping = create_raster(raster_file, (nH, nW) + img.shape[2:])
+    for y0 in range(0, nH, STRIP_HEIGHT):
+        y1 = min(y0 + STRIP_HEIGHT, nH)
+        strip_corners = np.array([[0, y0, 1], [nW, y0, 1], [0, y1, 1], [nW, y1, 1]], dtype=np.float64).T
+        src_corners = M_inv @ strip_corners
+        # a couple of pixels of margin for the interpolation
+        sx0 = max(int(np.floor(src_corners[0].min())) - 2, 0)
+        sx1 = min(int(np.ceil(src_corners[0].max())) + 3, w)
+        sy0 = max(int(np.floor(src_corners[1].min())) - 2, 0)
+        sy1 = min(int(np.ceil(src_corners[1].max())) + 3, h)
+        if sx0 >= sx1 or sy0 >= sy1:
+            out[y0:y1] = fill_color
+            release_pages(mapping)
+            continue
+
+        # move the origin to the top left of the source window and the output strip
+        M_strip = M.copy()
+        M_strip[:, 2] += M[:, :2] @ np.array([sx0, sy0], dtype=np.float64)
+        M_strip[1, 2] -= y0
+
+        src = np.ascontiguousarray(img[sy0:sy1, sx0:sx1])
+        out[y0:y1] = cv2.warpAffine(src, M_strip, (nW, y1 - y0),
+                                    borderMode=cv2.BORDER_CONSTANT,
+                                    borderValue=fill_color)
+        del src
+        release_pages(mapping)
+
+    del out
+    mapping.close()
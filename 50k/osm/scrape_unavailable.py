@@ -9,11 +9,14 @@
 # ///
 
 import json
+import sys
+import hashlib
 import logging
-import shutil
 
+from datetime import datetime, time as dt_time
 from pprint import pformat, pprint
 from pathlib import Path
+from urllib.parse import urlparse
 
 from bs4 import BeautifulSoup
 
@@ -33,25 +36,24 @@ from soi_common.common import (
     raw_data_dir
 )
 
-logger = logging.getLogger(__name__)
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
 
+from rate_limit import RateLimiter
+from download_ledger import DownloadLedger, STATUS_DOWNLOADED, STATUS_UNAVAILABLE
+from form_state import find_text
 
+logger = logging.getLogger(__name__)
 
-tried_users_file = data_dir + 'tried_users.txt'
-def get_tried_users():
-    if not Path(tried_users_file).exists():
-        return []
-    with open(tried_users_file, 'r') as f:
-        tried_users = f.read().split('\n')
-    return [ x.strip() for x in tried_users ]
+# paces the requests to the portal, slowing down when it starts to struggle
+limiter = RateLimiter('scrape_unavailable')
+session.hooks['response'].append(limiter.on_response)
+
+# sheets are keyed by their file name without the .pdf, which joins the combined sheets
+ledger = DownloadLedger(raw_dir=raw_data_dir, list_dir=data_dir + 'list')
+ACCOUNT_LIMIT_CROSSED = 'limit_crossed'
 
 
-def update_tried_users(tried_users):
-    tried_users_file_new = tried_users_file + '.new'
-    with open(tried_users_file_new, 'w') as f:
-        f.write('\n'.join(tried_users))
-    shutil.move(tried_users_file_new, tried_users_file)
-    
 
 def get_tile_infos(map_index_file):
     with open(map_index_file, 'r') as f:
@@ -106,14 +108,17 @@ def download_tile(sheet_no):
     file_name = get_file_name(sheet_no)
     
     out_file = Path(file_name)
-    out_file_unavailable = Path(str(out_file) + '.unavailable')
-    file_to_write = out_file
-    if out_file.exists() or out_file_unavailable.exists():
+    if out_file.exists() or ledger.is_done(out_file.stem):
         logger.info(f'{out_file} exists.. skipping')
         return
 
-    
+    with ledger.attempt(out_file.stem) as attempt:
+        return fetch_tile(sheet_no, out_file, attempt)
+
+def fetch_tile(sheet_no, out_file, attempt):
+    unavailable = False
     url = base_url + 'FreeMapSpecification.aspx'
+    limiter.wait()
     resp = session.get(url)
     if not resp.ok:
         raise Exception('unable to get FreeMapSpec page')
@@ -127,10 +132,11 @@ def download_tile(sheet_no):
         'Referer': base_url + 'FreeMapSpecification.aspx',
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/141.0.0.0 Safari/537.36',
         'Origin': base_url[:-1],
-        'Host': base_url[8:-1],
+        'Host': urlparse(base_url).netloc,
     }
 
     url = base_url + 'FreeMapSpecification.aspx'
+    limiter.wait()
     resp = session.post(url, data=form_data, headers=headers)
     logger.debug(f'status_code = {resp.status_code} headers:\n{pformat(dict(resp.headers))}')
     if not resp.ok:
@@ -140,6 +146,7 @@ def download_tile(sheet_no):
     form_data = get_form_data(soup)
     form_data.update(get_download_tile_form_data(soup, sheet_no, first_pass=False))
     logger.debug(f'spec page form data second pass:\n{pformat(form_data)}')
+    limiter.wait()
     resp = session.post(url, data=form_data, headers=headers)
     logger.debug(f'status_code = {resp.status_code} headers:\n{pformat(dict(resp.headers))}')
     if not resp.ok:
@@ -148,29 +155,29 @@ def download_tile(sheet_no):
     if resp.headers['Content-Type'] != 'text/html; charset=utf-8':
         content = resp.content
     else:
-        soup = BeautifulSoup(resp.text, 'html.parser')
+        page_html = resp.text
 
-        captcha_failed = soup.find('span', { 'id': 'ContentPlaceHolder1_lblWrongCaptcha'})
+        captcha_failed = find_text(page_html, 'span', id='ContentPlaceHolder1_lblWrongCaptcha')
         CAPTCHA_FAILED_MSG = 'Please enter valid captcha code'
-        if captcha_failed is not None and captcha_failed.text == CAPTCHA_FAILED_MSG:
+        if captcha_failed == CAPTCHA_FAILED_MSG:
             raise Exception('Captcha Failed')
 
-        limit_crossed = soup.find('span', { 'id': 'ContentPlaceHolder1_msgbox_lblMsg'})
+        limit_crossed = find_text(page_html, 'span', id='ContentPlaceHolder1_msgbox_lblMsg')
         LIMIT_CROSSED_MSG = 'You have crossed your download limit for today'
-        if limit_crossed is not None and limit_crossed.text == LIMIT_CROSSED_MSG:
+        if limit_crossed == LIMIT_CROSSED_MSG:
             raise Exception('Limit Crossed')
 
-        error_heading = soup.find('div', {'class': 'errorHeading'})
+        error_heading = find_text(page_html, 'div', class_='errorHeading')
         if error_heading is not None:
-            raise Exception(f'Unexpected Error: {error_heading.text}')
+            limiter.failed()
+            raise Exception(f'Unexpected Error: {error_heading}')
 
-        not_found = soup.find('span', {'id':'ContentPlaceHolder1_lblSheetNotExist'})
+        not_found = find_text(page_html, 'span', id='ContentPlaceHolder1_lblSheetNotExist')
         #NOT_FOUND_MSG = 'Sheet Number is not exist... Please enter valid Sheet Number.'
         NOT_FOUND_MSG = 'Sheet Number is not available.'
-        if not_found is not None and not_found.text.strip() == NOT_FOUND_MSG:
-            logger.warning('sheet not found, writing unavailable file')
-            file_to_write = out_file_unavailable
-            content = b''
+        if not_found is not None and not_found.strip() == NOT_FOUND_MSG:
+            logger.warning('sheet not found, marking it unavailable')
+            unavailable = True
         else:
             with open('failed.html', 'w') as f:
                 f.write(resp.text)
@@ -179,11 +186,16 @@ def download_tile(sheet_no):
             raise Exception(f'Expected pdf got html for {sheet_no}')
 
 
+    if unavailable:
+        attempt.finish(STATUS_UNAVAILABLE, error=not_found.strip())
+        return out_file
+
     #TODO check if returned content is pdf or html?
-    ensure_dir(file_to_write)
-    logger.info(f'writing file {file_to_write}')
-    with open(file_to_write, 'wb') as f:
+    ensure_dir(out_file)
+    logger.info(f'writing file {out_file}')
+    with open(out_file, 'wb') as f:
         f.write(content)
+    attempt.finish(STATUS_DOWNLOADED, size=len(content), sha256=hashlib.sha256(content).hexdigest())
     return out_file
 
 
@@ -231,6 +243,9 @@ def is_sheet_done(sheet_no, done):
     if sheet_no in done:
         return True
 
+    if ledger.is_done(Path(get_file_name(sheet_no)).stem):
+        return True
+
     base_file = get_file_name(sheet_no) + '.pdf'
     base_file_unavailable = base_file + '.unavailable'
 
@@ -244,6 +259,7 @@ def is_sheet_done(sheet_no, done):
 
 def scrape(phone_num, password, otp_from_pb):
     login_wrap(phone_num, password, otp_from_pb)
+    ledger.account = phone_num
     map_index_file = Path(data_dir).joinpath('index_50k.geojson')
     if not map_index_file.exists():
         raise Exception(f'{map_index_file} is missing')
@@ -270,7 +286,9 @@ def scrape_wrap(otp_from_pb):
     global session
     secrets_map = get_secrets()
     p_idx = 0
-    tried_users = get_tried_users()
+    # the download limits are daily, limits crossed on an earlier day don't count
+    day_start = datetime.combine(datetime.now().date(), dt_time.min).timestamp()
+    tried_users = ledger.get_accounts(ACCOUNT_LIMIT_CROSSED, since=day_start)
     secrets_map = {k:v for k,v in secrets_map.items() if k not in tried_users}
     total_count = len(secrets_map)
     for phone_num, password in secrets_map.items():
@@ -279,19 +297,16 @@ def scrape_wrap(otp_from_pb):
             logger.info(f'scraping with phone number: {p_idx}/{total_count}')
             scrape(phone_num, password, otp_from_pb)
             logger.warning('No more Sheets')
-            if Path(tried_users_file).exists():
-                Path(tried_users_file).unlink()
+            ledger.clear_accounts(ACCOUNT_LIMIT_CROSSED)
             return
         except Exception as ex:
             if str(ex) != 'Limit Crossed':
                 raise
             logger.warning('Limit crossed for this user.. changing users')
-            tried_users.append(phone_num)
-            update_tried_users(tried_users)
+            ledger.mark_account(phone_num, ACCOUNT_LIMIT_CROSSED)
             #session = requests.session()
     logger.warning('No more users')
-    if Path(tried_users_file).exists():
-        Path(tried_users_file).unlink()
+    ledger.clear_accounts(ACCOUNT_LIMIT_CROSSED)
 
    
 
@@ -309,5 +324,8 @@ if __name__ == '__main__':
     if not CAPTCHA_MANUAL:
         check_captcha_models(captcha_model_dir)
 
-    scrape_wrap(args.otp_from_pushbullet)
+    try:
+        scrape_wrap(args.otp_from_pushbullet)
+    finally:
+        limiter.save()
 
@@ -6,3 +6,6 @@ gh release upload soi-ancilliary data/OSM_SHEET_INDEX.zip
 gh release upload soi-ancilliary data/index_50k.geojson
 
 # 2. download and process SOI data
+
+# 3. index the downloaded pdfs, parse.py and compress.py pick up flavors from data/pdf_index.sqlite
+uv run index_pdfs.py build
@@ -0,0 +1,51 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "soi-common",
+# ]
+#
+# [tool.uv.sources]
+# soi-common = { git = "https://github.com/ramseraph/soi_common" }
+# ///
+
+import sys
+from pathlib import Path
+
+# the mock portal is shared by the benchmarks of all the scrapers
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
+
+from mock_portal import (
+    add_bench_args,
+    run_bench,
+    get_catalogue,
+    get_accounts,
+    point_at_portal,
+    bench_sheet_runs,
+    verify_downloads,
+)
+
+
+def bench_sheets(args, url):
+    import scrape_sheets
+    point_at_portal(scrape_sheets, url, args.time_scale)
+    accounts = get_accounts(args.accounts)
+    scrape_sheets.get_secrets = lambda: accounts
+
+    # the scraper goes through every listing, so every sheet of the portal is expected
+    catalogue = get_catalogue(args)
+    ledger_file = scrape_sheets.ledger.ledger_file
+    runs = bench_sheet_runs(args, url, ledger_file, catalogue.sheets,
+                            lambda: scrape_sheets.scrape_wrap(False, 'CMPDI'))
+    check, problems = verify_downloads(catalogue, catalogue.sheets, ledger_file, scrape_sheets.raw_data_dir, zipped=True)
+    return { 'runs': runs, 'check': check, 'problems': problems }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='run scrape_sheets.py against the mock portal and check what it leaves in the ledger',
+        epilog='the scraper settings come from the usual environment variables, like RATE_START/RATE_MIN/RATE_MAX')
+    add_bench_args(parser)
+    args = parser.parse_args()
+
+    run_bench(args, 'cmpdi', lambda url: bench_sheets(args, url))
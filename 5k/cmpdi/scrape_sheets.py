@@ -9,11 +9,9 @@
 # ///
 
 import logging
+import sys
 import shutil
 import json
-import time
-import zipfile
-import io
 
 from pathlib import Path
 from pprint import pprint
@@ -36,13 +34,31 @@ from soi_common.common import (
     reset_session,
 )
 
+# the helpers shared with the other directories live in util/
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'util'))
 
-DELAY = 1
+from rate_limit import RateLimiter, get_backoff
+from zip_download import save_pdf_from_zip_response, ZipContentsError, BrokenDownloadError
+from download_ledger import DownloadLedger, STATUS_DOWNLOADED, STATUS_UNAVAILABLE, STATUS_FAILED, STATUS_ERROR
+from form_state import find_fragment, find_text
+
+
+# a retriable error rests the account for COOLDOWN_BASE secs, doubling with
+# each further one while no sheets get done, up to COOLDOWN_MAX
+COOLDOWN_BASE = 60
+COOLDOWN_MAX = 960
 logger = logging.getLogger(__name__)
 
 data_dir = 'data/'
 raw_data_dir = data_dir + 'raw/'
 
+# takes the place of a fixed sleep before each post
+limiter = RateLimiter('scrape_sheets')
+session.hooks['response'].append(limiter.on_response)
+
+# status of every sheet tried and of the listing pages done
+ledger = DownloadLedger(raw_dir=raw_data_dir, list_dir=data_dir + 'list')
+
 class DelayedRetriableException(Exception):
     pass
 class KnownException(Exception):
@@ -53,10 +69,8 @@ def check_for_error(resp, err_file=None):
     resps = list(resp.history) + [resp]
     for r in resps:
         if '/Errorpage.aspx' in str(r.url):
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            main_div = soup.find('div', { 'id': 'divMain'})
-            err_div = main_div.find('div', { 'class': 'errorHeading'})
-            err_text = err_div.text
+            main_html = find_fragment(resp.text, 'div', id='divMain') or ''
+            err_text = find_text(main_html, 'div', class_='errorHeading') or ''
             err_strings = [ 'Ooops! Something went wrong.',
                             'We apologize for the inconvenience. Please try again later.']
             for e in err_strings:
@@ -76,14 +90,16 @@ def check_for_error(resp, err_file=None):
             raise Exception('Some Error Happened')
 
 def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
-    out_file = Path(raw_data_dir) / f'{sheet_no}.pdf'
-
-    out_unavailable_file = out_file.with_suffix('.pdf.unavailable')
-    out_html_file = out_file.with_suffix('.html')
-    if out_file.exists() or out_unavailable_file.exists() or out_html_file.exists():
+    if ledger.is_done(sheet_no):
         logging.info(f'Skipping sheet {sheet_no}, already downloaded')
         return
 
+    with ledger.attempt(sheet_no) as attempt:
+        order_sheet(sheet_no, attempt, input_name, soup, headers, url, state_id, dist_id)
+
+def order_sheet(sheet_no, attempt, input_name, soup, headers, url, state_id, dist_id):
+    out_file = Path(raw_data_dir) / f'{sheet_no}.pdf'
+
     form_data = get_form_data(soup)
     form_data.update({
         'ctl00$ContentPlaceHolder1$ddlstatelist': str(state_id),
@@ -94,7 +110,7 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$ddlstate': '0',
         'ctl00$ContentPlaceHolder1$ddldist': '0',
     })
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Selecting sheet {sheet_no}')
     resp = session.post(url, headers=headers, data=form_data)
     if not resp.ok:
@@ -111,15 +127,14 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$ddlstate': '0',
         'ctl00$ContentPlaceHolder1$ddldist': '0',
     })
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Adding sheet {sheet_no} to cart')
     resp = session.post(resp.url, headers=headers, data=form_data)
     if not resp.ok:
         raise Exception(f'Unable to post to add sheet {sheet_no} to cart')
 
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         '__EVENTTARGET': 'ctl00$ContentPlaceHolder1$ImageButton1',
         'ctl00$ContentPlaceHolder1$ddlstatelist': str(state_id),
@@ -130,7 +145,7 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$ddlstate': '0',
         'ctl00$ContentPlaceHolder1$ddldist': '0',
     })
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'viewing cart for sheet {sheet_no}')
     resp = session.post(resp.url, headers=headers, data=form_data)
     if not resp.ok:
@@ -144,7 +159,7 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$HiddenField1': ''
     })
 
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Placing order for sheet {sheet_no}')
     resp = session.post(resp.url, headers=new_headers, data=form_data)
     if not resp.ok:
@@ -153,27 +168,25 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
     try:
         check_for_error(resp)
     except KnownException:
-        out_unavailable_file.write_text('unavailable')
+        attempt.finish(STATUS_UNAVAILABLE, error='Sheet unavailable')
         logging.info(f'Sheet {sheet_no} marked unavailable')
         #return
         raise DelayedRetriableException('Sheet unavailable')
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         'ctl00$ContentPlaceHolder1$btnSubmitPrivateIndenter': 'I Agree',
         'ctl00$ContentPlaceHolder1$HiddenField1': ''
     })
     new_headers['referer'] = resp.url
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Agree to terms and conditions for sheet {sheet_no}')
     resp = session.post(resp.url, headers=new_headers, data=form_data)
     if not resp.ok:
         raise Exception(f'Unable to post to agree to T&C for sheet {sheet_no}')
 
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         'ctl00$ContentPlaceHolder1$gvCustomers$ctl02$btnProceedDownload': 'Proceed for Download',
         'ctl00$ContentPlaceHolder1$HiddenField1': ''
@@ -181,14 +194,13 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
     new_headers['referer'] = resp.url
     logging.info(f'Proceeding to download for sheet {sheet_no}')
 
-    time.sleep(DELAY)
+    limiter.wait()
     resp = session.post(resp.url, headers=new_headers, data=form_data)
     if not resp.ok:
         raise Exception(f'Unable to post to proceed to download for sheet {sheet_no}')
 
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnRequest': 'Request',
         'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
@@ -198,15 +210,14 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$HiddenFieldDistrictCode': '',
     })
     new_headers['referer'] = resp.url
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Requesting download for sheet {sheet_no}')
     resp = session.post(resp.url, headers=new_headers, data=form_data)
     if not resp.ok:
         raise Exception(f'Unable to post to request download for sheet {sheet_no}')
 
     check_for_error(resp)
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnGenerateDownloadLink': 'Generate Download Link',
         'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
@@ -217,7 +228,7 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
     })
     new_headers['referer'] = resp.url
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Generating download link for sheet {sheet_no}')
     resp = session.post(resp.url, headers=new_headers, data=form_data)
     if not resp.ok:
@@ -226,13 +237,12 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
     try:
         check_for_error(resp)
     except KnownException:
-        out_unavailable_file.write_text('unavailable')
+        attempt.finish(STATUS_UNAVAILABLE, error='Sheet unavailable')
         logging.info(f'Sheet {sheet_no} marked unavailable')
         #return
         raise DelayedRetriableException('Sheet unavailable')
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     form_data.update({
         'ctl00$ContentPlaceHolder1$gvOrders$ctl02$btnDownloadMap': 'Download',
         'ctl00$ContentPlaceHolder1$HiddenFieldOrder': '',
@@ -243,39 +253,37 @@ def download_sheet(sheet_no, input_name, soup, headers, url, state_id, dist_id):
         'ctl00$ContentPlaceHolder1$HiddenFieldProductCode': '',
     })
     new_headers['referer'] = resp.url
-    time.sleep(DELAY)
+    limiter.wait()
     logging.info(f'Downloading sheet {sheet_no}')
-    resp = session.post(resp.url, headers=new_headers, data=form_data)
+    resp = session.post(resp.url, headers=new_headers, data=form_data, stream=True)
     if not resp.ok:
         raise Exception(f'Unable to post to download sheet {sheet_no}')
 
     try:
         check_for_error(resp)
     except KnownException:
-        out_unavailable_file.write_text('unavailable')
+        attempt.finish(STATUS_UNAVAILABLE, error='Sheet unavailable')
         logging.info(f'Sheet {sheet_no} marked unavailable')
         #return
         raise DelayedRetriableException('Sheet unavailable')
 
-    zip_file_contents = resp.content
-    # decode the zip file and locate the pdf inside it
-    if resp.headers.get('content-type', '').lower() != 'application/x-zip-compressed':
-        raise DelayedRetriableException('Unable to get zip file')
-
-    # use buffered io to treat the bytes as a file and use the zip file module to pull out the pdf
-    zip_buffer = io.BytesIO(zip_file_contents)
-    with zipfile.ZipFile(zip_buffer, 'r') as zf:
-        namelist = zf.namelist()
-        pdf_files = [ x for x in namelist if x.lower().endswith('.pdf') ]
-        if len(pdf_files) == 0:
-            out_file.with_suffix('.html').write_text(resp.text)
-            raise Exception(f'No pdf file found in the zip for sheet {sheet_no}, check the html file')
-        if len(pdf_files) > 1:
-            out_file.with_suffix('.html').write_text(resp.text)
-            raise Exception(f'Multiple pdf files found in the zip for sheet {sheet_no}, check the html file')
-        pdf_file_name = pdf_files[0]
-        with zf.open(pdf_file_name) as pdf_f, open(out_file, 'wb') as out_f:
-            shutil.copyfileobj(pdf_f, out_f)
+    # the body is only read from here on, straight to disk
+    try:
+        if resp.headers.get('content-type', '').lower() != 'application/x-zip-compressed':
+            raise DelayedRetriableException('Unable to get zip file')
+        try:
+            size, sha256 = save_pdf_from_zip_response(resp, out_file)
+        except ZipContentsError as ex:
+            # the html file is only kept for a look, the ledger has the status
+            out_file.with_suffix('.html').write_text('\n'.join(ex.namelist))
+            attempt.finish(STATUS_FAILED, error=str(ex))
+            raise Exception(f'{ex} for sheet {sheet_no}, check the html file')
+        except BrokenDownloadError as ex:
+            attempt.finish(STATUS_ERROR, error=str(ex))
+            raise DelayedRetriableException(f'{ex} for sheet {sheet_no}, trying again')
+    finally:
+        resp.close()
+    attempt.finish(STATUS_DOWNLOADED, size=size, sha256=sha256)
     logging.info(f'Sheet {sheet_no} written to {out_file}')
 
 
@@ -285,6 +293,7 @@ def scrape(phone_num, password, otp_from_pb, typ):
     global force_map_tried
 
     login_wrap(phone_num, password, otp_from_pb)
+    ledger.account = phone_num
 
     logging.info('Product Show page scraping')
     dp_page = base_url + 'Digital_Product_Show.aspx'
@@ -310,8 +319,7 @@ def scrape(phone_num, password, otp_from_pb, typ):
         raise Exception('Unable to post to get village shapefile listing')
     check_for_error(resp)
 
-    soup = BeautifulSoup(resp.text, 'html.parser')
-    form_data = get_form_data(soup)
+    form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
     if typ == 'NHP':
         key = 'ctl00$ContentPlaceHolder1$ListViewSingleProduct$ctrl1$Button4'
     else:
@@ -344,8 +352,8 @@ def scrape(phone_num, password, otp_from_pb, typ):
     for state_id, state_name in state_map.items():
         state_dir = Path(data_dir) / 'list' / str(state_id)
         state_dir.mkdir(parents=True, exist_ok=True)
-        state_done_file = state_dir / 'done.txt'
-        if state_done_file.exists():
+        state_key = str(state_id)
+        if ledger.is_listing_done(state_key):
             logging.info(f'Skipping state {state_name}, already done')
             continue
 
@@ -377,8 +385,8 @@ def scrape(phone_num, password, otp_from_pb, typ):
         for dist_id, dist_name in dist_map.items():
             dist_dir = state_dir / str(dist_id)
             dist_dir.mkdir(parents=True, exist_ok=True)
-            dist_done_file = dist_dir / 'done.txt'
-            if dist_done_file.exists():
+            dist_key = f'{state_id}/{dist_id}'
+            if ledger.is_listing_done(dist_key):
                 logging.info(f'Skipping district {dist_name}, already done')
                 continue
 
@@ -398,8 +406,7 @@ def scrape(phone_num, password, otp_from_pb, typ):
                 raise Exception(f'Unable to post to get sheet listing for district {dist_name}')
      
             check_for_error(resp)
-            soup = BeautifulSoup(resp.text, 'html.parser')
-            form_data = get_form_data(soup)
+            form_data = get_form_data(BeautifulSoup(resp.text, 'html.parser'))
 
 
             form_data.update({
@@ -424,7 +431,7 @@ def scrape(phone_num, password, otp_from_pb, typ):
                 table = sheet_soup.find('table', { 'id': 'ContentPlaceHolder1_GridViewPopup' })
                 if table is None:
                     logging.info(f'No sheets available for district {dist_name}, marking done')
-                    dist_done_file.write_text('done')
+                    ledger.mark_listing_done(dist_key)
                     continue
 
                 rows = table.find_all('tr', recursive=False)
@@ -495,15 +502,15 @@ def scrape(phone_num, password, otp_from_pb, typ):
                     'ctl00$ContentPlaceHolder1$ddlstate': '0',
                     'ctl00$ContentPlaceHolder1$ddldist': '0',
                 })
-                #time.sleep(DELAY)
+                #limiter.wait()
                 logging.info(f'Getting the sheet listing page {pno} for district {dist_name}')
                 resp = session.post(resp.url, headers=headers, data=form_data)
                 if not resp.ok:
                     raise Exception(f'Unable to post to get sheet listing page {pno} for district {dist_name}')
                 pno = next_pno
 
-            dist_done_file.write_text('done')
-        state_done_file.write_text('done')
+            ledger.mark_listing_done(dist_key)
+        ledger.mark_listing_done(state_key)
 
     return False
 
@@ -530,6 +537,8 @@ def scrape_wrap(otp_from_pb, typ):
     secrets_map = {k:v for k,v in secrets_map.items()}
     total_count = len(secrets_map)
     s_items = list(secrets_map.items())
+    failure_count = 0
+    done_count = None
     while True:
         phone_num, password = s_items[0]
         try:
@@ -537,8 +546,14 @@ def scrape_wrap(otp_from_pb, typ):
             if not ret:
                 break
         except (KnownException, DelayedRetriableException) as ke:
+            # only back off further while no sheets are getting done
+            count = len(ledger.get_statuses())
+            if done_count is not None and count > done_count:
+                failure_count = 0
+            done_count = count
+            failure_count += 1
             logger.warning('Known Exception for this user..')
-            time.sleep(60)
+            limiter.rest(get_backoff(failure_count, COOLDOWN_BASE, COOLDOWN_MAX))
             saved_cookie_file = Path(f'data/cookies/saved_cookies.{phone_num}.pkl')
             saved_cookie_file.unlink(missing_ok=True)
             reset_session()
@@ -566,5 +581,8 @@ if __name__ == '__main__':
     #geojson = json.loads(Path('data/index.geojson').read_text())
     #features = geojson['features']
     #sheet_list = [ f['properties']['id'] for f in features ]
-    scrape_wrap(otp_from_pb, typ)
+    try:
+        scrape_wrap(otp_from_pb, typ)
+    finally:
+        limiter.save()
 
@@ -0,0 +1,276 @@
+import os
+import time
+import logging
+import sqlite3
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+LEDGER_FILE = Path(os.environ.get('DOWNLOAD_LEDGER_FILE', 'data/download_ledger.sqlite'))
+
+# the outcomes which end the work on a sheet, like the marker files used to
+STATUS_DOWNLOADED = 'downloaded'
+STATUS_UNAVAILABLE = 'unavailable'
+# failed with a page kept as <sheet>.html for a look, not retried
+STATUS_FAILED = 'failed'
+DONE_STATUSES = (STATUS_DOWNLOADED, STATUS_UNAVAILABLE, STATUS_FAILED)
+# attempt still running, or interrupted
+STATUS_STARTED = 'started'
+# retriable error, the sheet is tried again
+STATUS_ERROR = 'error'
+
+
+class Attempt:
+    def __init__(self, ledger, sheet):
+        self.ledger = ledger
+        self.sheet = sheet
+        self.id = None
+        self.status = None
+
+    def finish(self, status, size=None, sha256=None, error=None):
+        self.status = status
+        self.ledger.finish_attempt(self, status, size, sha256, error)
+
+    def __enter__(self):
+        self.id = self.ledger.start_attempt(self.sheet)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.status is None:
+            error = f'{exc_type.__name__}: {exc}' if exc_type is not None else 'no outcome recorded'
+            self.finish(STATUS_ERROR, error=error)
+        return False
+
+
+class DownloadLedger:
+    """
+    Record of every attempt at downloading a sheet, with the account used, the
+    times, the size and hash of what was downloaded and the error, and of the
+    latest outcome for each sheet. Also keeps the listing pages which are done
+    and the accounts which are used up, which used to be the done.txt and
+    tried_users.txt files. In WAL mode, so several scrapers can share it.
+
+    The marker files already in raw_dir and the done.txt files in list_dir are
+    imported the first time the ledger is opened. Markers which turn up after
+    that are ignored, unless they are imported again with the import command,
+    which only adds the markers that don't match the sheet's current status.
+    """
+    def __init__(self, ledger_file=LEDGER_FILE, raw_dir='data/raw', list_dir='data/list'):
+        self.ledger_file = Path(ledger_file)
+        self.raw_dir = Path(raw_dir)
+        self.list_dir = Path(list_dir)
+        self.account = None
+        self.conn = None
+        self.pid = None
+
+    def get_conn(self):
+        # connections don't survive a fork, each worker process opens its own
+        if self.conn is not None and self.pid == os.getpid():
+            return self.conn
+        self.ledger_file.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.ledger_file), timeout=60, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS attempts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                sheet TEXT NOT NULL,
+                status TEXT NOT NULL,
+                account TEXT,
+                pid INTEGER,
+                started REAL,
+                finished REAL,
+                size INTEGER,
+                sha256 TEXT,
+                error TEXT
+            );
+            CREATE INDEX IF NOT EXISTS attempts_sheet ON attempts (sheet);
+            CREATE TABLE IF NOT EXISTS sheets (
+                sheet TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempt_id INTEGER,
+                updated REAL
+            );
+            CREATE INDEX IF NOT EXISTS sheets_status ON sheets (status);
+            CREATE TABLE IF NOT EXISTS listings (
+                key TEXT PRIMARY KEY,
+                count INTEGER,
+                updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS accounts (
+                account TEXT PRIMARY KEY,
+                status TEXT,
+                updated REAL
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.conn = conn
+        self.pid = os.getpid()
+        self.import_markers()
+        return conn
+
+    def import_markers(self, force=False):
+        conn = self.conn
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute("SELECT value FROM meta WHERE key = 'markers_imported'").fetchone()
+            if row is not None and not force:
+                return
+            now = time.time()
+            sheets = []
+            if self.raw_dir.exists():
+                for p in self.raw_dir.iterdir():
+                    name = p.name
+                    if name.endswith('.pdf.unavailable'):
+                        sheets.append((name[:-len('.pdf.unavailable')], STATUS_UNAVAILABLE, None, p.stat().st_mtime))
+                    elif name.endswith('.pdf'):
+                        st = p.stat()
+                        sheets.append((name[:-len('.pdf')], STATUS_DOWNLOADED, st.st_size, st.st_mtime))
+                    elif name.endswith('.html'):
+                        sheets.append((name[:-len('.html')], STATUS_FAILED, None, p.stat().st_mtime))
+            # a pdf wins over an older failure for the same sheet
+            order = { STATUS_FAILED: 0, STATUS_UNAVAILABLE: 1, STATUS_DOWNLOADED: 2 }
+            sheets.sort(key=lambda x: order[x[1]])
+            sheets = { x[0]: x for x in sheets }
+            current = { row['sheet']: row['status'] for row in conn.execute('SELECT sheet, status FROM sheets') }
+            # imported again, only what changed gets an attempt
+            sheets = [ x for x in sheets.values() if current.get(x[0]) != x[1] ]
+            for sheet, status, size, mtime in sheets:
+                cur = conn.execute('INSERT INTO attempts (sheet, status, started, finished, size, error) VALUES (?, ?, ?, ?, ?, ?)',
+                                   (sheet, status, mtime, mtime, size, 'imported from marker file'))
+                conn.execute('INSERT OR REPLACE INTO sheets (sheet, status, attempt_id, updated) VALUES (?, ?, ?, ?)',
+                             (sheet, status, cur.lastrowid, now))
+            listings = []
+            if self.list_dir.exists():
+                for p in self.list_dir.rglob('done.txt'):
+                    listings.append((str(p.parent.relative_to(self.list_dir)), None, p.stat().st_mtime))
+            conn.executemany('INSERT OR IGNORE INTO listings (key, count, updated) VALUES (?, ?, ?)', listings)
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('markers_imported', ?)", (str(now),))
+        if len(sheets) > 0 or len(listings) > 0:
+            logger.info(f'imported {len(sheets)} sheet markers and {len(listings)} listing markers into {self.ledger_file}')
+
+    def attempt(self, sheet):
+        return Attempt(self, sheet)
+
+    def start_attempt(self, sheet):
+        conn = self.get_conn()
+        with conn:
+            cur = conn.execute('INSERT INTO attempts (sheet, status, account, pid, started) VALUES (?, ?, ?, ?, ?)',
+                               (sheet, STATUS_STARTED, self.account, os.getpid(), time.time()))
+        return cur.lastrowid
+
+    def finish_attempt(self, attempt, status, size=None, sha256=None, error=None):
+        conn = self.get_conn()
+        now = time.time()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('UPDATE attempts SET status = ?, finished = ?, size = ?, sha256 = ?, error = ? WHERE id = ?',
+                         (status, now, size, sha256, error, attempt.id))
+            if status in DONE_STATUSES:
+                conn.execute('INSERT OR REPLACE INTO sheets (sheet, status, attempt_id, updated) VALUES (?, ?, ?, ?)',
+                             (attempt.sheet, status, attempt.id, now))
+
+    def get_status(self, sheet):
+        row = self.get_conn().execute('SELECT status FROM sheets WHERE sheet = ?', (sheet,)).fetchone()
+        return row['status'] if row is not None else None
+
+    def is_done(self, sheet):
+        return self.get_status(sheet) in DONE_STATUSES
+
+    def get_statuses(self):
+        return { row['sheet']: row['status'] for row in self.get_conn().execute('SELECT sheet, status FROM sheets') }
+
+    def is_listing_done(self, key):
+        return self.get_conn().execute('SELECT 1 FROM listings WHERE key = ?', (str(key),)).fetchone() is not None
+
+    def mark_listing_done(self, key, count=None):
+        conn = self.get_conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO listings (key, count, updated) VALUES (?, ?, ?)', (str(key), count, time.time()))
+
+    def get_accounts(self, status, since=None):
+        # marks from before since are stale, like a download limit crossed on an earlier day
+        rows = self.get_conn().execute('SELECT account FROM accounts WHERE status = ? AND updated >= ?', (status, since or 0))
+        return [ row['account'] for row in rows ]
+
+    def mark_account(self, account, status):
+        conn = self.get_conn()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO accounts (account, status, updated) VALUES (?, ?, ?)', (account, status, time.time()))
+
+    def clear_accounts(self, status):
+        conn = self.get_conn()
+        with conn:
+            conn.execute('DELETE FROM accounts WHERE status = ?', (status,))
+
+    def checkpoint(self):
+        # folds the wal into the main file, so the file alone can be copied or cached
+        self.get_conn().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+
+def print_summary(ledger):
+    conn = ledger.get_conn()
+    print('sheets by status:')
+    for row in conn.execute('SELECT status, COUNT(*) AS count FROM sheets GROUP BY status ORDER BY status'):
+        print(f'{row["status"]:<12} {row["count"]:>8}')
+    print()
+    print('attempts by account:')
+    rows = conn.execute("""
+        SELECT account, COUNT(*) AS count, SUM(status = ?) AS downloaded, SUM(status = ?) AS errors,
+               SUM(COALESCE(size, 0)) AS bytes, SUM(finished - started) AS secs
+        FROM attempts WHERE error IS NOT 'imported from marker file' GROUP BY account ORDER BY account
+    """, (STATUS_DOWNLOADED, STATUS_ERROR))
+    for row in rows:
+        print(f'{str(row["account"]):<16} {row["count"]:>8} attempts {row["downloaded"]:>8} downloaded '
+              f'{row["errors"]:>6} errors {row["bytes"] / (1024 * 1024):>10.1f} MB {row["secs"] or 0:>10.0f} secs')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='query the ledger of sheet downloads')
+    parser.add_argument('-f', '--ledger-file', help='sqlite ledger file', default=str(LEDGER_FILE))
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('summary', help='counts by status and by account')
+
+    list_parser = subparsers.add_parser('list', help='print the sheets with the given status, one per line')
+    list_parser.add_argument('status', choices=DONE_STATUSES)
+
+    status_parser = subparsers.add_parser('status', help='print the status of sheets, read from the arguments or stdin')
+    status_parser.add_argument('sheets', nargs='*')
+
+    pending_parser = subparsers.add_parser('pending', help='print the sheets in a list file which are not done yet')
+    pending_parser.add_argument('sheets_file')
+
+    subparsers.add_parser('import', help='import the marker files again')
+
+    subparsers.add_parser('checkpoint', help='write everything into the ledger file, before it is copied')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    ledger = DownloadLedger(args.ledger_file)
+    if args.command == 'summary':
+        print_summary(ledger)
+    elif args.command == 'list':
+        for row in ledger.get_conn().execute('SELECT sheet FROM sheets WHERE status = ? ORDER BY sheet', (args.status,)):
+            print(row['sheet'])
+    elif args.command == 'status':
+        import sys
+        sheets = args.sheets if len(args.sheets) > 0 else [ x.strip() for x in sys.stdin if x.strip() != '' ]
+        for sheet in sheets:
+            print(f'{sheet} {ledger.get_status(sheet) or "unprobed"}')
+    elif args.command == 'pending':
+        sheets = [ x.strip() for x in Path(args.sheets_file).read_text().split('\n') if x.strip() != '' ]
+        for sheet in sheets:
+            if not ledger.is_done(sheet):
+                print(sheet)
+    elif args.command == 'checkpoint':
+        ledger.checkpoint()
+    else:
+        # a new ledger imports the markers when it is opened, the forced import then finds nothing new
+        ledger.get_conn()
+        ledger.import_markers(force=True)
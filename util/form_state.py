@@ -0,0 +1,49 @@
+import re
+import html
+
+# the error spans and divs are pulled out of the pages without parsing them whole
+TAG_RE = re.compile(r'<[^>]*>')
+
+
+def get_text(fragment):
+    return html.unescape(TAG_RE.sub('', fragment))
+
+def find_text(page_html, tag, id=None, class_=None):
+    """
+    Text of the first tag with the given id or class, None if there is none.
+    The same as soup.find(tag, ...).text for the error spans and divs checked
+    after each post.
+    """
+    fragment = find_fragment(page_html, tag, id=id, class_=class_)
+    return get_text(fragment) if fragment is not None else None
+
+def find_fragment(page_html, tag, id=None, class_=None):
+    """
+    Inner html of the first tag with the given id or class, None if there is none.
+    """
+    if id is not None:
+        attr_re = r'\bid\s*=\s*["\']?' + re.escape(id) + r'["\'\s>/]'
+    else:
+        attr_re = r'\bclass\s*=\s*["\'](?:[^"\']*\s)?' + re.escape(class_) + r'(?:\s[^"\']*)?["\']'
+    start_re = re.compile(r'<' + tag + r'\b[^>]*?' + attr_re, re.IGNORECASE)
+    m = start_re.search(page_html)
+    if m is None:
+        return None
+    open_end = page_html.find('>', m.end() - 1)
+    if open_end == -1:
+        return None
+    if page_html[open_end - 1] == '/':
+        return ''
+
+    # same named tags can nest, like divs, the matching close tag is at depth 0
+    depth = 1
+    tag_re = re.compile(r'<(/?)' + tag + r'\b[^>]*?(/?)>', re.IGNORECASE)
+    pos = open_end + 1
+    for tm in tag_re.finditer(page_html, pos):
+        if tm.group(1) == '/':
+            depth -= 1
+            if depth == 0:
+                return page_html[pos:tm.start()]
+        elif tm.group(2) != '/':
+            depth += 1
+    return page_html[pos:]
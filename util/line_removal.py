@@ -0,0 +1,112 @@
+import cv2
+import numpy as np
+from shapely.geometry import LineString, Polygon, CAP_STYLE
+
+# the masks are built and the blurs run a tile at a time, only over the
+# part of the tile the lines cover
+TILE_SIZE = 256
+
+
+def get_removal_sizes(params, w):
+    # same sizes as TopoMapProcessor.remove_line()
+    line_buf = round(params.line_buf_ratio * w)
+    blur_buf = round(params.blur_buf_ratio * w)
+    blur_kern = round(params.blur_kern_ratio * w)
+    if blur_kern % 2 == 0:
+        blur_kern += 1
+    return line_buf, blur_buf, blur_kern, params.blur_repeat
+
+def get_line_polygons(line, line_buf, limits):
+    poly = LineString(line).buffer(line_buf, resolution=1, cap_style=CAP_STYLE.flat).intersection(limits)
+    if poly.is_empty:
+        return []
+    polys = poly.geoms if hasattr(poly, 'geoms') else [ poly ]
+    return [ np.floor(np.array(p.exterior.coords)).astype(np.int32) for p in polys if p.geom_type == 'Polygon' and not p.is_empty ]
+
+def get_blur_box(line, blur_buf, limits):
+    # the strip TopoMapProcessor.remove_line() blurs, only pixels in it feed the blur
+    poly = LineString(line).buffer(blur_buf, resolution=1, cap_style=CAP_STYLE.flat).intersection(limits)
+    if poly.is_empty:
+        return None
+    return [ round(x) for x in poly.bounds ]
+
+def remove_lines_in_tile(img, polys, bounds, blur_boxes, tx, ty, tile_size, blur_kern, blur_repeat, pad):
+    h, w = img.shape[:2]
+    tx1 = min(tx + tile_size, w)
+    ty1 = min(ty + tile_size, h)
+    sel = (bounds[:, 0] < tx1) & (bounds[:, 2] >= tx) & (bounds[:, 1] < ty1) & (bounds[:, 3] >= ty)
+    if not sel.any():
+        return
+
+    mask = np.zeros((ty1 - ty, tx1 - tx), dtype=np.uint8)
+    offset = np.array([tx, ty], dtype=np.int32)
+    for i in np.flatnonzero(sel):
+        # one at a time, fillPoly leaves the overlaps of the polygons it is given unfilled
+        cv2.fillPoly(mask, pts=[ polys[i] - offset ], color=1)
+    x, y, bw, bh = cv2.boundingRect(mask)
+    if bw == 0 or bh == 0:
+        return
+
+    # the pixels around the masked area, reflected beyond the blur strips of the lines
+    mx0, my0 = tx + x, ty + y
+    mx1, my1 = mx0 + bw, my0 + bh
+    boxes = blur_boxes[sel]
+    wx0 = max(mx0 - pad, min(boxes[:, 0].min(), mx0))
+    wy0 = max(my0 - pad, min(boxes[:, 1].min(), my0))
+    wx1 = min(mx1 + pad, max(boxes[:, 2].max(), mx1))
+    wy1 = min(my1 + pad, max(boxes[:, 3].max(), my1))
+    window = cv2.copyMakeBorder(np.ascontiguousarray(img[wy0:wy1, wx0:wx1]),
+                                pad - (my0 - wy0), pad - (wy1 - my1),
+                                pad - (mx0 - wx0), pad - (wx1 - mx1),
+                                cv2.BORDER_REFLECT_101)
+
+    # each blur only needs to cover what the next one reads
+    half = blur_kern // 2
+    blurred = window
+    for i in range(blur_repeat + 1):
+        blurred = cv2.medianBlur(blurred, blur_kern)
+        if i < blur_repeat and half > 0:
+            blurred = blurred[half:-half, half:-half]
+    offset = pad - half * blur_repeat
+    blurred = blurred[offset:offset + bh, offset:offset + bw]
+
+    region_mask = mask[y:y + bh, x:x + bw] == 1
+    region = img[my0:my1, mx0:mx1]
+    region[region_mask] = blurred[region_mask]
+
+def remove_lines(img, lines, passes=1, tile_size=TILE_SIZE, after_tile_row=None):
+    """
+    Batched TopoMapProcessor.remove_line() for a list of (line, LineRemovalParams).
+    Lines with the same blur settings are rasterized into one mask and the masked
+    pixels are replaced with the median blur of their surroundings in a single
+    sweep over the image per pass, instead of one blur per line. img is changed
+    in place, after_tile_row(img) is called after each row of tiles is done.
+    """
+    h, w = img.shape[:2]
+    limits = Polygon([(w,0), (w,h), (0,h), (0,0), (w,0)])
+
+    groups = {}
+    for line, params in lines:
+        line_buf, blur_buf, blur_kern, blur_repeat = get_removal_sizes(params, w)
+        blur_box = get_blur_box(line, blur_buf, limits)
+        if blur_box is None:
+            continue
+        group = groups.setdefault((blur_kern, blur_repeat), ([], []))
+        for poly in get_line_polygons(line, line_buf, limits):
+            group[0].append(poly)
+            group[1].append(blur_box)
+
+    print(f'removing {len(lines)} lines with {len(groups)} blur settings in {passes} passes')
+    for i in range(passes):
+        for (blur_kern, blur_repeat), (polys, blur_boxes) in groups.items():
+            if len(polys) == 0:
+                continue
+            bounds = np.array([ [p[:, 0].min(), p[:, 1].min(), p[:, 0].max(), p[:, 1].max()] for p in polys ])
+            blur_boxes = np.array(blur_boxes)
+            # enough real pixels around the mask for all the repeated blurs
+            pad = (blur_kern // 2) * (blur_repeat + 1)
+            for ty in range(0, h, tile_size):
+                for tx in range(0, w, tile_size):
+                    remove_lines_in_tile(img, polys, bounds, blur_boxes, tx, ty, tile_size, blur_kern, blur_repeat, pad)
+                if after_tile_row is not None:
+                    after_tile_row(img)
@@ -0,0 +1,1073 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = []
+# ///
+
+import io
+import os
+import re
+import sys
+import json
+import time
+import random
+import signal
+import base64
+import hashlib
+import logging
+import sqlite3
+import zipfile
+import tempfile
+import threading
+import subprocess
+import multiprocessing
+from pathlib import Path
+from http import cookies
+from html import escape
+from urllib.parse import urlsplit, parse_qs
+from urllib.request import urlopen, Request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = 'ASP.NET_SessionId'
+CP = 'ctl00$ContentPlaceHolder1$'
+CP_ID = 'ContentPlaceHolder1_'
+HTML_TYPE = 'text/html; charset=utf-8'
+ZIP_TYPE = 'application/x-zip-compressed'
+PDF_TYPE = 'application/pdf'
+
+# the texts the scrapers look for
+ERROR_TEXT = 'Ooops! Something went wrong.'
+APOLOGY_TEXT = 'We apologize for the inconvenience. Please try again later.'
+CAPTCHA_FAILED_MSG = 'Please enter valid captcha code'
+LIMIT_CROSSED_MSG = 'You have crossed your download limit for today'
+NOT_FOUND_MSG = 'Sheet Number is not available.'
+
+# read by the benchmarks in their spawned worker processes
+PORTAL_URL_ENV = 'MOCK_PORTAL_URL'
+TIME_SCALE_ENV = 'MOCK_TIME_SCALE'
+
+PAGE_SIZE = 10
+PAGER_WINDOW = 10
+# fixed zip member times, so the zip of a sheet is the same bytes every time
+ZIP_DATE_TIME = (2020, 1, 1, 0, 0, 0)
+
+
+def norm_sheet(sheet_no):
+    return sheet_no.replace('_', '').replace('/', '').strip().upper()
+
+def make_sheet_ids(count):
+    ids = []
+    for i in range(count):
+        block, k = divmod(i, 16)
+        major, minor = divmod(block, 16)
+        ids.append(f'{chr(ord("A") + major % 26)}{43 + major // 26}{chr(ord("A") + minor)}_{k + 1}')
+    return ids
+
+
+class Catalogue:
+    """
+    The sheets the portal knows about, which of them can't be ordered, how
+    they are spread over the states and districts of the listings and the
+    bytes served for each. Everything follows from the arguments and the
+    seed, so the benchmark builds the same catalogue as the portal process.
+    """
+    def __init__(self, sheet_count=40, unavailable_ratio=0.1, states=2, districts=2, pdf_size=256 * 1024, seed=0):
+        rng = random.Random(seed)
+        self.sheets = make_sheet_ids(sheet_count)
+        self.unavailable = set(rng.sample(self.sheets, int(round(sheet_count * unavailable_ratio))))
+        self.by_norm = { norm_sheet(x): x for x in self.sheets }
+        self.pdf_size = pdf_size
+        self.seed = seed
+
+        self.states = {}
+        for i in range(states):
+            dists = {}
+            for j in range(districts):
+                dists[str(j + 1)] = (f'DISTRICT {i + 1}{chr(ord("A") + j)}', [])
+            self.states[str(i + 1)] = (f'STATE {i + 1}', dists)
+        keys = [ (s, d) for s, (_, dists) in self.states.items() for d in dists ]
+        for idx, sheet_no in enumerate(self.sheets):
+            s, d = keys[idx % len(keys)]
+            self.states[s][1][d][1].append(sheet_no)
+
+    def lookup(self, sheet_no):
+        return self.by_norm.get(norm_sheet(sheet_no))
+
+    def is_available(self, sheet_no):
+        return sheet_no is not None and sheet_no not in self.unavailable
+
+    def get_listing(self, state_id, dist_id, available_only):
+        dists = self.states.get(state_id, (None, {}))[1]
+        sheets = dists.get(dist_id, (None, []))[1]
+        if available_only:
+            sheets = [ x for x in sheets if self.is_available(x) ]
+        return sheets
+
+    def get_pdf(self, sheet_no):
+        rng = random.Random(f'{self.seed}:{sheet_no}')
+        header = f'%PDF-1.4\n% sheet {sheet_no}\n'.encode('ascii')
+        return header + rng.randbytes(max(self.pdf_size - len(header), 0))
+
+    def get_zip(self, sheet_no):
+        buf = io.BytesIO()
+        with zipfile.ZipFile(buf, 'w', zipfile.ZIP_STORED) as zf:
+            zf.writestr(zipfile.ZipInfo(f'{sheet_no}.pdf', date_time=ZIP_DATE_TIME), self.get_pdf(sheet_no))
+        return buf.getvalue()
+
+
+class PortalSession:
+    def __init__(self, sid, account=None):
+        self.sid = sid
+        self.account = account
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.token_count = 0
+        self.product = None
+        self.format = ''
+        self.state = '0'
+        self.dist = '0'
+        self.ptype = ''
+        self.page = 1
+        self.message = ''
+        # checkbox name -> sheet of the last listing page shown
+        self.row_inputs = {}
+        self.selected = []
+        self.cart = []
+        self.order = []
+        self.order_state = {}
+        self.free_downloads = 0
+        self.free_sheet = ''
+
+    def new_token(self):
+        self.token_count += 1
+        token = f'{self.sid[:8]}{self.token_count:06d}'
+        self.tokens.add(token)
+        return token
+
+
+def ctl(name):
+    return CP + name, CP_ID + name.replace('$', '_')
+
+def hidden(name, value=''):
+    n, i = ctl(name)
+    return f'<input type="hidden" name="{n}" id="{i}" value="{escape(value)}" />'
+
+def text_input(name, value=''):
+    n, i = ctl(name)
+    return f'<input name="{n}" type="text" value="{escape(value)}" id="{i}" class="form-control" />'
+
+def submit(name, value):
+    n, i = ctl(name)
+    return f'<input type="submit" name="{n}" value="{escape(value)}" id="{i}" class="btn btn-primary" />'
+
+def checkbox(name, checked=False):
+    n, i = ctl(name)
+    checked_attr = ' checked="checked"' if checked else ''
+    return f'<input id="{i}" type="checkbox" name="{n}"{checked_attr} />'
+
+def postback_link(name, text, argument=''):
+    n, i = ctl(name)
+    return f'<a id="{i}" href="javascript:__doPostBack(&#39;{n}&#39;,&#39;{argument}&#39;)">{escape(text)}</a>'
+
+def span(name, text, style='color:Red;'):
+    _, i = ctl(name)
+    return f'<span id="{i}" style="{style}">{escape(text)}</span>'
+
+def select(name, options, selected=None, autopostback=True):
+    n, i = ctl(name)
+    onchange = f' onchange="javascript:setTimeout(&#39;__doPostBack(\\&#39;{n}\\&#39;,\\&#39;\\&#39;)&#39;, 0)"' if autopostback else ''
+    opts = []
+    for value, text in options:
+        sel = ' selected="selected"' if value == selected else ''
+        opts.append(f'<option{sel} value="{escape(value)}">{escape(text)}</option>')
+    return f'<select name="{n}" id="{i}" class="form-control"{onchange}>\n' + '\n'.join(opts) + '\n</select>'
+
+def pager_row(grid, page, page_count, colspan):
+    if page_count <= 1:
+        return ''
+    start = ((page - 1) // PAGER_WINDOW) * PAGER_WINDOW + 1
+    end = min(start + PAGER_WINDOW - 1, page_count)
+    cells = []
+    if start > 1:
+        cells.append(postback_link(grid, 'First', 'Page$First'))
+        cells.append(postback_link(grid, '...', f'Page${start - 1}'))
+    for p in range(start, end + 1):
+        cells.append(f'<span>{p}</span>' if p == page else postback_link(grid, str(p), f'Page${p}'))
+    if end < page_count:
+        cells.append(postback_link(grid, '...', f'Page${end + 1}'))
+        cells.append(postback_link(grid, 'Last', 'Page$Last'))
+    tds = ''.join(f'<td>{c}</td>' for c in cells)
+    return f'<tr class="pager"><td colspan="{colspan}"><table><tr>{tds}</tr></table></td></tr>'
+
+def grid_table(name, header, rows, pager=''):
+    _, i = ctl(name)
+    out = [ f'<table cellspacing="0" rules="all" border="1" id="{i}" style="border-collapse:collapse;">' ]
+    out.append('<tr>' + ''.join(f'<th scope="col">{escape(h)}</th>' for h in header) + '</tr>')
+    for row in rows:
+        out.append('<tr>' + ''.join(f'<td>{c}</td>' for c in row) + '</tr>')
+    if pager != '':
+        out.append(pager)
+    out.append('</table>')
+    return '\n'.join(out)
+
+def get_page_number(argument, page, page_count):
+    arg = argument.split('$', 1)[-1]
+    if arg == 'First':
+        return 1
+    if arg == 'Last':
+        return page_count
+    try:
+        return min(max(int(arg), 1), max(page_count, 1))
+    except ValueError:
+        return page
+
+
+class MockPortal:
+    """
+    Stand-in for the Survey of India online maps portal, serving the pages the
+    scrapers walk through: Digital_Product_Show.aspx, the NHP and CMPDI product
+    pages with their listings, the cart, the order grid and the zip downloads,
+    and FreeMapSpecification.aspx for the OSM sheets. The state of each visitor
+    is kept against the ASP.NET_SessionId cookie and a post is only accepted
+    with a __VIEWSTATE this visitor was given, the way a broken form would be
+    turned away by the real one.
+
+    Faults are injected at the given rates: error pages, slow responses,
+    wrong captchas, pages instead of zips and zips cut short. After
+    outage_after downloads the portal answers 503 until restored. With
+    keep_cart, a refused order leaves the cart of the session as it was.
+    """
+    def __init__(self, catalogue, latency=0.0, jitter=0.0, slow_rate=0.0, slow_latency=5.0,
+                 error_rate=0.0, captcha_fail_rate=0.0, html_rate=0.0, truncate_rate=0.0,
+                 download_limit=0, outage_after=0, keep_cart=False, viewstate_size=40000, seed=0):
+        self.catalogue = catalogue
+        self.latency = latency
+        self.jitter = jitter
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.captcha_fail_rate = captcha_fail_rate
+        self.html_rate = html_rate
+        self.truncate_rate = truncate_rate
+        self.download_limit = download_limit
+        self.outage_after = outage_after
+        self.keep_cart = keep_cart
+        self.rng = random.Random(seed)
+        self.viewstate_blob = base64.b64encode(self.rng.randbytes(viewstate_size * 3 // 4)).decode('ascii')
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.down = False
+        self.stats = {
+            'requests': 0,
+            'posts': 0,
+            'errors_injected': 0,
+            'slow_injected': 0,
+            'captcha_failures': 0,
+            'limit_crossed': 0,
+            'not_found': 0,
+            'html_instead_of_zip': 0,
+            'truncated': 0,
+            'viewstate_rejected': 0,
+            'outage_responses': 0,
+            'logins': 0,
+            'orders': 0,
+            'orders_refused': 0,
+            'downloads': 0,
+            # sheet -> number of complete downloads served
+            'downloaded': {},
+            # state/district -> number of listing pages served
+            'listing_pages': {},
+        }
+
+    def count(self, key, by=1):
+        with self.lock:
+            self.stats[key] += by
+
+    def chance(self, rate):
+        if rate <= 0:
+            return False
+        with self.lock:
+            return self.rng.random() < rate
+
+    def new_session(self, account=None):
+        with self.lock:
+            sid = base64.b32encode(self.rng.randbytes(15)).decode('ascii').lower()
+            sess = PortalSession(sid, account)
+            self.sessions[sid] = sess
+        return sess
+
+    def get_session(self, handler):
+        jar = cookies.SimpleCookie(handler.headers.get('Cookie', ''))
+        morsel = jar.get(SESSION_COOKIE)
+        if morsel is not None:
+            sess = self.sessions.get(morsel.value)
+            if sess is not None:
+                return sess, False
+        return self.new_session(), True
+
+    def get_delay(self):
+        delay = self.latency
+        if self.jitter > 0:
+            with self.lock:
+                delay += self.rng.uniform(-self.jitter, self.jitter)
+        if self.chance(self.slow_rate):
+            self.count('slow_injected')
+            delay += self.slow_latency
+        return max(delay, 0)
+
+    def record_download(self, sheet_no):
+        with self.lock:
+            self.stats['downloads'] += 1
+            self.stats['downloaded'][sheet_no] = self.stats['downloaded'].get(sheet_no, 0) + 1
+            if self.outage_after > 0 and self.stats['downloads'] >= self.outage_after:
+                self.down = True
+
+    def record_listing(self, sess):
+        key = f'{sess.state}/{sess.dist}'
+        with self.lock:
+            pages = self.stats['listing_pages']
+            pages[key] = pages.get(key, 0) + 1
+
+    def get_stats(self):
+        with self.lock:
+            return json.loads(json.dumps(self.stats))
+
+    def restore(self):
+        with self.lock:
+            self.down = False
+            self.outage_after = 0
+
+    def render(self, sess, path, title, body):
+        token = sess.new_token()
+        return f'''<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml">
+<head><title>{escape(title)}</title></head>
+<body>
+<form method="post" action="./{path}" id="form1">
+<div class="aspNetHidden">
+<input type="hidden" name="__EVENTTARGET" id="__EVENTTARGET" value="" />
+<input type="hidden" name="__EVENTARGUMENT" id="__EVENTARGUMENT" value="" />
+<input type="hidden" name="__VIEWSTATE" id="__VIEWSTATE" value="{token}.{self.viewstate_blob}" />
+</div>
+<div class="aspNetHidden">
+<input type="hidden" name="__VIEWSTATEGENERATOR" id="__VIEWSTATEGENERATOR" value="{hashlib.md5(path.encode()).hexdigest()[:8].upper()}" />
+<input type="hidden" name="__EVENTVALIDATION" id="__EVENTVALIDATION" value="{base64.b64encode(token.encode()).decode()}" />
+</div>
+<div id="divMain">
+{body}
+</div>
+</form>
+</body>
+</html>
+'''
+
+    def error_page(self, sess):
+        body = f'<div class="errorHeading">{ERROR_TEXT}</div>\n<p>{APOLOGY_TEXT}</p>'
+        return self.render(sess, 'Errorpage.aspx', 'Error', body)
+
+    def product_show_page(self, sess, with_products):
+        radios = []
+        for idx, value in enumerate(['1', '5', '9', '12']):
+            n, i = ctl('rblDigitalProduct')
+            checked = ' checked="checked"' if with_products and value == '12' else ''
+            radios.append(f'<input id="{i}_{idx}" type="radio" name="{n}" value="{value}"{checked} />')
+        n, i = ctl('rblFormats')
+        radios.append(f'<input id="{i}_0" type="radio" name="{n}" value="All" checked="checked" />')
+        body = '\n'.join(radios)
+        if with_products:
+            body += '\n' + '\n'.join([
+                f'<div class="product">CMPDI {submit("ListViewSingleProduct$ctrl0$Button3", "View")} {submit("ListViewSingleProduct$ctrl0$Button4", "Click to Buy")}</div>',
+                f'<div class="product">NHP {submit("ListViewSingleProduct$ctrl1$Button3", "View")} {submit("ListViewSingleProduct$ctrl1$Button4", "Click to Buy")}</div>',
+            ])
+        return self.render(sess, 'Digital_Product_Show.aspx', 'Digital Products', body)
+
+    def listing_rows(self, sess, grid, available_only):
+        sheets = self.catalogue.get_listing(sess.state, sess.dist, available_only)
+        page_count = (len(sheets) + PAGE_SIZE - 1) // PAGE_SIZE
+        sess.page = min(max(sess.page, 1), max(page_count, 1))
+        page_sheets = sheets[(sess.page - 1) * PAGE_SIZE: sess.page * PAGE_SIZE]
+        return page_sheets, pager_row(grid, sess.page, page_count, 4)
+
+    def nhp_page(self, sess):
+        catalogue = self.catalogue
+        state_opts = [('0', '--Select State--')]
+        if sess.format == 'pdf':
+            state_opts += [ (k, v[0]) for k, v in catalogue.states.items() ]
+        dist_opts = [('0', '--Select District--')]
+        if sess.state in catalogue.states:
+            dist_opts += [('-1', 'All Districts')] + [ (k, v[0]) for k, v in catalogue.states[sess.state][1].items() ]
+        parts = [
+            select('ddlFormateTyoe', [('', '--Select--'), ('shp', 'Shape File'), ('pdf', 'PDF')], sess.format),
+            text_input('txtSheetNumber'),
+            postback_link('lbtnAddToCart', 'Add to Cart'),
+            postback_link('lbtnSheetNumber', 'Search by State'),
+            select('ddlstate', state_opts, sess.state),
+            select('ddldist', dist_opts, sess.dist),
+            select('ddlProductsType', [('', '--Select--'), ('pdf', 'PDF')], sess.ptype),
+            submit('btnViewCart', 'View Cart'),
+            span('lblMsg', sess.message, style='color:Green;'),
+        ]
+        if sess.ptype == 'pdf' and sess.dist in catalogue.states.get(sess.state, (None, {}))[1]:
+            page_sheets, pager = self.listing_rows(sess, 'GridView1', available_only=True)
+            rows = [ [str((sess.page - 1) * PAGE_SIZE + i + 1), escape(s), 'PDF', '0.00'] for i, s in enumerate(page_sheets) ]
+            parts.append(grid_table('GridView1', ['S.No.', 'Sheet Number', 'Format', 'Price'], rows, pager))
+        return self.render(sess, 'Product_Specification.aspx', 'NHP Product Specification', '\n'.join(parts))
+
+    def cmpdi_page(self, sess):
+        catalogue = self.catalogue
+        state_opts = [('0', '--Select State--')] + [ (k, v[0]) for k, v in catalogue.states.items() ]
+        dist_opts = [('0', '--Select--')]
+        if sess.state in catalogue.states:
+            dist_opts += [ (k, v[0]) for k, v in catalogue.states[sess.state][1].items() ]
+        parts = [
+            select('ddlstatelist', state_opts, sess.state),
+            select('ddlTownCoalfield', dist_opts, sess.dist),
+            select('ddlformatTypeproducts', [('', '--Select--'), ('pdf', 'PDF')], sess.format),
+            hidden('ddlstate', '0'),
+            hidden('ddldist', '0'),
+            span('lblMsg', sess.message, style='color:Green;'),
+        ]
+        sess.row_inputs = {}
+        if sess.format == 'pdf' and sess.dist in catalogue.states.get(sess.state, (None, {}))[1]:
+            page_sheets, pager = self.listing_rows(sess, 'GridViewPopup', available_only=False)
+            rows = []
+            for i, s in enumerate(page_sheets):
+                name = f'GridViewPopup$ctl{i + 2:02d}$chkSelect'
+                sess.row_inputs[CP + name] = s
+                rows.append([str((sess.page - 1) * PAGE_SIZE + i + 1), escape(s), 'PDF', checkbox(name, s in sess.selected)])
+            parts.append(grid_table('GridViewPopup', ['S.No.', 'Sheet Number', 'Format', 'Select'], rows, pager))
+            parts += [
+                submit('btnOkmulitySelects', 'OK'),
+                postback_link('lbtnMultiAddToCard', 'Add to Cart'),
+                f'<input type="image" name="{CP}ImageButton1" id="{CP_ID}ImageButton1" src="images/cart.png" />',
+                submit('btnViewCart', 'View Cart'),
+            ]
+        return self.render(sess, 'Product_Specification.aspx', 'CMPDI Product Specification', '\n'.join(parts))
+
+    def cart_page(self, sess):
+        rows = [ [str(i + 1), escape(s), 'PDF', '0.00'] for i, s in enumerate(sess.cart) ]
+        body = '\n'.join([
+            grid_table('gvCart', ['S.No.', 'Sheet Number', 'Format', 'Price'], rows),
+            hidden('HiddenField1'),
+            submit('btnplaceorder', 'Place Order'),
+        ])
+        return self.render(sess, 'Cart.aspx', 'Cart', body)
+
+    def terms_page(self, sess, agreed):
+        parts = [ hidden('HiddenField1') ]
+        if agreed:
+            rows = [[ '1', escape(sess.account or ''), submit('gvCustomers$ctl02$btnProceedDownload', 'Proceed for Download') ]]
+            parts.append(grid_table('gvCustomers', ['S.No.', 'Indenter', ''], rows))
+        else:
+            parts.append('<p>Terms and conditions for the use of the maps.</p>')
+            parts.append(submit('btnSubmitPrivateIndenter', 'I Agree'))
+        return self.render(sess, 'Terms.aspx', 'Terms and Conditions', '\n'.join(parts))
+
+    def orders_page(self, sess):
+        rows = []
+        for i, s in enumerate(sess.order):
+            prefix = f'gvOrders$ctl{i + 2:02d}'
+            rows.append([
+                str(i + 1), escape(s), escape(sess.order_state[s]),
+                submit(f'{prefix}$btnRequest', 'Request'),
+                submit(f'{prefix}$btnGenerateDownloadLink', 'Generate Download Link'),
+                submit(f'{prefix}$btnDownloadMap', 'Download'),
+            ])
+        parts = [ grid_table('gvOrders', ['S.No.', 'Sheet Number', 'Status', '', '', ''], rows) ]
+        for name in ['HiddenFieldOrder', 'HiddenFieldpointID', 'HiddenFieldMasterCode',
+                     'HiddenFieldStateCode', 'HiddenFieldDistrictCode', 'HiddenFieldProductCode']:
+            parts.append(hidden(name))
+        return self.render(sess, 'MyOrders.aspx', 'My Orders', '\n'.join(parts))
+
+    def free_map_page(self, sess, with_captcha, message_name=None, message=''):
+        parts = [
+            select('ddlstate', [('0', '--Select State--')], '0'),
+            select('ddldist', [('0', '--Select District--')], '0'),
+            text_input('txtSheetNumber', sess.free_sheet),
+            postback_link('lbtnDownloadMap', 'Download Map'),
+        ]
+        if with_captcha:
+            parts += [
+                f'<img id="{CP_ID}Image1" src="Captcha.aspx?t={sess.token_count}" alt="captcha" />',
+                text_input('txtCaptchaMtr'),
+                checkbox('CheckBox1'),
+                submit('Button_ok', 'OK'),
+            ]
+        for name in ['lblWrongCaptcha', 'lblSheetNotExist', 'msgbox_lblMsg']:
+            parts.append(span(name, message if name == message_name else ''))
+        return self.render(sess, 'FreeMapSpecification.aspx', 'Free Map Specification', '\n'.join(parts))
+
+    def handle_get(self, sess, path):
+        if path == 'Digital_Product_Show.aspx':
+            return self.product_show_page(sess, with_products=False)
+        if path == 'Product_Specification.aspx':
+            return self.cmpdi_page(sess) if sess.product == 'cmpdi' else self.nhp_page(sess)
+        if path == 'Cart.aspx':
+            return self.cart_page(sess)
+        if path == 'Terms.aspx':
+            return self.terms_page(sess, agreed=False)
+        if path == 'MyOrders.aspx':
+            return self.orders_page(sess)
+        if path == 'FreeMapSpecification.aspx':
+            sess.free_sheet = ''
+            return self.free_map_page(sess, with_captcha=False)
+        if path == 'Errorpage.aspx':
+            return self.error_page(sess)
+        return None
+
+    def handle_post(self, sess, path, form):
+        """
+        Returns ('page', html), ('redirect', path), ('file', (content_type, bytes)) or None.
+        """
+        target = form.get('__EVENTTARGET', '')
+        event = target[len(CP):] if target.startswith(CP) else target
+        argument = form.get('__EVENTARGUMENT', '')
+
+        if path == 'Digital_Product_Show.aspx':
+            for key in form:
+                m = re.match(r'^' + re.escape(CP) + r'ListViewSingleProduct\$ctrl(\d+)\$Button\d+$', key)
+                if m is not None:
+                    sess.product = 'cmpdi' if m.group(1) == '0' else 'nhp'
+                    sess.format, sess.state, sess.dist, sess.ptype, sess.page = '', '0', '0', '', 1
+                    return 'redirect', f'Product_Specification.aspx?p={sess.product}'
+            return 'page', self.product_show_page(sess, with_products=event.startswith('rblDigitalProduct'))
+
+        if path == 'Product_Specification.aspx':
+            if sess.product == 'cmpdi':
+                return self.post_cmpdi(sess, form, event, argument)
+            return self.post_nhp(sess, form, event, argument)
+
+        if path == 'Cart.aspx':
+            if CP + 'btnplaceorder' not in form:
+                return 'page', self.cart_page(sess)
+            cart = sess.cart
+            if len(cart) == 0 or not all(self.catalogue.is_available(s) for s in cart):
+                self.count('orders_refused')
+                if not self.keep_cart:
+                    sess.cart = []
+                return 'redirect', 'Errorpage.aspx'
+            sess.cart = []
+            self.count('orders')
+            sess.order = cart
+            sess.order_state = { s: 'Ordered' for s in cart }
+            return 'redirect', 'Terms.aspx'
+
+        if path == 'Terms.aspx':
+            if CP + 'gvCustomers$ctl02$btnProceedDownload' in form:
+                return 'redirect', 'MyOrders.aspx'
+            return 'page', self.terms_page(sess, agreed=CP + 'btnSubmitPrivateIndenter' in form)
+
+        if path == 'MyOrders.aspx':
+            return self.post_orders(sess, form)
+
+        if path == 'FreeMapSpecification.aspx':
+            return self.post_free_map(sess, form, event)
+
+        return None
+
+    def post_nhp(self, sess, form, event, argument):
+        sess.message = ''
+        if CP + 'btnViewCart' in form:
+            return 'redirect', 'Cart.aspx'
+        if event == 'ddlFormateTyoe':
+            sess.format = form.get(CP + 'ddlFormateTyoe', '')
+        elif event == 'lbtnAddToCart':
+            sheet_no = self.catalogue.lookup(form.get(CP + 'txtSheetNumber', ''))
+            if sheet_no is None:
+                # unknown sheets get into the cart as typed, the order is what fails
+                sheet_no = form.get(CP + 'txtSheetNumber', '')
+            if sheet_no != '' and sheet_no not in sess.cart:
+                sess.cart.append(sheet_no)
+            sess.message = f'Sheet {sheet_no} added to cart'
+        elif event == 'lbtnSheetNumber':
+            sess.format = 'pdf'
+            sess.state, sess.dist, sess.ptype = '0', '0', ''
+        elif event == 'ddlstate':
+            sess.state = form.get(CP + 'ddlstate', '0')
+            sess.dist, sess.ptype = '0', ''
+        elif event == 'ddldist':
+            sess.dist = form.get(CP + 'ddldist', '0')
+            sess.ptype = ''
+        elif event == 'ddlProductsType':
+            sess.ptype = form.get(CP + 'ddlProductsType', '')
+            sess.page = 1
+            self.record_listing(sess)
+        elif event == 'GridView1':
+            sheets = self.catalogue.get_listing(sess.state, sess.dist, available_only=True)
+            sess.page = get_page_number(argument, sess.page, (len(sheets) + PAGE_SIZE - 1) // PAGE_SIZE)
+            self.record_listing(sess)
+        return 'page', self.nhp_page(sess)
+
+    def post_cmpdi(self, sess, form, event, argument):
+        sess.message = ''
+        if event == 'ImageButton1' or CP + 'btnViewCart' in form:
+            return 'redirect', 'Cart.aspx'
+        checked = [ s for name, s in sess.row_inputs.items() if form.get(name) == 'on' ]
+        if CP + 'btnOkmulitySelects' in form:
+            sess.selected = checked
+        elif event == 'lbtnMultiAddToCard':
+            for s in sess.selected + checked:
+                if s not in sess.cart:
+                    sess.cart.append(s)
+            sess.message = f'{len(sess.cart)} sheets in the cart'
+        elif event == 'ddlstatelist':
+            sess.state = form.get(CP + 'ddlstatelist', '0')
+            sess.dist, sess.format = '0', ''
+        elif event == 'ddlTownCoalfield':
+            sess.dist = form.get(CP + 'ddlTownCoalfield', '0')
+            sess.format = ''
+        elif event == 'ddlformatTypeproducts':
+            sess.format = form.get(CP + 'ddlformatTypeproducts', '')
+            sess.page = 1
+            sess.selected = []
+            self.record_listing(sess)
+        elif event == 'GridViewPopup':
+            sheets = self.catalogue.get_listing(sess.state, sess.dist, available_only=False)
+            sess.page = get_page_number(argument, sess.page, (len(sheets) + PAGE_SIZE - 1) // PAGE_SIZE)
+            sess.selected = []
+            self.record_listing(sess)
+        return 'page', self.cmpdi_page(sess)
+
+    def post_orders(self, sess, form):
+        for key in form:
+            m = re.match(r'^' + re.escape(CP) + r'gvOrders\$ctl(\d+)\$(btnRequest|btnGenerateDownloadLink|btnDownloadMap)$', key)
+            if m is None:
+                continue
+            idx = int(m.group(1)) - 2
+            if idx < 0 or idx >= len(sess.order):
+                return 'redirect', 'Errorpage.aspx'
+            sheet_no = sess.order[idx]
+            state = sess.order_state[sheet_no]
+            button = m.group(2)
+            if button == 'btnRequest':
+                sess.order_state[sheet_no] = 'Requested'
+            elif button == 'btnGenerateDownloadLink':
+                if state not in ('Requested', 'Link Generated'):
+                    return 'redirect', 'Errorpage.aspx'
+                sess.order_state[sheet_no] = 'Link Generated'
+            else:
+                if state != 'Link Generated':
+                    return 'page', self.orders_page(sess)
+                if self.chance(self.html_rate):
+                    self.count('html_instead_of_zip')
+                    return 'page', self.orders_page(sess)
+                content = self.catalogue.get_zip(sheet_no)
+                if self.chance(self.truncate_rate):
+                    self.count('truncated')
+                    return 'file', (ZIP_TYPE, content[:len(content) // 2])
+                self.record_download(sheet_no)
+                return 'file', (ZIP_TYPE, content)
+            return 'page', self.orders_page(sess)
+        return 'page', self.orders_page(sess)
+
+    def post_free_map(self, sess, form, event):
+        sess.free_sheet = form.get(CP + 'txtSheetNumber', '')
+        if event == 'lbtnDownloadMap':
+            return 'page', self.free_map_page(sess, with_captcha=True)
+        if CP + 'Button_ok' not in form:
+            return 'page', self.free_map_page(sess, with_captcha=False)
+        if self.chance(self.captcha_fail_rate):
+            self.count('captcha_failures')
+            return 'page', self.free_map_page(sess, True, 'lblWrongCaptcha', CAPTCHA_FAILED_MSG)
+        if self.download_limit > 0 and sess.free_downloads >= self.download_limit:
+            self.count('limit_crossed')
+            return 'page', self.free_map_page(sess, True, 'msgbox_lblMsg', LIMIT_CROSSED_MSG)
+        sheet_no = self.catalogue.lookup(sess.free_sheet)
+        if not self.catalogue.is_available(sheet_no):
+            self.count('not_found')
+            return 'page', self.free_map_page(sess, True, 'lblSheetNotExist', NOT_FOUND_MSG)
+        sess.free_downloads += 1
+        self.record_download(sheet_no)
+        return 'file', (PDF_TYPE, self.catalogue.get_pdf(sheet_no))
+
+
+class PortalHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    portal = None
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_body(self, status, content_type, body, sess=None, new_cookie=False, location=None):
+        self.send_response(status)
+        if new_cookie and sess is not None:
+            self.send_header('Set-Cookie', f'{SESSION_COOKIE}={sess.sid}; path=/; HttpOnly')
+        if location is not None:
+            self.send_header('Location', location)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        portal = self.portal
+        url = urlsplit(self.path)
+        path = url.path.lstrip('/')
+        length = int(self.headers.get('Content-Length', '0'))
+        body = self.rfile.read(length) if length > 0 else b''
+
+        # the benchmark's own endpoints, left out of the counts
+        if path == '__stats':
+            return self.send_body(200, 'application/json', json.dumps(portal.get_stats()).encode())
+        if path == '__restore':
+            portal.restore()
+            return self.send_body(200, 'application/json', b'{}')
+
+        portal.count('requests')
+        time.sleep(portal.get_delay())
+        if portal.down:
+            portal.count('outage_responses')
+            return self.send_body(503, HTML_TYPE, b'<html><body>Service Unavailable</body></html>')
+
+        if path == 'Login.aspx' and method == 'POST':
+            # logins go through captchas and otps, the benchmark just names the account
+            form = { k: v[0] for k, v in parse_qs(body.decode('utf8'), keep_blank_values=True).items() }
+            portal.count('logins')
+            sess = portal.new_session(form.get('account'))
+            return self.send_body(200, HTML_TYPE, b'<html><body>logged in</body></html>', sess, new_cookie=True)
+
+        sess, new_cookie = portal.get_session(self)
+        # a visitor's requests are handled one at a time, like with the ASP.NET session lock
+        with sess.lock:
+            if method == 'GET':
+                page = portal.handle_get(sess, path)
+                if page is None:
+                    return self.send_body(404, HTML_TYPE, b'<html><body>Not Found</body></html>', sess, new_cookie)
+                return self.send_body(200, HTML_TYPE, page.encode('utf8'), sess, new_cookie)
+
+            portal.count('posts')
+            form = { k: v[0] for k, v in parse_qs(body.decode('utf8'), keep_blank_values=True).items() }
+            token = form.get('__VIEWSTATE', '').split('.', 1)[0]
+            if token not in sess.tokens:
+                portal.count('viewstate_rejected')
+                return self.send_body(500, HTML_TYPE, b'<html><body>Validation of viewstate MAC failed.</body></html>', sess, new_cookie)
+            if portal.chance(portal.error_rate):
+                portal.count('errors_injected')
+                return self.send_body(302, HTML_TYPE, b'', sess, new_cookie, location='/Errorpage.aspx')
+
+            ret = portal.handle_post(sess, path, form)
+            if ret is None:
+                return self.send_body(404, HTML_TYPE, b'<html><body>Not Found</body></html>', sess, new_cookie)
+            kind, value = ret
+            if kind == 'redirect':
+                return self.send_body(302, HTML_TYPE, b'', sess, new_cookie, location='/' + value)
+            if kind == 'file':
+                content_type, content = value
+                return self.send_body(200, content_type, content, sess, new_cookie)
+            return self.send_body(200, HTML_TYPE, value.encode('utf8'), sess, new_cookie)
+
+
+def add_portal_args(parser):
+    group = parser.add_argument_group('mock portal')
+    group.add_argument('--sheets', help='number of sheets the portal knows about', type=int, default=40)
+    group.add_argument('--unavailable-ratio', help='share of the sheets which can not be ordered', type=float, default=0.1)
+    group.add_argument('--states', help='number of states in the listings', type=int, default=2)
+    group.add_argument('--districts', help='number of districts per state in the listings', type=int, default=2)
+    group.add_argument('--pdf-size', help='size of each pdf in bytes', type=int, default=256 * 1024)
+    group.add_argument('--viewstate-size', help='size of the __VIEWSTATE on each page in bytes', type=int, default=40000)
+    group.add_argument('--latency', help='seconds taken by each response', type=float, default=0.05)
+    group.add_argument('--jitter', help='random seconds added to or taken from the latency', type=float, default=0.0)
+    group.add_argument('--slow-rate', help='share of responses which are slow', type=float, default=0.0)
+    group.add_argument('--slow-latency', help='seconds added to the slow responses', type=float, default=5.0)
+    group.add_argument('--error-rate', help='share of posts sent to Errorpage.aspx', type=float, default=0.0)
+    group.add_argument('--captcha-fail-rate', help='share of free map captchas rejected', type=float, default=0.0)
+    group.add_argument('--html-rate', help='share of zip downloads answered with a page', type=float, default=0.0)
+    group.add_argument('--truncate-rate', help='share of zip downloads cut short', type=float, default=0.0)
+    group.add_argument('--download-limit', help='free map downloads per login, 0 for no limit', type=int, default=0)
+    group.add_argument('--outage-after', help='answer 503 after this many downloads, until restored, 0 for never', type=int, default=0)
+    group.add_argument('--keep-cart', help='leave the cart as it was after a refused order', action='store_true')
+    group.add_argument('--seed', help='seed for the catalogue and the injected faults', type=int, default=0)
+
+def get_catalogue(args):
+    return Catalogue(args.sheets, args.unavailable_ratio, args.states, args.districts, args.pdf_size, args.seed)
+
+def get_portal(args):
+    return MockPortal(get_catalogue(args), latency=args.latency, jitter=args.jitter,
+                      slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                      error_rate=args.error_rate, captcha_fail_rate=args.captcha_fail_rate,
+                      html_rate=args.html_rate, truncate_rate=args.truncate_rate,
+                      download_limit=args.download_limit, outage_after=args.outage_after, keep_cart=args.keep_cart,
+                      viewstate_size=args.viewstate_size, seed=args.seed)
+
+def get_portal_argv(args):
+    argv = []
+    for action in ('sheets', 'unavailable_ratio', 'states', 'districts', 'pdf_size', 'viewstate_size',
+                   'latency', 'jitter', 'slow_rate', 'slow_latency', 'error_rate', 'captcha_fail_rate',
+                   'html_rate', 'truncate_rate', 'download_limit', 'outage_after', 'seed'):
+        argv += [ '--' + action.replace('_', '-'), str(getattr(args, action)) ]
+    if args.keep_cart:
+        argv.append('--keep-cart')
+    return argv
+
+def serve(portal, host='127.0.0.1', port=0):
+    handler = type('Handler', (PortalHandler,), { 'portal': portal })
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+def start_portal(args):
+    """
+    Runs the portal in a process of its own, so that it doesn't take cpu from
+    the scraper being measured. Returns the process and the base url.
+    """
+    cmd = [ sys.executable, str(Path(__file__).resolve()), '--port', '0' ] + get_portal_argv(args)
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, text=True)
+    line = proc.stdout.readline().strip()
+    if not line.startswith('http'):
+        proc.kill()
+        raise Exception(f'mock portal failed to start: {line}')
+    return proc, line
+
+def stop_portal(proc):
+    proc.terminate()
+    proc.wait(timeout=10)
+
+def call_portal(base_url, endpoint, post=False):
+    req = Request(base_url + endpoint, data=b'' if post else None)
+    with urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read())
+
+def get_ledger_rows(ledger_file):
+    if not Path(ledger_file).exists():
+        return {}
+    conn = sqlite3.connect(f'file:{ledger_file}?mode=ro', uri=True)
+    try:
+        rows = conn.execute("""
+            SELECT s.sheet, s.status, a.sha256, a.size FROM sheets s LEFT JOIN attempts a ON a.id = s.attempt_id
+        """).fetchall()
+    finally:
+        conn.close()
+    return { sheet: (status, sha256, size) for sheet, status, sha256, size in rows }
+
+def verify_downloads(catalogue, sheet_list, ledger_file, raw_dir, zipped=True):
+    """
+    Checks the ledger and the files in raw_dir against what the portal has,
+    for the sheets in sheet_list. A sheet is ok when it is downloaded with the
+    exact bytes and the hash of what was served, or when it is recorded
+    unavailable and is. Sheets left without an outcome are counted as missing.
+    """
+    rows = get_ledger_rows(ledger_file)
+    raw_dir = Path(raw_dir)
+    problems = []
+    counts = { 'ok': 0, 'missing': 0, 'wrong_status': 0, 'bad_file': 0, 'bad_hash': 0, 'stray_files': 0 }
+    for sheet_no in sheet_list:
+        status, sha256, size = rows.get(sheet_no, (None, None, None))
+        available = catalogue.is_available(catalogue.lookup(sheet_no))
+        out_file = raw_dir / f'{sheet_no}.pdf'
+        if status is None:
+            counts['missing'] += 1
+            if out_file.exists():
+                counts['stray_files'] += 1
+                problems.append(f'{sheet_no}: pdf on disk but not in the ledger')
+            continue
+        if status == 'downloaded' and available:
+            if not out_file.exists() or out_file.read_bytes() != catalogue.get_pdf(sheet_no):
+                counts['bad_file'] += 1
+                problems.append(f'{sheet_no}: recorded downloaded but the pdf is missing or wrong')
+                continue
+            served = catalogue.get_zip(sheet_no) if zipped else catalogue.get_pdf(sheet_no)
+            if sha256 != hashlib.sha256(served).hexdigest():
+                counts['bad_hash'] += 1
+                problems.append(f'{sheet_no}: recorded sha256 {sha256} is not that of the download')
+                continue
+            counts['ok'] += 1
+        elif status == 'unavailable' and not available:
+            counts['ok'] += 1
+        else:
+            counts['wrong_status'] += 1
+            problems.append(f'{sheet_no}: recorded {status} but the portal has it {"available" if available else "unavailable"}')
+    partials = list(raw_dir.glob('*.part')) if raw_dir.exists() else []
+    counts['partial_files'] = len(partials)
+    problems += [ f'{p.name}: partial file left behind' for p in partials ]
+    return counts, problems
+
+class RunTimeout(Exception):
+    pass
+
+
+def mock_login(module, url, phone_num):
+    # stands in for login_wrap, the portal only needs to know the account
+    resp = module.session.post(url + 'Login.aspx', data={ 'account': phone_num })
+    if not resp.ok:
+        raise Exception(f'Unable to log in to the mock portal as {phone_num}')
+
+def point_at_portal(module, url, time_scale=1.0):
+    """
+    Sends a scraper module to the portal at url instead of the live one. The
+    logins, which need captchas and otps, are replaced with a post naming the
+    account and the cooldowns meant for the live portal are scaled.
+    """
+    module.base_url = url
+    module.login_wrap = lambda phone_num, password, otp_from_pb: mock_login(module, url, phone_num)
+    if hasattr(module, 'get_captcha_from_page'):
+        # which captchas fail is up to the portal
+        module.get_captcha_from_page = lambda soup: '00000'
+    if hasattr(module, 'COOLDOWN_BASE'):
+        module.COOLDOWN_BASE *= time_scale
+        module.COOLDOWN_MAX *= time_scale
+
+def get_accounts(count):
+    return { f'90000{i:05d}': 'password' for i in range(count) }
+
+def on_timeout(signum, frame):
+    raise RunTimeout('run timed out')
+
+def run_with_timeout(fn, timeout):
+    signal.signal(signal.SIGALRM, on_timeout)
+    signal.alarm(timeout)
+    try:
+        fn()
+        return None
+    except RunTimeout as ex:
+        for p in multiprocessing.active_children():
+            p.terminate()
+        return str(ex)
+    except Exception as ex:
+        logger.exception(ex)
+        return f'{type(ex).__name__}: {ex}'
+    finally:
+        signal.alarm(0)
+
+def diff_counts(after, before):
+    return { k: v - before.get(k, 0) for k, v in after.items() if v - before.get(k, 0) > 0 }
+
+def get_sheet_repeats(served, before):
+    # a sheet already downloaded shouldn't be fetched again, any other at most once
+    repeats = 0
+    for sheet_no, count in served.items():
+        allowed = 0 if before.get(sheet_no, (None,))[0] == 'downloaded' else 1
+        repeats += max(count - allowed, 0)
+    return repeats
+
+def get_run_record(run, elapsed, stats, stats_before, new_done, repeats, error):
+    return {
+        'run': run,
+        'elapsed': elapsed,
+        'new_done': new_done,
+        'sheets_per_hour': new_done / elapsed * 3600 if elapsed > 0 else 0,
+        'requests': stats['requests'] - stats_before['requests'],
+        'downloads': stats['downloads'] - stats_before['downloads'],
+        'repeats': repeats,
+        'errors_injected': stats['errors_injected'] - stats_before['errors_injected'],
+        'viewstate_rejected': stats['viewstate_rejected'] - stats_before['viewstate_rejected'],
+        'error': error,
+    }
+
+def bench_sheet_runs(args, url, ledger_file, sheet_list, scrape_fn):
+    """
+    Runs scrape_fn args.runs times against the portal, the outage is lifted
+    between runs. Sheets finished in a run are those which got an outcome in
+    the ledger during it, repeats are downloads of sheets which had one
+    already, or more than one download of a sheet in the same run.
+    """
+    runs = []
+    for run in range(1, args.runs + 1):
+        if run > 1:
+            call_portal(url, '__restore', post=True)
+        before = get_ledger_rows(ledger_file)
+        stats_before = call_portal(url, '__stats')
+        start = time.time()
+        error = run_with_timeout(scrape_fn, args.timeout)
+        elapsed = time.time() - start
+        stats = call_portal(url, '__stats')
+        after = get_ledger_rows(ledger_file)
+        new_done = len([ x for x in sheet_list if x in after and x not in before ])
+        repeats = get_sheet_repeats(diff_counts(stats['downloaded'], stats_before['downloaded']), before)
+        runs.append(get_run_record(run, elapsed, stats, stats_before, new_done, repeats, error))
+        if error is not None:
+            logger.warning(f'run {run} ended with {error}')
+    return runs
+
+def add_bench_args(parser):
+    parser.add_argument('--accounts', help='number of accounts to log in with', type=int, default=1)
+    parser.add_argument('--runs', help='number of runs over the same ledger, the later ones check resuming', type=int, default=2)
+    parser.add_argument('--timeout', help='seconds allowed for each run', type=int, default=1800)
+    parser.add_argument('--time-scale', help='factor for the cooldowns and backoffs meant for the live portal', type=float, default=1.0)
+    parser.add_argument('--work-dir', help='directory for the data dir of the runs, a new temp dir by default')
+    parser.add_argument('--report-file', help='append the report as a json line to this file')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    add_portal_args(parser)
+
+def run_bench(args, name, bench_fn):
+    """
+    Starts the portal, moves to the work dir and calls bench_fn(url), which
+    returns the report. Exits with 1 when the ledger check found problems.
+    """
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    # read when rate_limit is imported, in this process and in the spawned ones
+    for env_name, value in [('BACKOFF_BASE', 30), ('BACKOFF_MAX', 960)]:
+        os.environ.setdefault(env_name, str(value * args.time_scale))
+    report_file = Path(args.report_file).resolve() if args.report_file is not None else None
+
+    proc, url = start_portal(args)
+    try:
+        work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix=f'bench_{name}_'))
+        work_dir.mkdir(parents=True, exist_ok=True)
+        print(f'mock portal at {url}, working in {work_dir}')
+        os.chdir(work_dir)
+        os.environ[PORTAL_URL_ENV] = url
+        os.environ[TIME_SCALE_ENV] = str(args.time_scale)
+        report = bench_fn(url)
+    finally:
+        stop_portal(proc)
+
+    report['scraper'] = name
+    report['args'] = vars(args)
+    print_report(report)
+    if report_file is not None:
+        save_report(report, report_file)
+    if len(report['problems']) > 0:
+        sys.exit(1)
+
+def print_report(report):
+    print()
+    print(f'{"run":>4} {"secs":>8} {"new done":>9} {"sheets/hour":>12} {"requests":>9} {"downloads":>10} {"repeats":>8} {"errors":>7}')
+    for run in report['runs']:
+        print(f'{run["run"]:>4} {run["elapsed"]:>8.1f} {run["new_done"]:>9} {run["sheets_per_hour"]:>12.0f} '
+              f'{run["requests"]:>9} {run["downloads"]:>10} {run["repeats"]:>8} {run["errors_injected"]:>7}')
+        if run['viewstate_rejected'] > 0:
+            print(f'     {run["viewstate_rejected"]} posts rejected for a __VIEWSTATE the portal never gave out')
+        if run['error'] is not None:
+            print(f'     ended with {run["error"]}')
+    print()
+    print('ledger check: ' + ', '.join(f'{k} {v}' for k, v in report['check'].items()))
+    for p in report['problems'][:20]:
+        print(f'  {p}')
+    if len(report['problems']) > 20:
+        print(f'  ... and {len(report["problems"]) - 20} more')
+
+def save_report(report, report_file):
+    report_file = Path(report_file)
+    report_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_file, 'a') as f:
+        f.write(json.dumps(report) + '\n')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='serve a local stand-in for the SOI online maps portal')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    add_portal_args(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    portal = get_portal(args)
+    server = serve(portal, args.host, args.port)
+    host, port = server.server_address[:2]
+    # the first line is read by start_portal()
+    print(f'http://{host}:{port}/', flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(portal.get_stats(), indent=2), file=sys.stderr)
@@ -0,0 +1,214 @@
+import os
+import json
+import time
+import random
+import logging
+import threading
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# requests per second, the rate starts at RATE_START and moves between RATE_MIN and RATE_MAX
+RATE_START = float(os.environ.get('RATE_START', '1'))
+RATE_MIN = float(os.environ.get('RATE_MIN', '0.1'))
+RATE_MAX = float(os.environ.get('RATE_MAX', '4'))
+# added to the rate after every healthy response
+RATE_STEP = 0.05
+# the rate is multiplied by these on an error page and on a slow response
+ERROR_FACTOR = 0.5
+SLOW_FACTOR = 0.9
+# a response is slow when it takes this many times the usual latency
+SLOW_LATENCY_RATIO = 2.0
+# weight of the latest response in the usual latency
+LATENCY_ALPHA = 0.1
+# pause after an error page, doubling for every further error in a row
+BACKOFF_BASE = float(os.environ.get('BACKOFF_BASE', '30'))
+BACKOFF_MAX = float(os.environ.get('BACKOFF_MAX', '960'))
+REPORT_EVERY = 100
+
+RATE_STATS_FILE = Path(os.environ.get('RATE_STATS_FILE', 'data/rate_stats.jsonl'))
+
+ERROR_PAGE = '/Errorpage.aspx'
+
+
+def get_shared_field(index):
+    def get(self):
+        return self.state[index]
+    def set(self, value):
+        self.state[index] = value
+    return property(get, set)
+
+
+def get_backoff(count, base=BACKOFF_BASE, max_delay=BACKOFF_MAX):
+    """
+    Exponential backoff for the count'th failure in a row, with jitter so that
+    sessions which failed together don't come back together.
+    """
+    delay = min(base * 2 ** (max(count, 1) - 1), max_delay)
+    return delay * random.uniform(0.5, 1.0)
+
+
+class RateLimiter:
+    """
+    Token bucket, holding at most one token, for the requests to a host. The rate
+    goes up slowly while the responses come back fine and quick, and is cut on
+    error pages and slow responses. Error pages also pause all requests for an
+    exponentially growing time.
+
+    Call wait() before each request and add on_response() to the response hooks
+    of the session doing them. Processes hitting the same host share one bucket,
+    made with share() in the parent and passed to attach() in each child.
+    """
+    def __init__(self, name, rate=RATE_START, min_rate=RATE_MIN, max_rate=RATE_MAX):
+        self.name = name
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.state = [rate, 1.0, time.monotonic(), 0.0, 0]
+        self.lock = threading.RLock()
+        self.latency = None
+
+        self.start = time.time()
+        self.request_count = 0
+        self.error_count = 0
+        self.slow_count = 0
+        self.total_latency = 0.0
+        self.total_wait = 0.0
+
+    # the part of the limiter which share() puts in shared memory
+    rate = get_shared_field(0)
+    tokens = get_shared_field(1)
+    last_refill = get_shared_field(2)
+    paused_until = get_shared_field(3)
+    errors_in_row = get_shared_field(4)
+
+    def share(self, ctx):
+        """
+        Moves the bucket, the pause and the errors in a row to shared memory made
+        with the multiprocessing context ctx, returns it for attach().
+        """
+        state = ctx.Array('d', [ float(x) for x in self.state ])
+        self.attach(state)
+        return state
+
+    def attach(self, state):
+        self.state = state
+        # the lock of the array is reentrant
+        self.lock = state.get_lock()
+
+    def refill(self):
+        with self.lock:
+            # monotonic time is the same clock in all processes
+            now = time.monotonic()
+            self.tokens = min(1.0, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+    def wait(self):
+        start = time.monotonic()
+        while True:
+            with self.lock:
+                pause = self.paused_until - time.monotonic()
+                if pause <= 0:
+                    # the token is taken now, going into debt if there isn't one,
+                    # so that the sleep can happen without holding the lock
+                    self.refill()
+                    self.tokens -= 1.0
+                    delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+                    break
+            logger.info(f'{self.name}: backing off for {pause:.0f} secs')
+            time.sleep(pause)
+        if delay > 0:
+            time.sleep(delay)
+        self.total_wait += time.monotonic() - start
+
+    def on_response(self, resp, *args, **kwargs):
+        # called for each response of a redirect chain, the error page shows up on its own
+        is_error = ERROR_PAGE in str(resp.url)
+        self.record(resp.elapsed.total_seconds(), is_error)
+
+    def record(self, latency, is_error=False):
+        self.request_count += 1
+        self.total_latency += latency
+        if is_error:
+            self.failed()
+        elif self.latency is not None and latency > SLOW_LATENCY_RATIO * self.latency:
+            self.slow_count += 1
+            with self.lock:
+                self.set_rate(self.rate * SLOW_FACTOR)
+        else:
+            with self.lock:
+                self.errors_in_row = 0
+                self.set_rate(self.rate + RATE_STEP)
+
+        if not is_error:
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency += LATENCY_ALPHA * (latency - self.latency)
+
+        if self.request_count % REPORT_EVERY == 0:
+            self.report()
+
+    def failed(self):
+        """
+        For errors the response hook can't see, like an error message on a normal page.
+        """
+        self.error_count += 1
+        with self.lock:
+            self.errors_in_row += 1
+            self.set_rate(self.rate * ERROR_FACTOR)
+            backoff = get_backoff(int(self.errors_in_row))
+            self.paused_until = max(self.paused_until, time.monotonic() + backoff)
+        logger.warning(f'{self.name}: error page, rate down to {self.rate:.2f} req/s, pausing for {backoff:.0f} secs')
+
+    def rest(self, delay):
+        """
+        Sleeps for delay between retries, or until the pause ends if that is later.
+        The retries are counted by the caller, the errors in a row of the limiter are
+        reset by the healthy responses of the retries themselves.
+        """
+        delay = max(delay, self.paused_until - time.monotonic())
+        logger.warning(f'{self.name}: resting for {delay:.0f} secs')
+        time.sleep(delay)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = min(max(rate, self.min_rate), self.max_rate)
+
+    def get_stats(self):
+        elapsed = time.time() - self.start
+        return {
+            'name': self.name,
+            'pid': os.getpid(),
+            'time': self.start,
+            'elapsed': elapsed,
+            'requests': self.request_count,
+            'errors': self.error_count,
+            'slow': self.slow_count,
+            'achieved_rate': self.request_count / elapsed if elapsed > 0 else 0,
+            'current_rate': self.rate,
+            'mean_latency': self.total_latency / self.request_count if self.request_count > 0 else None,
+            'usual_latency': self.latency,
+            'total_wait': self.total_wait,
+        }
+
+    def report(self):
+        stats = self.get_stats()
+        mean_latency = stats['mean_latency'] or 0
+        logger.info(f'{self.name}: {stats["requests"]} requests, {stats["errors"]} errors, '
+                    f'achieved {stats["achieved_rate"]:.2f} req/s, current {self.rate:.2f} req/s, '
+                    f'mean latency {mean_latency:.2f} secs, waited {self.total_wait:.0f} secs')
+
+    def save(self, stats_file=RATE_STATS_FILE):
+        if self.request_count == 0:
+            return
+        self.report()
+        stats_file = Path(stats_file)
+        stats_file.parent.mkdir(parents=True, exist_ok=True)
+        # a single append per run keeps lines whole when several scrapers share the file
+        line = json.dumps(self.get_stats()) + '\n'
+        fd = os.open(stats_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf8'))
+        finally:
+            os.close(fd)
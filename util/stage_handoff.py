@@ -0,0 +1,140 @@
+import os
+import json
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# also write each handed off raster as <name>.jpg in the workdir, for looking at
+HANDOFF_JPEG = os.environ.get('HANDOFF_JPEG', '0') == '1'
+
+MANIFEST_FILE_NAME = 'handoff.json'
+
+# rows copied at a time
+COPY_ROWS = 512
+
+# opencv keeps the channels as BGR
+BAND_CHANNELS = {
+    1: [ (0, 'Gray') ],
+    3: [ (2, 'Red'), (1, 'Green'), (0, 'Blue') ],
+}
+
+VRT_BAND_TEMPLATE = """  <VRTRasterBand dataType="Byte" band="{band}" subClass="VRTRawRasterBand">
+    <ColorInterp>{color_interp}</ColorInterp>
+    <SourceFilename relativeToVRT="1">{source}</SourceFilename>
+    <ImageOffset>{image_offset}</ImageOffset>
+    <PixelOffset>{pixel_offset}</PixelOffset>
+    <LineOffset>{line_offset}</LineOffset>
+  </VRTRasterBand>
+"""
+
+
+class StageHandoff:
+    """
+    Rasters passed from one stage of a sheet to the next. Each is kept as an
+    uncompressed .npy file in the workdir, read back memory mapped, and listed in
+    a manifest once it is complete, so that a rerun can tell finished outputs from
+    partial ones. GDAL reads them through a vrt over the raw pixels, so nothing
+    goes through a lossy jpeg on the way.
+    """
+    def __init__(self, workdir):
+        self.workdir = Path(workdir)
+        self.manifest_file = self.workdir / MANIFEST_FILE_NAME
+
+    def load_manifest(self):
+        if not self.manifest_file.exists():
+            return {}
+        return json.loads(self.manifest_file.read_text())
+
+    def save_manifest(self, manifest):
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        temp_file = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+        temp_file.write_text(json.dumps(manifest, indent=4))
+        os.replace(temp_file, self.manifest_file)
+
+    def get_file(self, name):
+        return self.workdir / f'{name}.stage.npy'
+
+    def get_gdal_file(self, name):
+        return self.workdir / f'{name}.stage.vrt'
+
+    def has(self, name):
+        entry = self.load_manifest().get(name)
+        if entry is None:
+            return False
+        raster_file = self.get_file(name)
+        return raster_file.exists() and raster_file.stat().st_size == entry['size']
+
+    def get(self, name):
+        # copy on write, changes made by the caller don't go back to the file
+        return np.load(str(self.get_file(name)), mmap_mode='c')
+
+    def get_shape(self, name):
+        return tuple(self.load_manifest()[name]['shape'])
+
+    def find(self, gdal_file):
+        gdal_file = Path(gdal_file)
+        for name in self.load_manifest().keys():
+            if self.get_gdal_file(name) == gdal_file:
+                return name
+        return None
+
+    def create(self, name, shape):
+        """
+        Returns a writable memory map for name, commit() it once it is filled in.
+        """
+        self.remove(name)
+        self.workdir.mkdir(parents=True, exist_ok=True)
+        return np.lib.format.open_memmap(str(self.get_file(name)), mode='w+', dtype=np.uint8, shape=shape)
+
+    def write_vrt(self, name, raster):
+        h, w = raster.shape[:2]
+        num_bands = 1 if raster.ndim == 2 else raster.shape[2]
+        if num_bands not in BAND_CHANNELS:
+            raise Exception(f'unable to describe a raster with {num_bands} channels to gdal')
+        bands = ''
+        for band, (channel, color_interp) in enumerate(BAND_CHANNELS[num_bands]):
+            bands += VRT_BAND_TEMPLATE.format(band=band + 1,
+                                              color_interp=color_interp,
+                                              source=self.get_file(name).name,
+                                              image_offset=raster.offset + channel,
+                                              pixel_offset=num_bands,
+                                              line_offset=w * num_bands)
+        vrt = f'<VRTDataset rasterXSize="{w}" rasterYSize="{h}">\n{bands}</VRTDataset>\n'
+        self.get_gdal_file(name).write_text(vrt)
+
+    def commit(self, name):
+        raster = np.load(str(self.get_file(name)), mmap_mode='r')
+        self.write_vrt(name, raster)
+        manifest = self.load_manifest()
+        manifest[name] = {
+            'shape': list(raster.shape),
+            'size': self.get_file(name).stat().st_size,
+        }
+        self.save_manifest(manifest)
+        if HANDOFF_JPEG:
+            jpeg_file = self.workdir / f'{name}.jpg'
+            print(f'writing {jpeg_file}')
+            cv2.imwrite(str(jpeg_file), raster)
+
+    def put(self, name, img):
+        out = self.create(name, img.shape)
+        for y in range(0, img.shape[0], COPY_ROWS):
+            out[y:y+COPY_ROWS] = img[y:y+COPY_ROWS]
+        out.flush()
+        del out
+        self.commit(name)
+
+    def remove(self, name):
+        manifest = self.load_manifest()
+        if name in manifest:
+            del manifest[name]
+            self.save_manifest(manifest)
+        self.get_file(name).unlink(missing_ok=True)
+        self.get_gdal_file(name).unlink(missing_ok=True)
+
+    def clear(self):
+        # partially written rasters aren't in the manifest, so go by the file names
+        for f in list(self.workdir.glob('*.stage.npy')) + list(self.workdir.glob('*.stage.vrt')):
+            f.unlink()
+        self.manifest_file.unlink(missing_ok=True)
@@ -0,0 +1,204 @@
+import os
+import json
+import hashlib
+import functools
+from pathlib import Path
+from importlib import metadata
+
+# outside the workdir, which is removed once a sheet is exported
+MANIFEST_DIR = Path(os.environ.get('STAGE_MANIFEST_DIR', 'data/stage_manifests'))
+MANIFEST_VERSION = 1
+
+
+def get_file_hash(filepath):
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+    return h.hexdigest()
+
+def get_json_hash(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True, default=str).encode('utf8')).hexdigest()
+
+def get_code_version(code_version):
+    """
+    CODE_VERSION from the environment if set, otherwise code_version, which is
+    bumped by hand when the output changes, along with the installed
+    topo-map-processor version. Edits that don't change the output leave the
+    finished sheets alone.
+    """
+    version = os.environ.get('CODE_VERSION', None)
+    if version is not None:
+        return version
+    try:
+        return f'{code_version}+tmp-{metadata.version("topo-map-processor")}'
+    except metadata.PackageNotFoundError:
+        return str(code_version)
+
+
+class StageManifest:
+    """
+    Per sheet record of the completed stages, each with a fingerprint of the
+    input pdf, the code version and the parameters of that stage and the ones
+    before it. invalidate() deletes the outputs of the first stage whose
+    fingerprint doesn't match anymore and of all the stages after it, the
+    usual exists() checks then rerun just those.
+
+    stage_params is the ordered list of (stage name, parameter names first used
+    by that stage). Parameters not listed are taken to affect the first stage.
+    """
+    def __init__(self, sheet_id, pdf_path, params, stage_params, code_version, manifest_dir=MANIFEST_DIR):
+        self.sheet_id = sheet_id
+        self.pdf_path = Path(pdf_path)
+        self.params = params
+        self.stage_params = stage_params
+        self.stage_names = [ name for name, _ in stage_params ]
+        self.code_version = code_version
+        self.manifest_file = Path(manifest_dir) / f'{sheet_id}.json'
+        self.fingerprints = None
+
+    def load(self):
+        if not self.manifest_file.exists():
+            return None
+        manifest = json.loads(self.manifest_file.read_text())
+        if manifest.get('version') != MANIFEST_VERSION:
+            return None
+        return manifest
+
+    def save(self, manifest):
+        self.manifest_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = self.manifest_file.with_name(self.manifest_file.name + '.tmp')
+        temp_file.write_text(json.dumps(manifest, indent=4))
+        os.replace(temp_file, self.manifest_file)
+
+    def get_pdf_info(self, manifest):
+        # the hash is only recomputed when the file looks changed
+        stat = self.pdf_path.stat()
+        pdf_info = manifest.get('pdf') if manifest is not None else None
+        if pdf_info is not None and pdf_info['size'] == stat.st_size and pdf_info['mtime_ns'] == stat.st_mtime_ns:
+            return pdf_info
+        return { 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': get_file_hash(self.pdf_path) }
+
+    def get_fingerprints(self, pdf_hash):
+        known = set()
+        for _, names in self.stage_params:
+            known.update(names)
+
+        stage_params = {}
+        for i, (stage, names) in enumerate(self.stage_params):
+            names = list(names)
+            if i == 0:
+                names += [ k for k in self.params.keys() if k not in known ]
+            stage_params[stage] = { k: self.params[k] for k in names if k in self.params }
+
+        fingerprints = {}
+        upstream = {}
+        for stage in self.stage_names:
+            upstream.update(stage_params[stage])
+            fingerprints[stage] = get_json_hash([ pdf_hash, self.code_version, upstream ])
+        return fingerprints
+
+    def invalidate(self, stage_outputs):
+        """
+        stage_outputs maps each stage name to the files it writes. Returns the
+        name of the first stage that has to be rerun, None if all are current.
+        """
+        manifest = self.load()
+        pdf_info = self.get_pdf_info(manifest)
+        self.fingerprints = self.get_fingerprints(pdf_info['sha256'])
+
+        if manifest is None:
+            # no record yet, whatever is already on disk is taken as current
+            print(f'no stage manifest for {self.sheet_id}, adopting the existing outputs')
+            self.save({
+                'version': MANIFEST_VERSION,
+                'pdf': pdf_info,
+                'stages': { stage: self.fingerprints[stage] for stage in self.stage_names
+                            if any(Path(f).exists() for f in stage_outputs.get(stage, [])) },
+            })
+            return None
+
+        first_invalid = None
+        for i, stage in enumerate(self.stage_names):
+            recorded = manifest['stages'].get(stage)
+            if recorded is None:
+                # not run, or its outputs were cleaned up along with the workdir,
+                # anything left on disk is from an interrupted run
+                if any(Path(f).exists() for f in stage_outputs.get(stage, [])):
+                    first_invalid = i
+                    break
+                continue
+            if recorded != self.fingerprints[stage]:
+                first_invalid = i
+                break
+
+        manifest['pdf'] = pdf_info
+        if first_invalid is None:
+            self.save(manifest)
+            return None
+
+        print(f'stage {self.stage_names[first_invalid]} of {self.sheet_id} is out of date, clearing it and the stages after it')
+        self.remove_stages(manifest, stage_outputs, self.stage_names[first_invalid])
+        self.save(manifest)
+        return self.stage_names[first_invalid]
+
+    def remove_stages(self, manifest, stage_outputs, first_stage):
+        for stage in self.stage_names[self.stage_names.index(first_stage):]:
+            manifest['stages'].pop(stage, None)
+            for f in stage_outputs.get(stage, []):
+                f = Path(f)
+                if f.exists():
+                    print(f'deleting {f}')
+                    f.unlink()
+
+    def clear(self, stage_outputs, first_stage):
+        """
+        Deletes the outputs of first_stage and of the stages after it, so that
+        the next run does them again.
+        """
+        manifest = self.load()
+        if manifest is None:
+            manifest = { 'version': MANIFEST_VERSION, 'stages': {} }
+        print(f'clearing stage {first_stage} of {self.sheet_id} and the stages after it')
+        self.remove_stages(manifest, stage_outputs, first_stage)
+        if 'pdf' in manifest:
+            self.save(manifest)
+
+    def is_current(self):
+        """
+        Whether the recorded stages were made with the current code and
+        parameters. The pdf hash is taken from the record, so the pdf isn't
+        needed. A sheet without a record counts as current.
+        """
+        manifest = self.load()
+        if manifest is None or 'pdf' not in manifest:
+            return True
+        fingerprints = self.get_fingerprints(manifest['pdf']['sha256'])
+        return all(fingerprints.get(stage) == recorded for stage, recorded in manifest['stages'].items())
+
+    def record(self, stage):
+        manifest = self.load()
+        if manifest['stages'].get(stage) == self.fingerprints[stage]:
+            return
+        manifest['stages'][stage] = self.fingerprints[stage]
+        self.save(manifest)
+
+    def instrument(self, processor):
+        # instance attributes shadow the methods, so calls from inside the
+        # processor go through the wrappers as well
+        for stage in self.stage_names:
+            method = getattr(processor, stage, None)
+            if method is None:
+                continue
+            setattr(processor, stage, self.wrap(stage, method))
+
+    def wrap(self, stage, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            ret = method(*args, **kwargs)
+            self.record(stage)
+            return ret
+        return wrapper
@@ -0,0 +1,242 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = []
+# ///
+
+import os
+import json
+import time
+import resource
+import functools
+from pathlib import Path
+
+STATS_FILE = Path(os.environ.get('STAGE_STATS_FILE', 'data/stage_stats.jsonl'))
+
+
+def get_cpu_time():
+    # includes the external tools(mutool, gdal) that have been waited on
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+def get_children_max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def read_proc_status_kb(key):
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def get_max_rss_kb():
+    hwm = read_proc_status_kb('VmHWM')
+    if hwm is not None:
+        return hwm
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def reset_max_rss():
+    # linux only, lets the peak be measured per stage instead of per process
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def get_file_states(paths):
+    states = {}
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            files = [ f for f in p.rglob('*') if f.is_file() ]
+        elif p.is_file():
+            files = [ p ]
+        else:
+            files = []
+        for f in files:
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            states[str(f)] = (st.st_size, st.st_mtime_ns)
+    return states
+
+def get_bytes_written(before, after):
+    # files which are new or were rewritten during the stage
+    total = 0
+    for f, state in after.items():
+        if before.get(f) != state:
+            total += state[0]
+    return total
+
+
+class StageStats:
+    """
+    Collects wall time, cpu time, peak rss and bytes written for the stages
+    of a processor run on one sheet. Stages nest, self_wall excludes the
+    time spent in nested stages.
+    """
+    def __init__(self, sheet_id, output_paths, stats_file=STATS_FILE):
+        self.sheet_id = sheet_id
+        self.output_paths = output_paths
+        self.stats_file = Path(stats_file)
+        self.stages = []
+        self.stack = []
+        self.start_wall = time.time()
+        self.start_cpu = get_cpu_time()
+
+    def instrument(self, processor, stage_names):
+        # instance attributes shadow the methods, so calls from inside the
+        # processor go through the wrappers as well
+        for name in stage_names:
+            method = getattr(processor, name, None)
+            if method is None:
+                continue
+            setattr(processor, name, self.wrap(name, method))
+
+    def wrap(self, name, method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            self.enter(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.exit()
+        return wrapper
+
+    def enter(self, name):
+        if len(self.stack) > 0:
+            # the peak so far belongs to the enclosing stage, keep it before resetting
+            parent = self.stack[-1]
+            parent['nested_max_rss'] = max(parent['nested_max_rss'], get_max_rss_kb())
+        rss_reset = reset_max_rss()
+        entry = {
+            'stage': name,
+            'depth': len(self.stack),
+            'start': time.time(),
+            'cpu_start': get_cpu_time(),
+            'files_before': get_file_states(self.output_paths),
+            'nested_wall': 0.0,
+            'nested_max_rss': 0,
+            'rss_reset': rss_reset,
+        }
+        self.stack.append(entry)
+
+    def exit(self):
+        entry = self.stack.pop()
+        wall = time.time() - entry['start']
+        max_rss = max(get_max_rss_kb(), entry['nested_max_rss'])
+        record = {
+            'stage': entry['stage'],
+            'depth': entry['depth'],
+            'wall': wall,
+            'self_wall': wall - entry['nested_wall'],
+            'cpu': get_cpu_time() - entry['cpu_start'],
+            'max_rss_kb': max_rss,
+            'max_rss_is_per_stage': entry['rss_reset'],
+            'children_max_rss_kb': get_children_max_rss_kb(),
+            'bytes_written': get_bytes_written(entry['files_before'], get_file_states(self.output_paths)),
+        }
+        if len(self.stack) > 0:
+            parent = self.stack[-1]
+            parent['nested_wall'] += wall
+            parent['nested_max_rss'] = max(parent['nested_max_rss'], max_rss)
+        self.stages.append(record)
+
+    def save(self, status, error=None):
+        record = {
+            'sheet': self.sheet_id,
+            'status': status,
+            'error': error,
+            'time': self.start_wall,
+            'wall': time.time() - self.start_wall,
+            'cpu': get_cpu_time() - self.start_cpu,
+            'max_rss_kb': max([ s['max_rss_kb'] for s in self.stages ], default=get_max_rss_kb()),
+            'children_max_rss_kb': get_children_max_rss_kb(),
+            'bytes_written': sum(s['bytes_written'] for s in self.stages if s['depth'] == 0),
+            'stages': self.stages,
+        }
+        self.stats_file.parent.mkdir(parents=True, exist_ok=True)
+        # a single append per sheet keeps lines whole when workers share the file
+        line = json.dumps(record) + '\n'
+        fd = os.open(self.stats_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode('utf8'))
+        finally:
+            os.close(fd)
+
+
+def load_stats(stats_file):
+    records = []
+    for line in Path(stats_file).read_text().split('\n'):
+        if line.strip() == '':
+            continue
+        records.append(json.loads(line))
+    return records
+
+def percentile(values, p):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0
+    idx = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[idx]
+
+def summarize(stats_file, top):
+    records = load_stats(stats_file)
+    # only the latest run of each sheet
+    latest = {}
+    for r in records:
+        latest[r['sheet']] = r
+    records = list(latest.values())
+
+    failed = [ r for r in records if r['status'] != 'ok' ]
+    print(f'{len(records)} sheets, {len(failed)} failed')
+    print()
+
+    by_stage = {}
+    for r in records:
+        for s in r['stages']:
+            by_stage.setdefault(s['stage'], []).append(s)
+
+    total_self_wall = sum(s['self_wall'] for ss in by_stage.values() for s in ss)
+    print('stages by total time, excluding nested stages:')
+    print(f'{"stage":<24} {"count":>6} {"total(s)":>10} {"share":>6} {"mean(s)":>8} {"p95(s)":>8} {"max(s)":>8} {"cpu(s)":>9} {"max rss(MB)":>11} {"written(MB)":>11}')
+    rows = sorted(by_stage.items(), key=lambda kv: -sum(s['self_wall'] for s in kv[1]))
+    for name, ss in rows:
+        self_walls = [ s['self_wall'] for s in ss ]
+        total = sum(self_walls)
+        share = total / total_self_wall if total_self_wall > 0 else 0
+        cpu = sum(s['cpu'] for s in ss)
+        max_rss = max(max(s['max_rss_kb'], s['children_max_rss_kb']) for s in ss) / 1024
+        written = sum(s['bytes_written'] for s in ss) / (1024 * 1024)
+        print(f'{name:<24} {len(ss):>6} {total:>10.1f} {share:>6.1%} {total / len(ss):>8.1f} '
+              f'{percentile(self_walls, 95):>8.1f} {max(self_walls):>8.1f} {cpu:>9.1f} {max_rss:>11.0f} {written:>11.1f}')
+    print()
+
+    print(f'slowest {top} sheets:')
+    for r in sorted(records, key=lambda r: -r['wall'])[:top]:
+        slowest = max(r['stages'], key=lambda s: s['self_wall'], default=None)
+        slowest_str = f'{slowest["stage"]} {slowest["self_wall"]:.1f}s' if slowest is not None else '-'
+        max_rss = max(r['max_rss_kb'], r['children_max_rss_kb']) / 1024
+        print(f'{r["sheet"]:<16} {r["status"]:<7} {r["wall"]:>8.1f}s cpu {r["cpu"]:>8.1f}s max rss {max_rss:>6.0f}MB slowest stage: {slowest_str}')
+    print()
+
+    print(f'largest {top} sheets by peak memory:')
+    for r in sorted(records, key=lambda r: -max(r['max_rss_kb'], r['children_max_rss_kb']))[:top]:
+        max_rss = max(r['max_rss_kb'], r['children_max_rss_kb']) / 1024
+        print(f'{r["sheet"]:<16} {max_rss:>6.0f}MB')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='summarize the per stage stats recorded by parse.py')
+    parser.add_argument('command', choices=['summary'])
+    parser.add_argument('-f', '--stats-file', help='json lines file written by parse.py', default=str(STATS_FILE))
+    parser.add_argument('-n', '--top', help='number of sheets to list', type=int, default=20)
+    args = parser.parse_args()
+
+    summarize(args.stats_file, args.top)
@@ -0,0 +1,156 @@
+import os
+import re
+import shutil
+import struct
+import hashlib
+import logging
+import zipfile
+import tempfile
+from pathlib import Path
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+# downloads bigger than this go to a temp file on disk instead of memory
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+
+# local file header, signature .. extra field length
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+
+
+class ZipContentsError(Exception):
+    def __init__(self, msg, namelist):
+        super().__init__(msg)
+        self.namelist = namelist
+
+
+class WrongSheetError(ZipContentsError):
+    pass
+
+
+class BrokenDownloadError(Exception):
+    """
+    The download was cut short or doesn't read as a zip, trying again may work.
+    """
+    pass
+
+
+def spool_response(resp, chunk_size=CHUNK_SIZE):
+    """
+    Streams the body of a stream=True response to a spooled temp file, returns the
+    file, the number of bytes and their sha256.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    h = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in resp.iter_content(chunk_size=chunk_size):
+            if not chunk:
+                continue
+            h.update(chunk)
+            spool.write(chunk)
+            size += len(chunk)
+    except requests.exceptions.RequestException as ex:
+        spool.close()
+        raise BrokenDownloadError(f'Download cut short after {size} bytes: {ex}') from ex
+
+    # the length is of the encoded body when there is a content-encoding
+    expected_size = resp.headers.get('content-length')
+    if expected_size is not None and 'content-encoding' not in resp.headers and int(expected_size) != size:
+        spool.close()
+        raise BrokenDownloadError(f'Download has {size} of the {expected_size} bytes')
+    spool.flush()
+    spool.seek(0)
+    return spool, size, h.hexdigest()
+
+def is_member_for_sheet(name, sheet_no):
+    # the naming of the pdfs isn't known for sure, the parts of the sheet number
+    # only have to be there in order, with or without separators between them
+    parts = [ re.escape(x) for x in re.split(r'[^0-9a-z]+', sheet_no.lower()) if x != '' ]
+    pattern = r'(?<![0-9])' + r'[^0-9a-z]?'.join(parts) + r'(?![0-9])'
+    return re.search(pattern, Path(name).stem.lower()) is not None
+
+def get_member_data_offset(f, zinfo):
+    # the extra field of the local header can differ from the one in the central directory
+    f.seek(zinfo.header_offset)
+    header = LOCAL_HEADER.unpack(f.read(LOCAL_HEADER.size))
+    if header[0] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f'bad local header for {zinfo.filename}')
+    name_len, extra_len = header[-2:]
+    return zinfo.header_offset + LOCAL_HEADER.size + name_len + extra_len
+
+def copy_range(src_fd, offset, dst_fd, count):
+    while count > 0:
+        copied = os.copy_file_range(src_fd, dst_fd, count, offset_src=offset)
+        if copied == 0:
+            raise OSError(f'unexpected end of data with {count} bytes left')
+        offset += copied
+        count -= copied
+
+def extract_member(zf, zinfo, spool, spool_on_disk, out_f):
+    stored = zinfo.compress_type == zipfile.ZIP_STORED and not (zinfo.flag_bits & 0x1)
+    if stored and spool_on_disk and hasattr(os, 'copy_file_range'):
+        # uncompressed member of a download that is already on disk, copied in the kernel
+        offset = get_member_data_offset(spool, zinfo)
+        try:
+            copy_range(spool.fileno(), offset, out_f.fileno(), zinfo.file_size)
+            return
+        except OSError as ex:
+            logger.debug(f'copy_file_range failed: {ex}, copying through python')
+            out_f.seek(0)
+            out_f.truncate()
+    with zf.open(zinfo) as member_f:
+        shutil.copyfileobj(member_f, out_f, CHUNK_SIZE)
+
+def fsync_dir(dirpath):
+    fd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def extract_pdf(spool, size, out_file, sheet_no):
+    with zipfile.ZipFile(spool, 'r') as zf:
+        namelist = zf.namelist()
+        pdf_files = [ x for x in namelist if x.lower().endswith('.pdf') ]
+        if len(pdf_files) == 0:
+            raise ZipContentsError('No pdf file found in the zip', namelist)
+        if len(pdf_files) > 1:
+            raise ZipContentsError('Multiple pdf files found in the zip', namelist)
+        if sheet_no is not None and not is_member_for_sheet(pdf_files[0], sheet_no):
+            raise WrongSheetError(f'Zip holds {pdf_files[0]}, not a pdf of sheet {sheet_no}', namelist)
+        zinfo = zf.getinfo(pdf_files[0])
+
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = out_file.with_name(out_file.name + '.part')
+        try:
+            with open(temp_file, 'wb') as out_f:
+                extract_member(zf, zinfo, spool, size > SPOOL_MAX_SIZE, out_f)
+                out_f.flush()
+                os.fsync(out_f.fileno())
+            os.replace(temp_file, out_file)
+        finally:
+            temp_file.unlink(missing_ok=True)
+
+def save_pdf_from_zip_response(resp, out_file, sheet_no=None):
+    """
+    Streams the zip in resp to a temp file and extracts the single pdf in it to
+    out_file. The pdf is written next to out_file and only renamed into place
+    once it has been synced, so out_file is never seen half written. Returns the
+    size and sha256 of the zip. With sheet_no, a pdf named for another sheet
+    raises WrongSheetError. A download that is short or not a readable zip
+    raises BrokenDownloadError.
+    """
+    out_file = Path(out_file)
+    spool, size, sha256 = spool_response(resp)
+    with spool:
+        try:
+            extract_pdf(spool, size, out_file, sheet_no)
+        except (zipfile.BadZipFile, EOFError) as ex:
+            raise BrokenDownloadError(f'Broken zip of {size} bytes: {ex}') from ex
+    fsync_dir(out_file.parent)
+    logger.info(f'{out_file.name}: zip of {size} bytes, sha256 {sha256}')
+    return size, sha256